@@ -5,13 +5,22 @@ import chromadb
 from chromadb.utils import embedding_functions 
 import uuid
 import re
-import requests
+import json
+import hashlib
 from datetime import datetime
 from colorama import Fore, Style
 import ast
+import inspect
 import operator
 import time 
+import atexit
+import numpy as np
+import asyncio
+import threading
+from collections import deque, OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 from dotenv import load_dotenv # 🟢 NUOVO: per leggere il .env
+from jarvis_web import GOOGLE_SEARCH_API_KEY, GOOGLE_SEARCH_CX, SEARCH_BUDGET_S, tool_cache, web_search_async, weather_async, http_pool_stats, run_async, iterate_async
 
 # 🟢 Carica le variabili dal file .env all'avvio
 load_dotenv()
@@ -24,12 +33,31 @@ API_KEY = os.getenv("GEMINI_API_KEY")
 if not API_KEY: raise RuntimeError("GEMINI_API_KEY non impostata nel file .env o come variabile d'ambiente.")
 genai.configure(api_key=API_KEY)
 
-# 🟢 DATI PER LA RICERCA WEB DI GOOGLE (con fallback per errore chiaro)
-GOOGLE_SEARCH_API_KEY = os.getenv("GOOGLE_SEARCH_API_KEY", "ERRORE_CHIAVE_MANCANTE") 
-GOOGLE_SEARCH_CX = os.getenv("GOOGLE_SEARCH_CX", "ERRORE_CX_MANCANTE") 
-
 SIMILARITY_THRESHOLD = 1.4 
 DEDUPLICATION_THRESHOLD = 0.3
+TOOL_WORKERS = 4 # Tool eseguiti in parallelo quando Gemini ne chiede più di uno nello stesso turno
+TOOL_TIMEOUT_S = 5 # Deadline di default di un tool: oltre, il turno prosegue con un errore
+TOOL_LATENCY_BUCKETS_MS = (10, 50, 100, 250, 500, 1000, 2500, 5000, float("inf")) # Istogramma latenze per tool
+GEMINI_STREAMING = True # 🟢 Il testo arriva al TTS man mano che viene generato (False = risposta intera)
+CONTEXT_TOKEN_BUDGET = 6000 # Token massimi della history della chat (oltre si piega nel riassunto)
+CONTEXT_TARGET_RATIO = 0.6 # Una compattazione scende fino a questa frazione del budget
+SUMMARY_TOKEN_BUDGET = 600 # Il riassunto dei turni piegati scorre: le righe più vecchie escono
+EMBED_CACHE_SIZE = 1024 # Vettori tenuti in memoria (~1.5 KB l'uno per MiniLM)
+MEMORY_FLUSH_SIZE = 8 # Scritture in coda che fanno partire subito un batch su Chroma
+MEMORY_FLUSH_INTERVAL_S = 2.0 # Attesa massima di una scrittura in coda prima del batch
+MEMORY_CLOSE_TIMEOUT_S = 10 # Alla chiusura si aspetta al massimo tanto lo svuotamento della coda
+MEMORY_COLLECTION = "user_memories"
+MEMORY_DELETE_PAGE = 5000 # Id per giro nelle cancellazioni di massa (memoria costante anche con milioni di ricordi)
+HOT_INDEX_SIZE = 4096 # Ricordi nel hot tier in RAM (4096 x 384 float32 = 6 MB, top-k sotto il millisecondo)
+HOT_INDEX_ACCEPT = 0.8 # Se tutti i k risultati caldi sono più vicini di così, Chroma non si interroga
+HOT_INDEX_PATH = os.path.join(os.getcwd(), "memoria_db", "hot_index") # .f32 (matrice mappata) + .json (id e testi, scritto alla chiusura)
+MEMORY_RETENTION_DAYS = {"user": None} # Giorni di vita dei ricordi per speaker (None = per sempre: qui sono fatti salvati apposta)
+MEMORY_DUP_SIMILARITY = 0.92 # Coseno oltre il quale due ricordi sono lo stesso (resta il più recente)
+MEMORY_COMPACT_BLOCK = 1024 # Ricordi per blocco nella compattazione (matrice di similarità 1024 x 1024)
+MEMORY_COMPACT_WINDOW = 8 # Blocchi precedenti con cui si confronta ogni blocco (RAM limitata, doppioni vicini nel tempo)
+MEMORY_COMPACT_DELAY_S = 120 # Primo giro di compattazione dopo l'avvio
+MEMORY_COMPACT_INTERVAL_S = 6 * 3600 # Giri successivi (0 = solo a mano)
+MEMORY_COMPACT_PROBES = 20 # Query campione per misurare la latenza prima e dopo
 
 # Mappa per gli operatori AST (Calcolatrice Sicura)
 _op_map = {
@@ -44,13 +72,335 @@ try:
     chroma_client = chromadb.PersistentClient(path=db_path)
     embedder_fn = embedding_functions.SentenceTransformerEmbeddingFunction(model_name="all-MiniLM-L6-v2")
     collection = chroma_client.get_or_create_collection(
-        name="user_memories",
+        name=MEMORY_COLLECTION,
         embedding_function=embedder_fn
     )
     print(f"{Fore.GREEN}✅ Database Caricato: {collection.count()} ricordi.{Style.RESET_ALL}")
 except Exception as e:
     print(f"{Fore.RED}❌ ERRORE DATABASE: {e}{Style.RESET_ALL}"); collection = None
 
+# --- CACHE EMBEDDING ---
+class EmbeddingCache:
+    """Embedding con LRU per hash del testo: ogni stringa si calcola una volta sola, i vettori vanno diretti a Chroma."""
+    def __init__(self, encode, max_entries=EMBED_CACHE_SIZE):
+        self.encode = encode            # lista di testi -> lista di vettori (un solo batch)
+        self.max_entries = max_entries
+        self.vectors = OrderedDict()    # sha1 del testo -> vettore (lista di float)
+        self.lock = threading.Lock()    # Tool, salvataggi e ricerche arrivano da thread diversi
+        self.hits = self.misses = 0
+
+    def embed(self, texts):
+        keys = [hashlib.sha1(t.encode("utf-8")).hexdigest() for t in texts]
+        with self.lock:
+            found = {k: self.vectors[k] for k in keys if k in self.vectors}
+            for k in found: self.vectors.move_to_end(k)
+        # I mancanti si calcolano insieme, fuori dal lock (il modello è la parte lenta)
+        todo = {k: t for k, t in zip(keys, texts) if k not in found}
+        if todo:
+            computed = [list(map(float, v)) for v in self.encode(list(todo.values()))]
+            found.update(zip(todo, computed))
+        with self.lock:
+            self.hits += len(texts) - len(todo); self.misses += len(todo)
+            for k in todo:
+                self.vectors[k] = found[k]
+            while len(self.vectors) > self.max_entries: self.vectors.popitem(last=False)
+        return [found[k] for k in keys]
+
+    def stats(self):
+        total = self.hits + self.misses
+        return f"embedding hit {self.hits / total:.0%} ({self.hits}/{total})" if total else "embedding: nessuno"
+
+embed_cache = EmbeddingCache(lambda texts: embedder_fn(texts))
+
+# --- SCRITTURE IN DIFFERITA (write-behind) ---
+class MemoryWriter:
+    """I salvataggi tornano subito: un thread li scrive su Chroma a blocchi (per dimensione, tempo o alla chiusura)."""
+    def __init__(self, write, flush_size=MEMORY_FLUSH_SIZE, flush_interval=MEMORY_FLUSH_INTERVAL_S):
+        self.write = write                  # lista di (testo, speaker) -> una scrittura batch
+        self.flush_size, self.flush_interval = flush_size, flush_interval
+        self.queue, self.inflight = [], []  # In coda / in scrittura: entrambi visibili a Memory.search
+        self.oldest = 0.0                   # Arrivo del primo elemento in coda (trigger a tempo)
+        self.flush_requested = self.closed = False
+        self.cond = threading.Condition()
+        self.batches = self.written = 0
+        self.thread = threading.Thread(target=self._run, daemon=True, name="jarvis-memory-writer")
+        self.thread.start()
+        atexit.register(self.close)         # Chiusura pulita: quel che è in coda arriva su disco
+
+    def submit(self, entries):
+        with self.cond:
+            if not self.queue: self.oldest = time.monotonic()
+            self.queue.extend(entries)
+            self.cond.notify_all()  # Il thread ricalcola la scadenza (o parte subito se la coda è piena)
+
+    def _due(self):
+        return self.closed or self.flush_requested or len(self.queue) >= self.flush_size or \
+            (self.queue and time.monotonic() - self.oldest >= self.flush_interval)
+
+    def _run(self):
+        while True:
+            with self.cond:
+                while not self._due():
+                    self.cond.wait(max(0.0, self.flush_interval - (time.monotonic() - self.oldest)) if self.queue else None)
+                if not self.queue:
+                    if self.closed: return
+                    self.flush_requested = False
+                    continue
+                batch, self.queue = self.queue, []
+                self.inflight = batch
+            try: self.write(batch)
+            except Exception as e: print(f"{Fore.RED}❌ Scrittura memoria fallita: {e}{Style.RESET_ALL}")
+            with self.cond:
+                self.inflight = []
+                self.batches += 1; self.written += len(batch)
+                self.cond.notify_all()
+
+    def pending(self):
+        """Testi inviati ma non ancora su Chroma (read-your-writes)."""
+        with self.cond: return self.inflight + self.queue
+
+    def flush(self, timeout=None):
+        """Attende che quanto inviato finora sia scritto."""
+        with self.cond:
+            self.flush_requested = True
+            self.cond.notify_all()
+            return self.cond.wait_for(lambda: not self.queue and not self.inflight, timeout)
+
+    def discard(self):
+        """Reset della memoria: la coda non va più scritta (una scrittura già in corso termina prima)."""
+        with self.cond:
+            self.queue.clear()
+            self.cond.wait_for(lambda: not self.inflight)
+
+    def close(self):
+        with self.cond:
+            if self.closed: return
+            self.closed = True
+            self.cond.notify_all()
+        self.thread.join(timeout=MEMORY_CLOSE_TIMEOUT_S)
+
+    def stats(self):
+        with self.cond:
+            return f"scritture {self.written} in {self.batches} batch, in coda {len(self.queue) + len(self.inflight)}"
+
+def _pending_hits(vector):
+    """Testi ancora in coda di scrittura con la stessa distanza di Chroma (L2 al quadrato) dal vettore della query."""
+    texts = [text for text, _ in memory_writer.pending()]
+    if not texts: return []
+    q = np.asarray(vector, dtype=np.float32)
+    return [(text, float(((np.asarray(v, dtype=np.float32) - q) ** 2).sum())) for text, v in zip(texts, embed_cache.embed(texts))]
+
+def _merge_hits(hits, limit):
+    """Chroma + coda, senza doppioni, in ordine di distanza."""
+    best = {}
+    for doc, dist in hits:
+        if doc not in best or dist < best[doc]: best[doc] = dist
+    return sorted(best.items(), key=lambda h: h[1])[:limit]
+
+# --- INDICE CALDO (hot tier davanti a Chroma) ---
+class HotIndex:
+    """Ricordi più recenti e più usati in una matrice float32 mappata su disco: top-k vettoriale, Chroma solo per il resto."""
+    def __init__(self, path, capacity=HOT_INDEX_SIZE, total=0):
+        self.path, self.capacity = path, capacity
+        self.lock = threading.Lock()        # Ricerche, writer e cancellazioni arrivano da thread diversi
+        self.hot = self.cold = 0
+        self.hot_ms, self.cold_ms = deque(maxlen=256), deque(maxlen=256)
+        self._empty()
+        self._load(total)
+        atexit.register(self.close)         # Registrato prima del writer: si chiude dopo l'ultimo batch
+
+    def _empty(self):
+        self.matrix = None                  # np.memmap (capacity x dim), creato al primo vettore
+        self.norms = np.full(self.capacity, np.inf, dtype=np.float32)  # inf = riga libera (mai nel top-k)
+        self.ids, self.docs = [None] * self.capacity, [None] * self.capacity
+        self.used = np.zeros(self.capacity, dtype=np.int64)  # Ultimo uso (salvataggio o risultato): il minimo esce
+        self.row_of, self.free = {}, list(range(self.capacity - 1, -1, -1))
+        self.tick, self.complete = 0, True  # complete: il caldo contiene tutta la collection (risposta esatta)
+
+    def _open(self, dim, mode):
+        os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+        self.matrix = np.memmap(self.path + ".f32", dtype=np.float32, mode=mode, shape=(self.capacity, dim))
+
+    def _load(self, total):
+        # Il sidecar esiste solo dopo una chiusura pulita: si consuma subito, così dopo un crash si riparte da vuoto
+        try:
+            with open(self.path + ".json", encoding="utf-8") as f: meta = json.load(f)
+            os.remove(self.path + ".json")
+            if meta["capacity"] != self.capacity: raise ValueError("HOT_INDEX_SIZE cambiato")  # Si riparte da vuoto, non completo
+            self._open(meta["dim"], "r+")
+            for row, (id_, doc, used) in enumerate(zip(meta["ids"], meta["docs"], meta["used"])):
+                if id_ is None: continue
+                self.ids[row], self.docs[row], self.used[row] = id_, doc, used
+                self.row_of[id_] = row
+                self.norms[row] = float(self.matrix[row] @ self.matrix[row])
+            self.free = [row for row in range(self.capacity - 1, -1, -1) if self.ids[row] is None]
+            self.tick, self.complete = meta["tick"], meta["complete"] and total == len(self.row_of)
+        except Exception:
+            self._empty()
+            self.complete = total == 0
+
+    def add(self, ids, docs, vectors):
+        """Salvataggi e risultati promossi da Chroma: entrano (o si rinfrescano) in testa."""
+        with self.lock:
+            for id_, doc, vector in zip(ids, docs, vectors):
+                v = np.asarray(vector, dtype=np.float32)
+                if self.matrix is None: self._open(len(v), "w+")
+                row = self.row_of.get(id_)
+                if row is None:
+                    if self.free: row = self.free.pop()
+                    else:  # Pieno: esce il ricordo usato meno di recente, che resta solo su Chroma
+                        row = int(np.argmin(self.used))
+                        del self.row_of[self.ids[row]]
+                        self.complete = False
+                    self.row_of[id_] = row
+                self.matrix[row] = v
+                self.norms[row] = float(v @ v)
+                self.ids[row], self.docs[row] = id_, doc
+                self.tick += 1; self.used[row] = self.tick
+
+    def remove(self, ids):
+        with self.lock:
+            for id_ in ids:
+                row = self.row_of.pop(id_, None)
+                if row is None: continue
+                self.norms[row] = np.inf
+                self.ids[row] = self.docs[row] = None
+                self.free.append(row)
+
+    def clear(self):
+        with self.lock:
+            matrix = self.matrix
+            self._empty()
+            self.matrix = matrix  # Il file resta: le righe libere hanno norma inf e non escono mai
+
+    def search(self, vector, limit):
+        """(risultati [(doc, distanza L2 al quadrato come Chroma)], esatto)."""
+        with self.lock:
+            k = min(limit, len(self.row_of))
+            if not k: return [], self.complete
+            q = np.asarray(vector, dtype=np.float32)
+            dists = self.norms - 2.0 * (self.matrix @ q) + float(q @ q)
+            rows = np.argpartition(dists, k - 1)[:k]
+            rows = rows[np.argsort(dists[rows])]
+            for row in rows:
+                self.tick += 1; self.used[row] = self.tick
+            return [(self.docs[row], max(0.0, float(dists[row]))) for row in rows], self.complete
+
+    def record(self, hot, ms):
+        with self.lock:
+            if hot: self.hot += 1; self.hot_ms.append(ms)
+            else: self.cold += 1; self.cold_ms.append(ms)
+
+    def close(self):
+        with self.lock:
+            if self.matrix is None: return
+            self.matrix.flush()
+            meta = {"capacity": self.capacity, "dim": self.matrix.shape[1], "tick": self.tick, "complete": self.complete,
+                    "ids": self.ids, "docs": self.docs, "used": self.used.tolist()}
+            with open(self.path + ".json", "w", encoding="utf-8") as f: json.dump(meta, f, ensure_ascii=False)
+
+    def stats(self):
+        with self.lock:
+            total = self.hot + self.cold
+            if not total: return f"hot tier {len(self.row_of)}/{self.capacity}, nessuna ricerca"
+            p50 = lambda xs: f"{np.median(xs):.2f} ms" if xs else "-"
+            return (f"hot tier {len(self.row_of)}/{self.capacity}, {self.hot / total:.0%} dal caldo (p50 {p50(self.hot_ms)})"
+                    f" / Chroma {self.cold} (p50 {p50(self.cold_ms)})")
+
+hot_index = HotIndex(HOT_INDEX_PATH, total=collection.count() if collection is not None else 0)
+
+# ==========================================
+# 🧰 REGISTRO TOOL (schema, dispatch, deadline, metriche)
+# ==========================================
+
+_JSON_TYPES = {str: "string", int: "integer", float: "number", bool: "boolean"}
+
+class _ToolSpec:
+    """Un tool registrato: funzione, parametri ricavati dalla firma, deadline e metriche."""
+    def __init__(self, name, fn, timeout_s):
+        self.name, self.fn, self.timeout_s = name, fn, timeout_s
+        params = inspect.signature(fn).parameters.values()
+        self.params = {p.name: _JSON_TYPES.get(p.annotation, "string") for p in params}
+        self.required = [p.name for p in params if p.default is p.empty]
+        self.description = inspect.getdoc(fn) or name
+        self.hist = [0] * len(TOOL_LATENCY_BUCKETS_MS)  # Istogramma delle latenze (ms)
+        self.calls = self.errors = self.timeouts = 0
+
+    def record(self, ms):
+        self.calls += 1
+        self.hist[next(i for i, bound in enumerate(TOOL_LATENCY_BUCKETS_MS) if ms <= bound)] += 1
+
+    def percentile(self, q):
+        """Limite superiore del bucket che contiene il quantile q."""
+        seen = 0
+        for bound, n in zip(TOOL_LATENCY_BUCKETS_MS, self.hist):
+            seen += n
+            if seen >= q * self.calls: return bound
+
+class ToolRegistry:
+    """Registro unico: lo schema per il modello nasce da firma e docstring dei metodi di Tools, il dispatch è un lookup."""
+    def __init__(self):
+        self.specs = {}
+
+    def tool(self, name, timeout_s=TOOL_TIMEOUT_S, enabled=True):
+        """Decoratore: registra la funzione col nome visto dal modello (va sotto @staticmethod)."""
+        def register(fn):
+            if enabled: self.specs[name] = _ToolSpec(name, fn, timeout_s)
+            return fn
+        return register
+
+    def schema(self):
+        """Schema JSON dei tool (formato Ollama / OpenAI)."""
+        return [{"type": "function", "function": {
+            "name": s.name, "description": s.description,
+            "parameters": {"type": "object", "properties": {p: {"type": t} for p, t in s.params.items()}, "required": s.required},
+        }} for s in self.specs.values()]
+
+    def gemini_tools(self):
+        """Lo stesso schema come dichiarazioni di funzione Gemini."""
+        types = {"string": genai.protos.Type.STRING, "integer": genai.protos.Type.INTEGER, "number": genai.protos.Type.NUMBER, "boolean": genai.protos.Type.BOOLEAN}
+        decls = []
+        for s in self.specs.values():
+            params = None  # Senza argomenti Gemini vuole parameters assente, non un oggetto vuoto
+            if s.params:
+                params = genai.protos.Schema(type_=genai.protos.Type.OBJECT, required=s.required,
+                    properties={p: genai.protos.Schema(type_=types[t]) for p, t in s.params.items()})
+            decls.append(genai.protos.FunctionDeclaration(name=s.name, description=s.description, parameters=params))
+        return [genai.protos.Tool(function_declarations=decls)]
+
+    async def arun(self, name, args):
+        """Esegue il tool sul pool entro la sua deadline; errori e timeout tornano come testo per il modello."""
+        spec = self.specs.get(name)
+        if spec is None: return f"Errore: tool '{name}' sconosciuto."
+        kwargs = {k: v for k, v in (args or {}).items() if k in spec.params}  # Argomenti inventati dal modello: ignorati
+        missing = [p for p in spec.required if p not in kwargs]
+        if missing:
+            spec.errors += 1
+            return f"Errore: argomenti mancanti per {name}: {', '.join(missing)}."
+        
+        t0 = time.perf_counter()
+        try:
+            res = await asyncio.wait_for(asyncio.get_running_loop().run_in_executor(_tool_pool, lambda: spec.fn(**kwargs)), spec.timeout_s)
+            if isinstance(res, str) and res.startswith("Err"): spec.errors += 1  # I tool restituiscono gli errori come testo
+        except asyncio.TimeoutError:
+            # Il thread non si può interrompere, ma il turno prosegue senza aspettarlo
+            spec.timeouts += 1
+            res = f"Errore: il tool {name} non ha risposto entro {spec.timeout_s:g} secondi."
+        except Exception as e:
+            spec.errors += 1
+            res = f"Errore: {e}"
+        ms = (time.perf_counter() - t0) * 1000
+        spec.record(ms)
+        print(f"{Fore.BLACK}{Style.BRIGHT}⏱️ Tool {name}: {ms:.0f} ms{Style.RESET_ALL}")
+        return res
+
+    def stats(self):
+        used = [s for s in self.specs.values() if s.calls]
+        return ", ".join(f"{s.name} {s.calls}x p50≤{s.percentile(0.5):g} p95≤{s.percentile(0.95):g} ms err {s.errors} timeout {s.timeouts}" for s in used) or "nessuna chiamata"
+
+_tool_pool = ThreadPoolExecutor(max_workers=TOOL_WORKERS, thread_name_prefix="jarvis-tool")
+registry = ToolRegistry()
+
 # ==========================================
 # 🛠️ CLASSE TOOLS (Tutte le Abilità Reali)
 # ==========================================
@@ -67,8 +417,9 @@ class Tools:
         raise TypeError(node)
 
     @staticmethod
-    def calculate(expression):
-        """Esegue calcoli matematici in modo sicuro."""
+    @registry.tool("calc", timeout_s=1)
+    def calculate(expression: str):
+        """Esegue un calcolo matematico."""
         try:
             tree = ast.parse(expression, mode='eval')
             result = Tools._evaluate_expression(tree)
@@ -78,19 +429,18 @@ class Tools:
     
     # --- MEMORIA ---
     @staticmethod
-    def save_memory(info):
+    @registry.tool("save_mem")
+    def save_memory(info: str):
         """Salva informazioni importanti sull'utente nel database a lungo termine."""
         if collection is None: return "Errore DB."
-        try:
-            collection.add(documents=[info], metadatas=[{"speaker": "user", "timestamp": datetime.now().isoformat()}], ids=[str(uuid.uuid4())])
-            print(f"{Fore.GREEN}💾 [MEMORIA] Salvato.{Style.RESET_ALL}")
-            return "Salvato."
-        except Exception as e: return f"Errore: {e}"
+        memory_writer.submit([(info, "user")])  # Scritta in differita, ma già visibile a Memory.search
+        return "Salvato."
 
     # 🟢 --- WEB SEARCH (Google Search API Stabile) ---
     @staticmethod
-    def web_search(query):
-        """Esegue una ricerca su Google via API e restituisce un riassunto."""
+    @registry.tool("search_web", timeout_s=SEARCH_BUDGET_S + 1)
+    def web_search(query: str):
+        """Esegue una ricerca su internet e restituisce un riassunto."""
         print(f"{Fore.CYAN}🌐 Google Search API: '{query}'...{Style.RESET_ALL}")
         
         # 🟢 VERIFICA DEI VALORI DEL .env
@@ -99,44 +449,9 @@ class Tools:
         if GOOGLE_SEARCH_CX == "ERRORE_CX_MANCANTE":
             return "Errore: GOOGLE_SEARCH_CX non trovato nel file .env."
         
-        url = "https://www.googleapis.com/customsearch/v1"
-        
-        params = {
-            "key": GOOGLE_SEARCH_API_KEY,
-            "cx": GOOGLE_SEARCH_CX,
-            "q": query,
-            "num": 3, 
-            "gl": "it", 
-            "lr": "lang_it" 
-        }
-        
+        # 🟢 Ricerca asincrona sul loop di servizio: niente sleep bloccanti, risposta entro SEARCH_BUDGET_S
         try:
-            for i in range(3): 
-                response = requests.get(url, params=params, timeout=5)
-                response.raise_for_status() 
-                data = response.json()
-                
-                if data.get('error'):
-                    error_detail = data['error']['message']
-                    print(f"{Fore.RED}❌ ERRORE GOOGLE API (Configurazione/Rate-Limit): {error_detail}{Style.RESET_ALL}")
-                    return f"Errore di configurazione API: {error_detail}"
-                
-                items = data.get("items", [])
-                
-                if items:
-                    results = []
-                    for item in items:
-                        results.append(f"- {item.get('title')}: {item.get('snippet')}")
-                    
-                    return "\n".join(results)[:1500]
-                
-                time.sleep(1.5) 
-                
-            return "Nessun risultato trovato sul web."
-
-        except requests.exceptions.RequestException as e:
-            print(f"{Fore.RED}❌ ERRORE GOOGLE API (Network): {e}{Style.RESET_ALL}")
-            return "In questo momento non riesco a cercare sul web. Riprova più tardi."
+            return run_async(web_search_async(query))
         except Exception as e:
             print(f"{Fore.RED}❌ ERRORE GOOGLE API (Generico): {e}{Style.RESET_ALL}")
             return "In questo momento non riesco a cercare sul web. Riprova più tardi."
@@ -144,17 +459,12 @@ class Tools:
 
     # --- METEO (Open-Meteo) ---
     @staticmethod
-    def get_weather(city):
+    @registry.tool("get_weather_at", timeout_s=8)
+    def get_weather(city: str):
         """Ottiene il meteo attuale per una specifica città."""
         print(f"{Fore.CYAN}☁️ Meteo: {city}...{Style.RESET_ALL}")
-        try:
-            geo = requests.get("https://geocoding-api.open-meteo.com/v1/search", params={"name": city, "count": 1}, timeout=3).json()
-            if not geo.get("results"): return "Città non trovata."
-            lat, lon = geo["results"][0]["latitude"], geo["results"][0]["longitude"]
-            weather_data = requests.get("https://api.open-meteo.com/v1/forecast", params={"latitude": lat, "longitude": lon, "current_weather": True}, timeout=3).json()
-            cw = weather_data.get("current_weather")
-            if not cw: return "Impossibile ottenere il meteo attuale."
-            return f"Meteo {city}: {cw['temperature']}°C, Vento {cw['windspeed']} km/h."
+        # 🟢 Stessa sessione keep-alive della ricerca, sul loop di servizio
+        try: return run_async(weather_async(city))
         except Exception as e: return f"Err Meteo: {e}"
 
     # --- FILESYSTEM (Desktop Sandbox) ---
@@ -166,6 +476,7 @@ class Tools:
         return target
 
     @staticmethod
+    @registry.tool("list_f", timeout_s=2)
     def list_files():
         """Elenca i file e le cartelle presenti sul Desktop."""
         print(f"{Fore.CYAN}📂 Listo file Desktop...{Style.RESET_ALL}")
@@ -173,7 +484,8 @@ class Tools:
         except Exception as e: return f"Errore: {e}"
         
     @staticmethod
-    def read_file(filename):
+    @registry.tool("read_f", timeout_s=2)
+    def read_file(filename: str):
         """Legge il contenuto di un file di testo sul Desktop."""
         print(f"{Fore.CYAN}📂 Leggo: {filename}...{Style.RESET_ALL}")
         try:
@@ -184,7 +496,8 @@ class Tools:
         except Exception as e: return f"Err: {e}"
     
     @staticmethod
-    def write_file(filename, content):
+    @registry.tool("write_f", timeout_s=2)
+    def write_file(filename: str, content: str):
         """Crea o sovrascrive un file di testo sul Desktop."""
         print(f"{Fore.CYAN}✍️ Scrivo: {filename}...{Style.RESET_ALL}")
         try:
@@ -195,7 +508,8 @@ class Tools:
         except Exception as e: return f"Err: {e}"
 
     @staticmethod
-    def create_folder(foldername):
+    @registry.tool("create_dir", timeout_s=2)
+    def create_folder(foldername: str):
         """Crea una nuova cartella sul Desktop."""
         print(f"{Fore.CYAN}📁 Creo Cartella: {foldername}...{Style.RESET_ALL}")
         try:
@@ -207,61 +521,336 @@ class Tools:
     
     # --- BASE ---
     @staticmethod
-    def get_time(): return datetime.now().strftime("%H:%M")
+    @registry.tool("get_t", timeout_s=1)
+    def get_time():
+        """Restituisce l'orario corrente."""
+        return datetime.now().strftime("%H:%M")
 
 # --- CLASSE MEMORIA (Per compatibilità e reset) ---
 class Memory:
     @staticmethod
     def save_direct(text): return Tools.save_memory(text)
+
+    @staticmethod
+    def save_many(entries):
+        """Scrive più (testo, speaker) con un solo batch di embedding, una query di dedup e un solo add (thread di MemoryWriter)."""
+        vectors = embed_cache.embed([text for text, _ in entries])
+        res = collection.query(query_embeddings=vectors, n_results=1, include=["distances"])
+        new = [(entry, v) for entry, v, dists in zip(entries, vectors, res['distances']) if not (dists and dists[0] < DEDUPLICATION_THRESHOLD)]
+        if not new: return
+        texts, vectors = [text for (text, _), _ in new], [v for _, v in new]
+        ids, now = [str(uuid.uuid4()) for _ in new], datetime.now()
+        collection.add(documents=texts, embeddings=vectors, metadatas=[{"speaker": speaker, "timestamp": now.isoformat(), "ts": now.timestamp()} for (_, speaker), _ in new], ids=ids)
+        hot_index.add(ids, texts, vectors)
+        print(f"{Fore.GREEN}💾 [MEMORIA] Salvato ({len(new)}).{Style.RESET_ALL}")
+    
+    @staticmethod
+    def _stored_hits(vector, limit):
+        """Hot tier se basta (completo o k risultati tutti vicini), altrimenti Chroma: i risultati freddi salgono nel caldo."""
+        start = time.perf_counter()
+        hits, exact = hot_index.search(vector, limit)
+        if exact or (len(hits) == limit and hits[-1][1] < HOT_INDEX_ACCEPT):
+            hot_index.record(True, (time.perf_counter() - start) * 1000)
+            return hits
+        res = collection.query(query_embeddings=[vector], n_results=limit, include=["documents", "distances", "embeddings"])
+        hot_index.add(res['ids'][0], res['documents'][0], res['embeddings'][0])
+        hot_index.record(False, (time.perf_counter() - start) * 1000)
+        return list(zip(res['documents'][0], res['distances'][0]))
+    
+    @staticmethod
+    def benchmark_delete(sizes=(1_000, 100_000, 1_000_000), dim=384):
+        """Tempi e picco di memoria Python di reset, forget_where e del vecchio get()+delete su store sintetici.
+        La metà più vecchia ha solo il "timestamp" ISO, come gli store nati prima di "ts": forget_where(until) paga il backfill.
+        Gira su una PersistentClient in una cartella temporanea, con la compattazione ferma; svuota il hot tier e la coda di scrittura."""
+        import tempfile, tracemalloc
+        global chroma_client, collection
+        saved, rng, lines = (chroma_client, collection), np.random.default_rng(0), []
+
+        def fill(n):
+            global collection, _ts_backfilled
+            try: chroma_client.delete_collection(MEMORY_COLLECTION)
+            except Exception: pass
+            collection = chroma_client.get_or_create_collection(name=MEMORY_COLLECTION, embedding_function=embedder_fn)
+            now = time.time()
+            for start in range(0, n, MEMORY_DELETE_PAGE):
+                ids = range(start, min(start + MEMORY_DELETE_PAGE, n))
+                collection.add(ids=[f"bench-{i}" for i in ids], documents=[f"U: ricordo di prova numero {i}" for i in ids],
+                               embeddings=rng.standard_normal((len(ids), dim), dtype=np.float32),
+                               metadatas=[{"speaker": "ai" if i % 2 else "user", "timestamp": datetime.fromtimestamp(now - i).isoformat(),
+                                           **({} if i >= n // 2 else {"ts": now - i})} for i in ids])
+            _ts_backfilled = False
+            return now
+
+        def measure(fn):
+            tracemalloc.start()
+            start = time.perf_counter()
+            try: res = fn(); result = f"{time.perf_counter() - start:7.2f} s, picco {tracemalloc.get_traced_memory()[1] / 1e6:6.1f} MB ({res})"
+            except Exception as e: result = f"errore ({e})"
+            tracemalloc.stop()
+            return result
+
+        def legacy():
+            ids = collection.get()['ids']
+            if ids: collection.delete(ids=ids)
+            return f"{len(ids)} cancellati"
+
+        memory_compactor.stopped.set()  # Niente giri periodici: falserebbero i tempi, e in coda sul lock partirebbero all'uscita
+        try:
+            with memory_compactor.lock, tempfile.TemporaryDirectory(prefix="jarvis-bench-") as tmp:
+                chroma_client = chromadb.PersistentClient(path=tmp)
+                for n in sizes:
+                    t0 = time.perf_counter(); now = fill(n); fill_s = time.perf_counter() - t0
+                    lines.append(f"{n:>9} ricordi (inserimento {fill_s:.0f} s)")
+                    lines.append(f"  get()+delete       : {measure(legacy)}")
+                    if collection.count() != n: now = fill(n)  # Se il vecchio percorso fallisce lo store resta intatto
+                    lines.append(f"  forget_where(until): {measure(lambda: Memory.forget_where(until=now - n // 2 + 0.5))}")
+                    lines.append(f"  forget_where(ai)   : {measure(lambda: Memory.forget_where(speaker='ai'))}")
+                    fill(n); lines.append(f"  reset (drop+create): {measure(Memory.reset)}")
+                    print("\n".join(lines[-5:]))
+                chroma_client = None  # Rilascia i file prima della rimozione della cartella
+        finally:
+            chroma_client, collection = saved
+        return "\n".join(lines)
+
+    @staticmethod
+    def benchmark_search(queries, limit=3):
+        """Hot tier contro il solo Chroma: recall@k sui documenti e latenze p50."""
+        if collection is None or not queries: return "Niente da misurare."
+        tiered_ms, chroma_ms, found, expected = [], [], 0, 0
+        for vector in embed_cache.embed(queries):
+            start = time.perf_counter()
+            tiered = {doc for doc, _ in Memory._stored_hits(vector, limit)}
+            tiered_ms.append((time.perf_counter() - start) * 1000)
+            start = time.perf_counter()
+            truth = set(collection.query(query_embeddings=[vector], n_results=limit)['documents'][0])
+            chroma_ms.append((time.perf_counter() - start) * 1000)
+            found += len(truth & tiered); expected += len(truth)
+        return (f"recall@{limit} {found / max(expected, 1):.1%} | hot tier p50 {np.median(tiered_ms):.2f} ms"
+                f" | Chroma p50 {np.median(chroma_ms):.2f} ms ({len(queries)} query)")
     
     @staticmethod
     def search(query, limit=3):
         if collection is None: return []
         try:
-            res = collection.query(query_texts=[query], n_results=limit)
-            return [doc for doc, dist in zip(res['documents'][0], res['distances'][0]) if dist < SIMILARITY_THRESHOLD] if res['documents'] else []
+            vector = embed_cache.embed([query])[0]
+            return [doc for doc, dist in _merge_hits(Memory._stored_hits(vector, limit) + _pending_hits(vector), limit) if dist < SIMILARITY_THRESHOLD]
         except: return []
     
+    @staticmethod
+    def _where(speaker=None, since=None, until=None):
+        """Filtro Chroma su speaker e su ts in [since, until) (datetime o epoch)."""
+        conds = [{"speaker": speaker}] if speaker else []
+        if since is not None: conds.append({"ts": {"$gte": since.timestamp() if isinstance(since, datetime) else since}})
+        if until is not None: conds.append({"ts": {"$lt": until.timestamp() if isinstance(until, datetime) else until}})
+        return None if not conds else conds[0] if len(conds) == 1 else {"$and": conds}
+
+    @staticmethod
+    def backfill_ts():
+        """Copia il vecchio "timestamp" ISO in "ts" numerico, a pagine di soli metadati: i filtri per data vedono solo ts."""
+        global _ts_backfilled
+        fixed, offset = 0, 0
+        while True:
+            res = collection.get(offset=offset, limit=MEMORY_DELETE_PAGE, include=["metadatas"])
+            if not res['ids']: break
+            offset += len(res['ids'])
+            legacy = [(id_, {**m, "ts": _entry_ts(m)}) for id_, m in zip(res['ids'], res['metadatas']) if m and m.get("ts") is None]
+            legacy = [(id_, m) for id_, m in legacy if not np.isnan(m["ts"])]  # Senza data leggibile resta fuori dai filtri per data
+            if legacy:
+                collection.update(ids=[id_ for id_, _ in legacy], metadatas=[m for _, m in legacy]); fixed += len(legacy)
+        _ts_backfilled = True
+        if fixed: print(f"{Fore.GREEN}🕰️ [DB] Data numerica aggiunta a {fixed} ricordi del vecchio formato.{Style.RESET_ALL}")
+        return fixed
+
+    @staticmethod
+    def forget_where(speaker=None, since=None, until=None):
+        """Dimentica in blocco per speaker e/o intervallo di tempo, a pagine di soli id."""
+        if collection is None: return "Errore DB."
+        where = Memory._where(speaker, since, until)
+        if where is None: return Memory.reset()
+        memory_writer.flush()
+        deleted = 0
+        with memory_compactor.lock:  # Un giro a metà riscriverebbe i doppioni accorpati appena cancellati
+            try:
+                if (since is not None or until is not None) and not _ts_backfilled: Memory.backfill_ts()
+                while True:  # Ogni pagina cancellata esce dal filtro: si riparte sempre dall'inizio
+                    ids = collection.get(where=where, limit=MEMORY_DELETE_PAGE, include=[])['ids']
+                    if not ids: break
+                    collection.delete(ids=ids); hot_index.remove(ids); deleted += len(ids)
+                print(f"{Fore.GREEN}🗑️ [DB] {deleted} ricordi cancellati.{Style.RESET_ALL}")
+                return f"Cancellati {deleted} ricordi."
+            except: return "Errore cancellazione."
+
     @staticmethod
     def reset():
+        """Drop e ricreazione della collection: costa uguale con mille o un milione di ricordi."""
+        global collection
         if collection is None: return "Errore DB."
-        try:
-            ids = collection.get()['ids']
-            if ids: collection.delete(ids=ids)
-            print(f"{Fore.GREEN}🗑️ [DB] Memoria cancellata.{Style.RESET_ALL}")
-            return "Memoria cancellata completamente."
-        except: return "Errore reset."
-
-# --- DEFINIZIONE TOOLS PER GEMINI ---
-def save_mem(info: str): 
-    """Salva informazioni importanti sull'utente nel database a lungo termine."""
-    return Tools.save_memory(info)
-def search_web(query: str):
-    """Esegue una ricerca su internet e restituisce un riassunto."""
-    return Tools.web_search(query)
-def get_weather_at(city: str):
-    """Ottiene il meteo attuale per una specifica città."""
-    return Tools.get_weather(city)
-def list_f():
-    """Elenca i file e le cartelle presenti sul Desktop."""
-    return Tools.list_files()
-def read_f(filename: str):
-    """Legge il contenuto di un file di testo sul Desktop."""
-    return Tools.read_file(filename)
-def write_f(filename: str, content: str):
-    """Crea o sovrascrive un file di testo sul Desktop."""
-    return Tools.write_file(filename, content)
-def create_dir(foldername: str):
-    """Crea una nuova cartella sul Desktop."""
-    return Tools.create_folder(foldername)
-def get_t():
-    """Restituisce l'orario corrente."""
-    return Tools.get_time()
-def calc(expr: str):
-    """Esegue un calcolo matematico."""
-    return Tools.calculate(expr)
-
-MY_TOOLS = [save_mem, search_web, get_weather_at, list_f, read_f, write_f, create_dir, get_t, calc]
+        memory_writer.discard()
+        with memory_compactor.lock:  # Un giro a metà scriverebbe sulla collection appena eliminata
+            try:
+                chroma_client.delete_collection(MEMORY_COLLECTION)
+                hot_index.clear()
+                collection = chroma_client.get_or_create_collection(name=MEMORY_COLLECTION, embedding_function=embedder_fn)
+                print(f"{Fore.GREEN}🗑️ [DB] Memoria cancellata.{Style.RESET_ALL}")
+                return "Memoria cancellata completamente."
+            except: return "Errore reset."
+
+memory_writer = MemoryWriter(Memory.save_many)
+
+# --- COMPATTAZIONE IN BACKGROUND ---
+def _entry_ts(meta):
+    """Epoch del ricordo: "ts" numerico, o il vecchio "timestamp" ISO (nan se manca)."""
+    if meta and meta.get("ts") is not None: return float(meta["ts"])
+    try: return datetime.fromisoformat(meta["timestamp"]).timestamp()
+    except Exception: return float("nan")
+
+_ts_backfilled = False  # Ogni ricordo ha "ts" numerico (dopo Memory.backfill_ts o un giro di compattazione)
+
+class MemoryCompactor:
+    """Ripulisce user_memories in background: turni oltre la retention e quasi-doppioni (coseno a blocchi) accorpati nel più recente."""
+    def __init__(self, delay=MEMORY_COMPACT_DELAY_S, interval=MEMORY_COMPACT_INTERVAL_S, block=MEMORY_COMPACT_BLOCK, window=MEMORY_COMPACT_WINDOW):
+        self.delay, self.interval, self.block, self.window = delay, interval, block, window
+        self.lock = threading.RLock()       # Un giro alla volta; lo prendono anche reset e forget_where (rientrante: il benchmark li chiama tenendolo)
+        self.last = None                    # Resoconto dell'ultimo giro
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self._run, daemon=True, name="jarvis-memory-compactor")
+        if collection is not None and interval: self.thread.start()
+        atexit.register(self.stopped.set)
+
+    def _run(self):
+        wait = self.delay
+        while not self.stopped.wait(wait):
+            try: self.compact()
+            except Exception as e: print(f"{Fore.RED}❌ Compattazione memoria fallita: {e}{Style.RESET_ALL}")
+            wait = self.interval
+
+    def _blocks(self):
+        """Pagine di (ids, vettori normalizzati, ts, metadati, vivi) in ordine di inserimento: in RAM solo la finestra."""
+        offset = 0
+        while True:
+            res = collection.get(offset=offset, limit=self.block, include=["embeddings", "metadatas"])
+            if not res['ids']: return
+            vectors = np.asarray(res['embeddings'], dtype=np.float32)
+            vectors /= np.maximum(np.linalg.norm(vectors, axis=1, keepdims=True), 1e-12)
+            metas = [m or {} for m in res['metadatas']]
+            yield res['ids'], vectors, np.array([_entry_ts(m) for m in metas]), metas, np.ones(len(res['ids']), dtype=bool)
+            offset += len(res['ids'])
+
+    @staticmethod
+    def _query_p50(probes):
+        times = []
+        for vector in probes:
+            start = time.perf_counter()
+            collection.query(query_embeddings=[vector.tolist()], n_results=3)
+            times.append((time.perf_counter() - start) * 1000)
+        return float(np.median(times)) if times else 0.0
+
+    def compact(self):
+        """Un giro completo. Ritorna (e ricorda) il resoconto: dimensione e latenza delle query prima e dopo."""
+        global _ts_backfilled
+        if collection is None: return "Errore DB."
+        with self.lock:
+            memory_writer.flush()  # Anche quel che è in coda partecipa al giro
+            start, before = time.perf_counter(), collection.count()
+            cutoffs = {s: time.time() - days * 86400 for s, days in MEMORY_RETENTION_DAYS.items() if days is not None}
+            drop, merged, aged, probes = [], {}, 0, []  # merged: id sopravvissuto -> (metadati, doppioni assorbiti)
+            legacy = []  # (id, metadati) dei ricordi con il solo "timestamp" ISO: a fine giro ricevono "ts"
+            window = deque(maxlen=self.window)  # Blocchi precedenti: ogni ricordo si confronta con i ~window*block vicini nel tempo
+            for block in self._blocks():
+                ids, vectors, ts, metas, alive = block
+                if len(probes) < MEMORY_COMPACT_PROBES: probes.extend(vectors[:MEMORY_COMPACT_PROBES - len(probes)])
+                for i, meta in enumerate(metas):
+                    if meta.get("ts") is None and not np.isnan(ts[i]):
+                        meta["ts"] = float(ts[i]); legacy.append((ids[i], meta))
+                    cutoff = cutoffs.get(meta.get("speaker"))
+                    if cutoff is not None and ts[i] < cutoff:  # nan (data ignota) non scade mai
+                        alive[i] = False; drop.append(ids[i]); aged += 1
+                for other in (*window, block):
+                    sims = vectors @ other[1].T  # Coseno: i vettori sono normalizzati
+                    if other is block: sims = np.triu(sims, k=1)
+                    for i, j in np.argwhere(sims >= MEMORY_DUP_SIMILARITY):
+                        if not (alive[i] and other[4][j]): continue
+                        # Resta il più recente (testo più aggiornato), l'altro sparisce
+                        newer = np.nan_to_num(ts[i], nan=-np.inf) >= np.nan_to_num(other[2][j], nan=-np.inf)
+                        (w_blk, w), (l_blk, l) = ((block, i), (other, j)) if newer else ((other, j), (block, i))
+                        l_blk[4][l] = False; drop.append(l_blk[0][l])
+                        absorbed = merged.pop(l_blk[0][l], (None, 0))[1] + l_blk[3][l].get("dups", 0) + 1
+                        meta, count = merged.get(w_blk[0][w], (w_blk[3][w], 0))
+                        merged[w_blk[0][w]] = (meta, count + absorbed)
+                window.append(block)
+            latency_before = self._query_p50(probes)
+            for i in range(0, len(drop), MEMORY_DELETE_PAGE):
+                page = drop[i:i + MEMORY_DELETE_PAGE]
+                collection.delete(ids=page); hot_index.remove(page)
+            # I sopravvissuti fusi portano già "ts" nei metadati; gli altri del vecchio formato si aggiornano a parte
+            dropped = set(drop)
+            updates = [(id_, {**meta, "dups": meta.get("dups", 0) + count}) for id_, (meta, count) in merged.items()]
+            updates += [(id_, meta) for id_, meta in legacy if id_ not in dropped and id_ not in merged]
+            for i in range(0, len(updates), MEMORY_DELETE_PAGE):
+                page = updates[i:i + MEMORY_DELETE_PAGE]
+                collection.update(ids=[id_ for id_, _ in page], metadatas=[meta for _, meta in page])
+            _ts_backfilled = True
+            after = collection.count()
+            self.last = (f"{before} -> {after} ricordi ({aged} scaduti, {len(drop) - aged} doppioni in {len(merged)} ricordi, {len(legacy)} date convertite)"
+                         f", query p50 {latency_before:.1f} -> {self._query_p50(probes):.1f} ms, {time.perf_counter() - start:.1f} s")
+            print(f"{Fore.GREEN}🧹 [DB] Compattazione: {self.last}{Style.RESET_ALL}")
+            return self.last
+
+    def stats(self):
+        return f"compattazione: {self.last or 'mai'}"
+
+memory_compactor = MemoryCompactor()
+
+# ==========================================
+# 🧾 CONTESTO A BUDGET DI TOKEN
+# ==========================================
+
+def estimate_tokens(text):
+    """Stima veloce senza tokenizer: ~4 caratteri per token."""
+    return len(text) // 4 + 1
+
+def _gist(text, words):
+    """Prima frase del testo, tagliata a `words` parole (riassunto estrattivo)."""
+    first = re.split(r"(?<=[.!?])\s", text.strip(), maxsplit=1)[0].split()
+    return " ".join(first[:words]) + ("…" if len(first) > words else "")
+
+class ContextManager:
+    """Storia della conversazione entro un budget di token: i turni più vecchi confluiscono in un riassunto a scorrimento."""
+    def __init__(self, count, budget=CONTEXT_TOKEN_BUDGET, summary_budget=SUMMARY_TOKEN_BUDGET):
+        self.count = count              # Token di un messaggio (il formato dipende dal backend)
+        self.budget, self.summary_budget = budget, summary_budget
+        self.turns = deque()            # (messaggi, token, riga di riassunto)
+        self.summary = deque()          # (riga, token)
+        self.tokens = self.summary_tokens = self.folded = 0
+
+    def add_turn(self, messages, user_text, answer):
+        tokens = sum(self.count(m) for m in messages)
+        self.turns.append((list(messages), tokens, f"- U: {_gist(user_text, 20)} → AI: {_gist(answer, 30)}"))
+        self.tokens += tokens
+
+    def compact(self):
+        """Oltre il budget piega i turni vecchi fino a CONTEXT_TARGET_RATIO. True se la storia è cambiata."""
+        if self.tokens + self.summary_tokens <= self.budget: return False
+        while len(self.turns) > 1 and self.tokens + self.summary_tokens > self.budget * CONTEXT_TARGET_RATIO:
+            _, tokens, line = self.turns.popleft()
+            self.tokens -= tokens; self.folded += 1
+            self.summary.append((line, estimate_tokens(line))); self.summary_tokens += self.summary[-1][1]
+            while self.summary_tokens > self.summary_budget:
+                self.summary_tokens -= self.summary.popleft()[1]
+        return True
+
+    def messages(self):
+        return [m for msgs, _, _ in self.turns for m in msgs]
+
+    def summary_text(self):
+        return "\n".join(line for line, _ in self.summary)
+
+    def stats(self):
+        return f"{len(self.turns)} turni, ~{self.tokens + self.summary_tokens} token, {self.folded} piegati nel riassunto"
+
+def _content_tokens(content):
+    """Token stimati di un Content Gemini (testo, function_call e function_response)."""
+    return sum(estimate_tokens(part.text) if part.text else estimate_tokens(str(part)) for part in content.parts)
 
 # ==========================================
 # 🤖 CERVELLO (MANUALE / VELOCE)
@@ -277,66 +866,110 @@ class JarvisBrain:
             "QUANDO ESEGUI search_web, la query deve essere più corta e diretta possibile, fedele all'intento dell'utente."
         )
         
+        self.context = ContextManager(count=_content_tokens)
         try:
-            model = genai.GenerativeModel("gemini-2.0-flash-lite-preview-02-05", tools=MY_TOOLS, system_instruction=self.sys_instruction)
+            self.model = genai.GenerativeModel("gemini-2.0-flash-lite-preview-02-05", tools=registry.gemini_tools(), system_instruction=self.sys_instruction)
             # Modalità Manuele (FAST MODE)
-            self.chat = model.start_chat(enable_automatic_function_calling=False) 
+            self.chat = self.model.start_chat(enable_automatic_function_calling=False) 
             self.chat.send_message("Ping", stream=False)
+            self._hist_len = len(self.chat.history)  # Contenuti già contabilizzati nel ContextManager
             print(f"{Fore.GREEN}OK (FAST MODE) 🚀{Style.RESET_ALL}")
         except Exception as e: 
             print(f"{Fore.RED}Errore Init: {e}{Style.RESET_ALL}"); self.chat = None
 
+    def _restart_chat(self):
+        """Riapre la sessione con riassunto + turni recenti: la history non cresce per tutta la vita del processo."""
+        history = []
+        if self.context.summary:
+            history += [genai.protos.Content(role="user", parts=[genai.protos.Part(text=f"RIASSUNTO CONVERSAZIONE PRECEDENTE:\n{self.context.summary_text()}")]),
+                        genai.protos.Content(role="model", parts=[genai.protos.Part(text="Ok.")])]
+        self.chat = self.model.start_chat(history=history + self.context.messages(), enable_automatic_function_calling=False)
+        print(f"{Fore.BLACK}{Style.BRIGHT}   [🗜️ Contesto compattato: {self.context.stats()}]{Style.RESET_ALL}")
+
+    def _rollback(self, snapshot):
+        """Riporta la chat alla history di inizio turno. Il setter azzera anche l'invio/risposta in sospeso
+        (_last_sent/_last_received): una risposta rotta rimasta lì farebbe fallire ogni turno successivo."""
+        self.chat.history = snapshot
+        self._hist_len = len(self.chat.history)
+
+    def http_stats(self):
+        return f"tool: {http_pool_stats()} | cache tool {tool_cache.stats()}"
+
+    def tool_stats(self):
+        return registry.stats()
+
+    def memory_stats(self):
+        return f"{embed_cache.stats()} | {memory_writer.stats()} | {hot_index.stats()} | {memory_compactor.stats()}"
+
     def think(self, user_text):
+        """Versione sincrona (compatibilità): stessa logica di athink."""
+        yield from iterate_async(self.athink(user_text))
+
+    async def athink(self, user_text):
         if not self.chat: yield "Errore critico."; return
 
-        # Recupero Memoria
-        memories = Memory.search(user_text)
+        # Recupero Memoria (embedding + query Chroma fuori dal loop)
+        memories = await asyncio.to_thread(Memory.search, user_text)
         prompt = user_text
         if memories:
             prompt = f"INFO MEMORIA:\n" + "\n".join([f"- {m}" for m in memories]) + f"\n\nUTENTE: {user_text}"
             print(f"{Fore.BLUE}🔍 Ricordi: {len(memories)}{Style.RESET_ALL}")
         
+        snapshot = list(self.chat.history)  # History a inizio turno: un barge-in la ripristina così com'era
         try:
-            response = self.chat.send_message(prompt, stream=False)
+            message = prompt
+            t0 = time.perf_counter(); first_text = True
+            answer = ""
             
-            # --- LOOP MANUALE DEI TOOLS (FIX BUG 400 resiliente) ---
-            while hasattr(response, 'candidates') and response.candidates:
+            # --- LOOP MANUALE DEI TOOLS (FIX BUG 400 resiliente), ora in streaming asincrono ---
+            while True:
+                response = await self.chat.send_message_async(message, stream=GEMINI_STREAMING)
                 
-                calls = [p.function_call for p in response.candidates[0].content.parts if getattr(p, "function_call", None)]
+                calls = []
+                async for chunk in response:
+                    if not chunk.candidates: continue
+                    for part in chunk.candidates[0].content.parts:
+                        if getattr(part, "function_call", None):
+                            calls.append(part.function_call)
+                        elif getattr(part, "text", ""):
+                            if first_text:
+                                print(f"{Fore.BLACK}{Style.BRIGHT}⏱️ Primo testo: {(time.perf_counter() - t0) * 1000:.0f} ms{Style.RESET_ALL}")
+                                first_text = False
+                            text = part.text.replace("*", "")
+                            answer += text
+                            yield text
                 
                 if not calls:
                     break 
 
-                fc = calls[0]
-                fname = fc.name
-                args = dict(fc.args) if getattr(fc, "args", None) else {}
-                
-                print(f"{Fore.YELLOW}🛠️ Tool: {fname}{Style.RESET_ALL}")
-                
-                res = "Err"
+                # 🟢 Tutte le function_call del candidato partono insieme sul pool (es. meteo Roma + Milano)
+                print(f"{Fore.YELLOW}🛠️ Tool: {', '.join(fc.name for fc in calls)}{Style.RESET_ALL}")
+                results = await asyncio.gather(*[
+                    registry.arun(fc.name, dict(fc.args) if getattr(fc, "args", None) else {}) for fc in calls
+                ])
                 
-                if fname == "save_mem": res = save_mem(**args)
-                elif fname == "search_web": res = search_web(**args)
-                elif fname == "get_weather_at": res = get_weather_at(**args)
-                elif fname == "list_f": res = list_f()
-                elif fname == "read_f": res = read_f(**args)
-                elif fname == "write_f": res = write_f(**args)
-                elif fname == "create_dir": res = create_dir(**args)
-                elif fname == "get_t": res = get_t()
-                elif fname == "calc": res = calc(**args)
+                # 🟢 FIX COMPATIBILITÀ: Torniamo alla sintassi PROTOS Stabile; tutte le risposte in un unico messaggio
+                message = genai.protos.Content(parts=[genai.protos.Part(
+                    function_response=genai.protos.FunctionResponse(
+                        name=fc.name, 
+                        response={"result": res}
+                    )
+                ) for fc, res in zip(calls, results)])
                 
-                # 🟢 FIX COMPATIBILITÀ: Torniamo alla sintassi PROTOS Stabile 
-                response = self.chat.send_message(
-                    genai.protos.Content(parts=[genai.protos.Part(
-                        function_response=genai.protos.FunctionResponse(
-                            name=fname, 
-                            response={"result": res}
-                        )
-                    )])
-                )
-
-            if response.text: yield response.text.replace("*", "")
+            # 🟢 Turno completo: entra nel ContextManager; oltre il budget la chat riparte con storia limitata
+            self.context.add_turn(self.chat.history[self._hist_len:], user_text, answer)
+            if self.context.compact(): self._restart_chat()
+            self._hist_len = len(self.chat.history)
                 
+        except (asyncio.CancelledError, GeneratorExit):
+            # 🟢 BARGE-IN: gather ha già cancellato i tool ancora in coda. rewind() su uno stream consumato a metà
+            # fallisce e lascia la chat rotta: si torna alla history di inizio turno
+            self._rollback(snapshot)
+            print(f"{Fore.BLACK}{Style.BRIGHT}   [✂️ Turno interrotto, history ripristinata]{Style.RESET_ALL}")
+            raise
         except Exception as e:
+            # In streaming la libreria non controlla la risposta: un errore di rete a metà o un finish_reason
+            # SAFETY/RECITATION restano in _last_received e rompono anche i turni dopo. Si torna a inizio turno.
+            self._rollback(snapshot)
             print(f"{Fore.RED}Err Brain: {e}{Style.RESET_ALL}")
-            yield "Ho avuto un problema tecnico. Riprova tra poco."
\ No newline at end of file
+            yield "Ho avuto un problema tecnico. Riprova tra poco."
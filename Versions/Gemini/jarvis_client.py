@@ -1,24 +1,61 @@
 import asyncio
-import websockets
-import urllib.parse
 import speech_recognition as sr
 from faster_whisper import WhisperModel
 import pyaudio
 import os
 import sys
-import tempfile
+import time
+import threading
+import wave
+from collections import deque
 import torch
 import numpy as np
-import re
+from contextlib import aclosing
 from colorama import init, Fore, Style
 from jarvis_brain import JarvisBrain, Memory 
+from jarvis_web import benchmark_http
+from jarvis_tts import SAMPLE_RATE, TTSCache, TTSClient, SentenceSegmenter, text_chunks, benchmark_segmenter
 
 # CONFIGURAZIONE
-SERVER_URL = "ws://127.0.0.1:8000/stream"
-VOICE_NAME = "it-Spk1_man" 
-SAMPLE_RATE = 24000 
 VAD_CONFIDENCE = 0.9 
-VOLUME_GATE = 1500 
+VOLUME_GATE = 1500 # Soglia di volume per il barge-in: minimo fisso, l'adattamento al rumore di fondo può solo alzarla
+ASR_MODE = "batch"          # "batch": trascrive a fine frase | "stream": trascrizione incrementale mentre parli
+STREAM_ASR_STEP_MS = 700    # Ogni quanto audio nuovo ripetere la trascrizione parziale
+STREAM_ASR_WINDOW_S = 6.0   # Oltre questa durata i segmenti stabili vengono consolidati
+STREAM_ASR_MARGIN_S = 1.5   # Audio finale sempre ritrascritto (le ultime parole cambiano ancora)
+
+# CATTURA MICROFONO + ENDPOINTING (Silero-VAD)
+MIC_RATE = 16000
+VAD_FRAME = 512             # Campioni per inferenza Silero a 16 kHz
+RING_SECONDS = 30           # Storia audio tenuta nel ring buffer condiviso
+VAD_SPEECH_THRESHOLD = 0.5  # Probabilità minima per considerare un frame "parlato"
+VAD_HANGOVER_MS = 1000      # Silenzio continuo che chiude la frase
+VAD_PREROLL_MS = 300        # Audio tenuto prima dell'inizio rilevato (per non tagliare la prima sillaba)
+MIN_SPEECH_MS = 250         # Frasi più corte vengono scartate (colpi, click)
+
+# BARGE-IN (thread dedicato)
+BARGE_IN_POLL_MS = 32       # Attesa tra due letture del ring buffer
+BARGE_IN_BATCH = 4          # Frame massimi valutati in una sola inferenza VAD
+BARGE_IN_NOISE_FACTOR = 3.0 # Soglia di volume = rumore di fondo stimato x fattore
+BARGE_IN_MIN_GATE = VOLUME_GATE  # Pavimento della soglia adattiva: il rumore di fondo si impara solo dai frame quieti
+                                 # e in una stanza silenziosa scenderebbe fin sotto l'eco della voce di Jarvis nel microfono
+
+# RIPRODUZIONE
+PLAYBACK_BUFFER_S = 8.0     # Capienza del jitter buffer (oltre, la ricezione TTS attende)
+PLAYBACK_PREBUFFER_MS = 80  # Audio minimo accodato prima di partire (assorbe il jitter di rete)
+PLAYBACK_FRAMES = 480       # Frame per callback (20 ms a 24 kHz)
+
+# TTS
+TTS_LOOKAHEAD = 2           # Frasi sintetizzate in anticipo mentre la corrente è in riproduzione
+
+# CACHE TTS
+TTS_PREWARM = [             # Frasi fisse sintetizzate in background all'avvio
+    "Ho cancellato tutte le informazioni memorizzate su di te. Ho fatto tabula rasa!",
+    "Ho avuto un problema tecnico. Riprova tra poco.",
+    "Errore critico.",
+]
+LISTEN_TIMEOUT_S = 2.0
+PHRASE_TIME_LIMIT_S = 10
 
 init(autoreset=True)
 
@@ -64,64 +101,459 @@ try:
 except Exception as e:
     print(f"Errore Modelli: {e}"); sys.exit(1)
 
-def check_interruption(stream):
-    try:
-        if stream.get_read_available() >= 512:
-            data = stream.read(512, exception_on_overflow=False)
-            audio_int16 = np.frombuffer(data, np.int16)
-            if np.abs(audio_int16).mean() < VOLUME_GATE: return False
-            if vad_model(torch.from_numpy(audio_int16.astype(np.float32)/32768.0), 16000).item() > VAD_CONFIDENCE: return True
-    except Exception as e: 
-        print(f"{Fore.RED}❌ Errore interruzione VAD: {e}{Style.RESET_ALL}")
-        pass
-    return False
-
-async def speak_stream(text_generator, out_stream, in_stream):
-    sentence_buffer = ""
-    stop_chars = [".", "!", "?", "\n"] 
-    
-    for chunk in text_generator:
-        chunk = re.sub(r'\{.*?\}', '', chunk)
-        sentence_buffer += chunk
-        
-        is_end = any(sentence_buffer.strip().endswith(s) for s in stop_chars)
-        if is_end and len(sentence_buffer) > 5:
-            clean = sentence_buffer.strip()
-            print(f"{Fore.MAGENTA}🔊 AI: {Style.RESET_ALL}{clean}")
-            
-            url = f"{SERVER_URL}?{urllib.parse.urlencode({'text': clean, 'voice': VOICE_NAME})}"
+def transcribe_pcm(pcm):
+    """Trascrive direttamente il buffer PCM in memoria e restituisce (testo, millisecondi)."""
+    t0 = time.perf_counter()
+    segs, _ = whisper.transcribe(pcm, language="it", beam_size=1)
+    text = " ".join([s.text for s in segs]).strip()
+    return text, (time.perf_counter() - t0) * 1000
+
+class StreamingTranscriber:
+    """ASR incrementale: ritrascrive una finestra mobile mentre l'utente parla ed emette ipotesi parziali."""
+    def __init__(self, on_partial=None):
+        self.on_partial = on_partial
+        self.pcm = np.zeros(0, dtype=np.float32)
+        self.committed_text = ""     # Testo stabile (segmenti usciti dalla finestra)
+        self.committed_at = 0        # Campione da cui parte la finestra attiva
+        self.partial = ""
+        self.last_step = 0
+        self.passes = 0
+        self.new_audio = threading.Event()
+        self.done = False
+        self.worker = threading.Thread(target=self._run, daemon=True)
+        self.worker.start()
+
+    def feed(self, pcm):
+        """Aggiunge audio float32 a 16 kHz (chiamato dal thread di cattura)."""
+        self.pcm = np.concatenate((self.pcm, pcm))
+        if len(self.pcm) - self.last_step >= STREAM_ASR_STEP_MS * 16:
+            self.new_audio.set()
+
+    def _transcribe_window(self):
+        window = self.pcm[self.committed_at:]
+        segs = list(whisper.transcribe(window, language="it", beam_size=1, condition_on_previous_text=False)[0])
+        self.passes += 1
+        # Consolida i segmenti ormai lontani dal bordo: non verranno più ritrascritti
+        if len(window) > STREAM_ASR_WINDOW_S * 16000:
+            stable_until = len(window) / 16000 - STREAM_ASR_MARGIN_S
+            stable = [s for s in segs if s.end <= stable_until]
+            if stable:
+                self.committed_text = " ".join([self.committed_text] + [s.text.strip() for s in stable]).strip()
+                self.committed_at += int(stable[-1].end * 16000)
+                segs = segs[len(stable):]
+        return " ".join([self.committed_text] + [s.text.strip() for s in segs]).strip()
+
+    def _run(self):
+        while True:
+            self.new_audio.wait()
+            self.new_audio.clear()
+            if self.done: return
+            self.last_step = len(self.pcm)
             try:
-                async with websockets.connect(url) as ws:
-                    async for msg in ws:
-                        if check_interruption(in_stream):
-                            print(f"{Fore.RED}🛑 STOP{Style.RESET_ALL}")
-                            out_stream.stop_stream(); out_stream.start_stream() 
-                            return True 
-                        if isinstance(msg, bytes): out_stream.write(msg)
+                self.partial = self._transcribe_window()
+                if self.on_partial and self.partial: self.on_partial(self.partial)
             except Exception as e:
-                print(f"{Fore.RED}❌ Errore TTS WebSocket: {e}{Style.RESET_ALL}")
-                pass
-            sentence_buffer = "" 
-            
-    if sentence_buffer.strip():
-        clean_final = sentence_buffer.strip()
-        print(f"{Fore.MAGENTA}🔊 AI: {Style.RESET_ALL}{clean_final}")
-        url = f"{SERVER_URL}?{urllib.parse.urlencode({'text': clean_final, 'voice': VOICE_NAME})}"
+                print(f"{Fore.RED}❌ Errore ASR streaming: {e}{Style.RESET_ALL}")
+
+    def finish(self):
+        """Chiude l'enunciato: ritrascrive solo la coda non consolidata e restituisce il testo finale."""
+        self.done = True
+        self.new_audio.set()
+        self.worker.join()
+        if len(self.pcm) <= self.committed_at: return self.committed_text
+        return self._transcribe_window()
+
+def show_partial(text):
+    print(f"{Fore.BLACK}{Style.BRIGHT}… {text[-70:]}{Style.RESET_ALL}", end="\r")
+
+def load_wav_float32(path):
+    """Legge un WAV PCM 16 bit e lo restituisce mono float32 a 16 kHz."""
+    with wave.open(path, "rb") as w:
+        rate, channels = w.getframerate(), w.getnchannels()
+        pcm = np.frombuffer(w.readframes(w.getnframes()), np.int16).astype(np.float32) / 32768.0
+    if channels > 1: pcm = pcm.reshape(-1, channels).mean(axis=1)
+    if rate != 16000:
+        pcm = np.interp(np.arange(0, len(pcm), rate / 16000), np.arange(len(pcm)), pcm).astype(np.float32)
+    return pcm
+
+def benchmark_asr(paths, chunk_ms=100):
+    """Confronta batch e streaming su WAV registrati: latenza dalla fine dell'audio al testo finale."""
+    print(f"{Fore.CYAN}📊 Benchmark ASR (batch vs stream){Style.RESET_ALL}")
+    for path in paths:
+        pcm = load_wav_float32(path)
+        text_b, batch_ms = transcribe_pcm(pcm)
+
+        # Streaming: l'audio arriva in tempo reale, come dal microfono
+        tr = StreamingTranscriber()
+        step = chunk_ms * 16
+        for i in range(0, len(pcm), step):
+            tr.feed(pcm[i:i + step])
+            time.sleep(chunk_ms / 1000)
+        t0 = time.perf_counter()
+        text_s = tr.finish()
+        stream_ms = (time.perf_counter() - t0) * 1000
+
+        print(f"  {os.path.basename(path)} ({len(pcm) / 16000:.1f}s): batch {batch_ms:.0f} ms | stream {stream_ms:.0f} ms dopo la fine ({tr.passes} passate)")
+        if text_b != text_s:
+            print(f"    batch : {text_b}\n    stream: {text_s}")
+
+# ==========================================
+# 🎙️ CATTURA AUDIO (unico stream + ring buffer)
+# ==========================================
+
+class RingBuffer:
+    """Buffer circolare int16 a scrittore singolo: ogni lettore tiene il proprio cursore, nessun lock sui dati."""
+    def __init__(self, capacity):
+        self.buf = np.zeros(capacity, dtype=np.int16)
+        self.capacity = capacity
+        self.written = 0  # Contatore monotono dei campioni scritti (pubblicato dopo la copia)
+
+    def write(self, samples):
+        n = len(samples)
+        if n > self.capacity: samples, n = samples[-self.capacity:], self.capacity
+        start = self.written % self.capacity
+        first = min(n, self.capacity - start)
+        self.buf[start:start + first] = samples[:first]
+        if first < n: self.buf[:n - first] = samples[first:]
+        self.written += n
+
+    def read(self, pos, n):
+        """Restituisce (campioni, nuovo_cursore). Se il lettore è rimasto indietro salta al dato più vecchio valido."""
+        pos = max(pos, self.written - self.capacity)
+        n = min(n, self.written - pos)
+        start = pos % self.capacity
+        first = min(n, self.capacity - start)
+        out = np.concatenate((self.buf[start:start + first], self.buf[:n - first])) if first < n else self.buf[start:start + n].copy()
+        return out, pos + n
+
+class AudioCapture:
+    """Apre il microfono una sola volta (PyAudio in modalità callback) e alimenta il RingBuffer condiviso."""
+    def __init__(self, p, device_index):
+        self.ring = RingBuffer(MIC_RATE * RING_SECONDS)
+        self.t_written = time.monotonic()  # Istante di arrivo dell'ultimo blocco (per misurare le latenze)
+        self.stream = p.open(format=pyaudio.paInt16, channels=1, rate=MIC_RATE, input=True, input_device_index=device_index,
+                             frames_per_buffer=VAD_FRAME, stream_callback=self._callback)
+
+    def _callback(self, in_data, frame_count, time_info, status):
+        self.ring.write(np.frombuffer(in_data, np.int16))
+        self.t_written = time.monotonic()
+        return (None, pyaudio.paContinue)
+
+    def read_frame(self, pos, n=VAD_FRAME):
+        """Attende (polling breve) che ci siano n campioni dopo pos e li restituisce."""
+        deadline = time.monotonic() + 2.0
+        while self.ring.written - pos < n:
+            if time.monotonic() > deadline: raise RuntimeError("Nessun audio dal microfono.")
+            time.sleep(0.01)
+        return self.ring.read(pos, n)
+
+    def close(self):
+        try: self.stream.stop_stream(); self.stream.close()
+        except: pass
+
+vad_lock = threading.Lock()  # Il modello Silero ha stato interno: un'inferenza alla volta
+
+def vad_prob(frame_f32):
+    with vad_lock: return vad_model(torch.from_numpy(frame_f32), MIC_RATE).item()
+
+def listen_utterance(capture, timeout=None, phrase_time_limit=None, on_audio=None):
+    """Raccoglie una frase dal ring buffer: inizio e fine sono decisi da Silero-VAD con hangover configurabile."""
+    frame_ms = VAD_FRAME * 1000 / MIC_RATE
+    pos = capture.ring.written
+    with vad_lock: vad_model.reset_states()
+    preroll = deque(maxlen=max(1, int(VAD_PREROLL_MS / frame_ms)))
+    speech, speech_ms, silence_ms = None, 0.0, 0.0
+    t_start = time.monotonic()
+
+    while True:
+        frame, pos = capture.read_frame(pos)
+        f32 = frame.astype(np.float32) / 32768.0
+        prob = vad_prob(f32)
+
+        if speech is None:
+            preroll.append(f32)
+            if prob >= VAD_SPEECH_THRESHOLD:
+                speech = list(preroll)
+                if on_audio: on_audio(np.concatenate(speech))
+            elif timeout and time.monotonic() - t_start > timeout:
+                return None
+            continue
+
+        speech.append(f32)
+        if on_audio: on_audio(f32)
+        # Isteresi: per restare "in parlato" basta una soglia leggermente più bassa
+        if prob >= VAD_SPEECH_THRESHOLD - 0.15: speech_ms += frame_ms; silence_ms = 0.0
+        else: silence_ms += frame_ms
+        if silence_ms >= VAD_HANGOVER_MS: break
+        if phrase_time_limit and len(speech) * frame_ms >= phrase_time_limit * 1000: break
+
+    if speech_ms < MIN_SPEECH_MS: return None
+    return np.concatenate(speech)
+
+def vad_probs(frames):
+    """Probabilità di parlato per un blocco di frame (k, 512) con una sola chiamata al modello quando possibile."""
+    with vad_lock:
+        if hasattr(vad_model, "audio_forward"):
+            return vad_model.audio_forward(torch.from_numpy(frames.reshape(-1)), MIC_RATE).reshape(-1).tolist()[:len(frames)]
+        return [vad_model(torch.from_numpy(f), MIC_RATE).item() for f in frames]
+
+class BargeInDetector:
+    """Thread dedicato che segue il microfono in tempo reale e segnala il barge-in tramite un asyncio.Event."""
+    def __init__(self, capture):
+        self.capture = capture
+        self.noise_floor = VOLUME_GATE / BARGE_IN_NOISE_FACTOR  # Stima iniziale, poi si adatta all'ambiente
+        self.armed = threading.Event()
+        self.lock = threading.Lock()    # pos, event e generazione cambiano insieme: arm() dal loop, _run dal thread
+        self.loop, self.event, self.pos = None, None, 0
+        self.generation = 0             # Cresce a ogni arm(): un giro del thread iniziato prima non conta più
+        self.last_latency_ms = None
+        threading.Thread(target=self._run, daemon=True).start()
+
+    def arm(self, loop):
+        """Inizia a sorvegliare il microfono dalla posizione attuale e restituisce l'Event da attendere."""
+        with self.lock:
+            self.generation += 1
+            self.loop, self.event = loop, asyncio.Event()
+            self.pos = self.capture.ring.written
+            self.last_latency_ms = None
+        self.armed.set()
+        return self.event
+
+    def disarm(self):
+        self.armed.clear()
+
+    def _run(self):
+        while True:
+            self.armed.wait()
+            with self.lock: generation, pos, loop, event = self.generation, self.pos, self.loop, self.event
+            ring = self.capture.ring
+            n_frames = min((ring.written - pos) // VAD_FRAME, BARGE_IN_BATCH)
+            if n_frames < 1:
+                time.sleep(BARGE_IN_POLL_MS / 1000); continue
+            data, end = ring.read(pos, n_frames * VAD_FRAME)
+            frames = data[:n_frames * VAD_FRAME].reshape(-1, VAD_FRAME)
+            try:
+                latency_ms = self._detect(frames, end)
+                with self.lock:
+                    # Riarmato durante l'inferenza: posizione ed Event sono già quelli del turno nuovo
+                    if generation != self.generation: continue
+                    self.pos = end
+                    if latency_ms is not None and self.armed.is_set():
+                        self.armed.clear()
+                        self.last_latency_ms = latency_ms
+                        loop.call_soon_threadsafe(event.set)
+            except Exception as e:
+                print(f"{Fore.RED}❌ Errore interruzione VAD: {e}{Style.RESET_ALL}")
+
+    def _detect(self, frames, end):
+        """Latenza (ms) del primo frame con voce, None se nei frame non c'è voce. end: posizione dopo l'ultimo frame."""
+        levels = np.abs(frames.astype(np.int32)).mean(axis=1)
+        gate = max(BARGE_IN_MIN_GATE, self.noise_floor * BARGE_IN_NOISE_FACTOR)
+        quiet = levels < gate
+        # Il rumore di fondo segue solo i frame sotto soglia (media esponenziale)
+        for lvl in levels[quiet]: self.noise_floor += 0.05 * (lvl - self.noise_floor)
+        if quiet.all(): return None
+
+        loud = np.flatnonzero(~quiet)
+        probs = vad_probs(frames[loud].astype(np.float32) / 32768.0)
+        for k, prob in zip(loud, probs):
+            if prob > VAD_CONFIDENCE:
+                # Latenza = ora - istante di cattura della fine del frame rilevato
+                frame_end = end - (len(frames) - k - 1) * VAD_FRAME
+                captured_at = self.capture.t_written - (self.capture.ring.written - frame_end) / MIC_RATE
+                return (time.monotonic() - captured_at) * 1000
+        return None
+
+async def until_interrupted(coro, interrupted):
+    """Esegue coro finché termina o arriva il barge-in: in quel caso lo cancella e restituisce True."""
+    task = asyncio.ensure_future(coro)
+    waiter = asyncio.ensure_future(interrupted.wait())
+    done, _ = await asyncio.wait({task, waiter}, return_when=asyncio.FIRST_COMPLETED)
+    if task in done:
+        waiter.cancel(); task.result()
+        return False
+    task.cancel()
+    return True
+
+async def _next_chunk(stream):
+    """Prossimo pezzo di testo dal brain, None a fine stream."""
+    try: return await stream.__anext__()
+    except StopAsyncIteration: return None
+
+# ==========================================
+# 🔈 RIPRODUZIONE (callback + jitter buffer)
+# ==========================================
+
+class PlaybackEngine:
+    """Riproduzione in modalità callback: la scheda audio pesca dal jitter buffer mentre il loop riceve i frame TTS."""
+    def __init__(self, p):
+        self.ring = RingBuffer(int(SAMPLE_RATE * PLAYBACK_BUFFER_S))
+        self.read_pos = 0          # Cursore del callback (unico lettore)
+        self.flush_to = 0          # Barge-in: il callback salta fino a qui
+        self.pending = b""         # Byte dispari rimasto a metà campione
+        self.playing = False
+        self.draining = False
+        self.underruns = 0
+        self.prebuffer = int(SAMPLE_RATE * PLAYBACK_PREBUFFER_MS / 1000)
+        self.stream = p.open(format=pyaudio.paInt16, channels=1, rate=SAMPLE_RATE, output=True,
+                             frames_per_buffer=PLAYBACK_FRAMES, stream_callback=self._callback)
+
+    def queued(self):
+        return self.ring.written - max(self.read_pos, self.flush_to)
+
+    def _callback(self, in_data, frame_count, time_info, status):
+        if self.flush_to > self.read_pos: self.read_pos = self.flush_to
+        available = self.ring.written - self.read_pos
+        if not self.playing:
+            # Prebuffer: si parte solo con un minimo di margine (o se il testo è finito)
+            if available >= self.prebuffer or (self.draining and available > 0): self.playing = True
+            else: return (bytes(frame_count * 2), pyaudio.paContinue)
+        n = min(available, frame_count)
+        data, self.read_pos = self.ring.read(self.read_pos, n)
+        if n < frame_count:
+            if not self.draining: self.underruns += 1  # Il TTS non ha tenuto il passo
+            self.playing = False
+            data = np.concatenate((data, np.zeros(frame_count - n, dtype=np.int16)))
+        return (data.tobytes(), pyaudio.paContinue)
+
+    async def write(self, pcm):
+        """Accoda PCM int16; se il buffer è pieno attende (contropressione) senza bloccare il loop."""
+        pcm = self.pending + pcm
+        cut = len(pcm) - len(pcm) % 2
+        self.pending = pcm[cut:]
+        samples = np.frombuffer(pcm[:cut], np.int16)
+        while samples.size:
+            free = self.ring.capacity - self.queued()
+            if free <= 0:
+                await asyncio.sleep(0.01); continue
+            self.ring.write(samples[:free])
+            samples = samples[free:]
+
+    async def drain(self):
+        """Attende che tutto l'audio accodato sia stato riprodotto."""
+        self.draining = True
+        try:
+            while self.queued() > 0: await asyncio.sleep(0.01)
+        finally:
+            self.draining = False
+
+    def flush(self):
+        """Barge-in: scarta all'istante l'audio accodato."""
+        self.pending = b""
+        self.flush_to = self.ring.written
+
+    def close(self):
+        try: self.stream.stop_stream(); self.stream.close()
+        except: pass
+
+# ==========================================
+# 🗣️ PIPELINE TTS (sintesi in anticipo)
+# ==========================================
+
+class TTSPipeline:
+    """Sintetizza fino a TTS_LOOKAHEAD frasi in anticipo mentre la frase corrente suona, mantenendo l'ordine."""
+    def __init__(self, tts, player):
+        self.tts, self.player = tts, player
+        self.order = asyncio.Queue()                       # (testo, coda PCM) nell'ordine di arrivo
+        self.slots = asyncio.Semaphore(1 + TTS_LOOKAHEAD)  # Frase in riproduzione + quelle in anticipo
+        self.tasks = set()
+        self.gaps_ms = []                                  # Silenzio tra la fine di una frase e l'inizio della successiva
+        self.audio_end_at = None
+        self.player_task = asyncio.ensure_future(self._play_in_order())
+
+    async def say(self, text):
+        """Accoda una frase: la sintesi parte subito se c'è uno slot libero, altrimenti attende."""
+        await self.slots.acquire()
+        pcm_queue = asyncio.Queue()
+        task = asyncio.ensure_future(self._synthesize(text, pcm_queue))
+        self.tasks.add(task); task.add_done_callback(self.tasks.discard)
+        self.order.put_nowait((text, pcm_queue))
+
+    async def _synthesize(self, text, pcm_queue):
         try:
-            async with websockets.connect(url) as ws:
-                async for msg in ws:
-                    if check_interruption(in_stream): return True
-                    if isinstance(msg, bytes): out_stream.write(msg)
+            async with aclosing(self.tts.synthesize(text)) as audio:
+                async for pcm in audio: pcm_queue.put_nowait(pcm)
         except Exception as e:
-            print(f"{Fore.RED}❌ Errore TTS WebSocket Finale: {e}{Style.RESET_ALL}")
-            pass
-    return False
+            print(f"{Fore.RED}❌ Errore TTS WebSocket: {e}{Style.RESET_ALL}")
+        finally:
+            pcm_queue.put_nowait(None)
+
+    async def _play_in_order(self):
+        while True:
+            text, pcm_queue = await self.order.get()
+            if text is None: return
+            first = True
+            while (pcm := await pcm_queue.get()) is not None:
+                if first and self.audio_end_at is not None:
+                    self.gaps_ms.append(max(0.0, time.monotonic() - self.audio_end_at) * 1000)
+                first = False
+                await self.player.write(pcm)
+                # Istante in cui finirà di suonare l'audio già accodato
+                self.audio_end_at = time.monotonic() + self.player.queued() / SAMPLE_RATE
+            self.slots.release()
+
+    async def finish(self):
+        """Attende che tutte le frasi accodate siano state sintetizzate e passate al player."""
+        self.order.put_nowait((None, None))
+        await self.player_task
+
+    def cancel(self):
+        """Barge-in: annulla la sintesi in corso e tutte le frasi in coda."""
+        for task in list(self.tasks): task.cancel()
+        self.player_task.cancel()
+
+    def gap_report(self):
+        if not self.gaps_ms: return None
+        return f"gap tra frasi: medio {sum(self.gaps_ms) / len(self.gaps_ms):.0f} ms, max {max(self.gaps_ms):.0f} ms ({len(self.gaps_ms)} confini)"
+
+async def speak_stream(text_stream, player, barge, tts):
+    segmenter = SentenceSegmenter(skip="{}")
+    interrupted = barge.arm(asyncio.get_running_loop())
+    underruns = player.underruns
+    # 🟢 PIPELINE: la frase N+1 si sintetizza mentre la N suona
+    pipeline = TTSPipeline(tts, player)
+
+    def stop():
+        latency = barge.last_latency_ms
+        print(f"{Fore.RED}🛑 STOP (barge-in rilevato{f' in {latency:.0f} ms' if latency is not None else ''}){Style.RESET_ALL}")
+        pipeline.cancel()
+        player.flush()
+        return True
+
+    nxt = None
+    try:
+        while True:
+            # 🟢 Anche l'attesa del prossimo token è interrompibile: il barge-in cancella la generazione a monte
+            nxt = asyncio.ensure_future(_next_chunk(text_stream))
+            if await until_interrupted(nxt, interrupted): return stop()
+            chunk = nxt.result()
+            if chunk is None: break
+            for clean in segmenter.feed(chunk):
+                print(f"{Fore.MAGENTA}🔊 AI: {Style.RESET_ALL}{clean}")
+                if await until_interrupted(pipeline.say(clean), interrupted): return stop()
+                
+        clean_final = segmenter.flush()
+        if clean_final:
+            print(f"{Fore.MAGENTA}🔊 AI: {Style.RESET_ALL}{clean_final}")
+            if await until_interrupted(pipeline.say(clean_final), interrupted): return stop()
+        if await until_interrupted(pipeline.finish(), interrupted): return stop()
+        # La riproduzione prosegue in background: si attende la coda restando interrompibili
+        if await until_interrupted(player.drain(), interrupted): return stop()
+        return False
+    finally:
+        pipeline.cancel()
+        barge.disarm()
+        # Chiude il generatore del brain (stream HTTP, tool in coda); prima si attende la cancellazione in corso
+        if nxt is not None and not nxt.done():
+            nxt.cancel()
+            await asyncio.gather(nxt, return_exceptions=True)
+        await text_stream.aclose()
+        if pipeline.gap_report():
+            print(f"{Fore.BLACK}{Style.BRIGHT}⏱️ TTS {pipeline.gap_report()}{Style.RESET_ALL}")
+        if player.underruns > underruns:
+            print(f"{Fore.YELLOW}⚠️ Underrun audio: {player.underruns - underruns} (TTS più lento della riproduzione){Style.RESET_ALL}")
 
 async def main_loop():
-    r = sr.Recognizer()
-    r.energy_threshold = 300   
-    r.pause_threshold = 1.0    
-    
     # 🟢 AGGIORNATO: Selezione interattiva del microfono
     mic_idx = select_microphone()
     mic_list = sr.Microphone.list_microphone_names() # Rileggi la lista per il nome corretto
@@ -132,97 +564,102 @@ async def main_loop():
         sys.exit(1)
 
     p = pyaudio.PyAudio()
-    out_s = p.open(format=pyaudio.paInt16, channels=1, rate=SAMPLE_RATE, output=True)
-    in_s = p.open(format=pyaudio.paInt16, channels=1, rate=16000, input=True, input_device_index=mic_idx, frames_per_buffer=512)
-    in_s.stop_stream() 
+    player = PlaybackEngine(p)
+    # 🟢 Un solo stream di ingresso: ascolto, endpointing e barge-in leggono lo stesso ring buffer
+    capture = AudioCapture(p, mic_idx)
+    barge = BargeInDetector(capture)
+    tts = TTSClient(cache=TTSCache())
+    await tts.warm()
+    prewarm_task = asyncio.ensure_future(tts.prewarm(TTS_PREWARM))
 
     brain = JarvisBrain() 
 
     print(f"\n{Fore.GREEN}🚀 JARVIS v51 (SAFE EXIT & MEMORY FIX){Style.RESET_ALL}")
     print(f"{Fore.YELLOW}ℹ️  Premi CTRL+C per uscire (risposta rapida).{Style.RESET_ALL}\n")
+    print(f"✅ PARLA! (Mic: {mic_list[mic_idx]})")
 
-    with sr.Microphone(device_index=mic_idx) as source:
-        r.adjust_for_ambient_noise(source, duration=1.0) 
-        print(f"✅ PARLA! (Mic: {mic_list[mic_idx]})")
-
+    try:
         while True:
             try:
-                try:
-                    if in_s.is_active(): in_s.stop_stream() 
-                except Exception as e:
-                    if "Stream not open" not in str(e):
-                        print(f"{Fore.RED}⚠️ Errore Audio Inatteso (Ignorato): {e}{Style.RESET_ALL}")
-                    
                 print(f"{Fore.CYAN}\n👂 Ascolto...{Style.RESET_ALL}", end="\r")
-                
-                try:
-                    audio = await asyncio.to_thread(r.listen, source, timeout=2.0, phrase_time_limit=10)
-                except sr.WaitTimeoutError:
+            
+                transcriber = StreamingTranscriber(on_partial=show_partial) if ASR_MODE == "stream" else None
+                pcm = await asyncio.to_thread(listen_utterance, capture, LISTEN_TIMEOUT_S, PHRASE_TIME_LIMIT_S, transcriber.feed if transcriber else None)
+                if pcm is None:
+                    if transcriber: transcriber.finish()
                     continue 
-                
+            
                 print(f"{Fore.YELLOW}⚡ Trascrizione...          {Style.RESET_ALL}", end="\r")
-                
-                with tempfile.NamedTemporaryFile(suffix=".wav", delete=False) as f:
-                    f.write(audio.get_wav_data()); tmp_name = f.name
-                
+            
+                t_turn = time.perf_counter()
                 try:
-                    segs, _ = whisper.transcribe(tmp_name, language="it", beam_size=1)
-                    user_text = " ".join([s.text for s in segs]).strip()
+                    user_text = transcriber.finish() if transcriber else transcribe_pcm(pcm)[0]
+                    print(f"{Fore.BLACK}{Style.BRIGHT}⏱️ ASR ({ASR_MODE}): {(time.perf_counter() - t_turn) * 1000:.0f} ms dopo fine frase (audio {len(pcm) / MIC_RATE:.1f}s){Style.RESET_ALL}")
                 except: user_text = ""
-                finally: 
-                    try: os.remove(tmp_name)
-                    except: pass
 
                 if len(user_text) < 2 or "sottotitoli" in user_text.lower(): continue
-                
-                
+            
+            
                 if "dimentica tutto" in user_text.lower() or "tabula rasa" in user_text.lower() or "cancella tutto" in user_text.lower():
                     reset_res = Memory.reset() 
                     print(f"🔧 {reset_res}")
-                    
-                    await speak_stream(iter(["Ho cancellato tutte le informazioni memorizzate su di te. Ho fatto tabula rasa!"]), out_s, in_s)
-                    
+                
+                    await speak_stream(text_chunks("Ho cancellato tutte le informazioni memorizzate su di te. Ho fatto tabula rasa!"), player, barge, tts)
+                
                     try:
-                        out_s.stop_stream(); out_s.close()
-                        in_s.stop_stream(); in_s.close()
+                        player.close()
+                        capture.close()
                         p.terminate()
-                        
+                    
                         p = pyaudio.PyAudio()
-                        out_s = p.open(format=pyaudio.paInt16, channels=1, rate=SAMPLE_RATE, output=True)
-                        in_s = p.open(format=pyaudio.paInt16, channels=1, rate=16000, input=True, input_device_index=mic_idx, frames_per_buffer=512)
-                        in_s.stop_stream() 
+                        player = PlaybackEngine(p)
+                        capture = AudioCapture(p, mic_idx)
+                        barge.capture = capture
                         print(f"{Fore.YELLOW}✅ Audio resettato senza riavvio del processo.{Style.RESET_ALL}")
-                        
+                    
                     except Exception as audio_e:
                         print(f"{Fore.RED}❌ FALLIMENTO RESET AUDIO: {audio_e}{Style.RESET_ALL}")
                         print(f"{Fore.RED}🛑 Eseguo riavvio completo del processo Python per stabilità.{Style.RESET_ALL}")
                         os.execv(sys.executable, ['python'] + sys.argv)
-                        
+                    
                     continue 
 
                 print(f"👤 TU: {user_text}")
 
-                in_s.start_stream() 
-                
                 try:
-                    generator = brain.think(user_text)
-                    if await speak_stream(generator, out_s, in_s):
+                    # 🟢 Brain asincrono: l'LLM non blocca mai il loop (barge-in, ping WebSocket, riproduzione)
+                    generator = brain.athink(user_text)
+                    if await speak_stream(generator, player, barge, tts):
                         print(f"{Fore.CYAN}⚡ Restart...{Style.RESET_ALL}")
                 except GeneratorExit: pass 
                 except Exception as e: 
                     print(f"Err Brain: {e}")
 
-            except KeyboardInterrupt:
-                print(f"\n{Fore.RED}🛑 Uscita in corso...{Style.RESET_ALL}")
-                break 
             except Exception as e: 
                 print(f"⚠️ Loop Error (FATAL): {e}")
-
-    out_s.stop_stream(); out_s.close()
-    in_s.stop_stream(); in_s.close()
-    p.terminate()
-    print("✅ Bye.")
+    finally:
+        # Uscita (anche Ctrl+C: asyncio.run lo consegna come CancelledError al task): metriche e chiusura dei pool
+        print(f"\n{Fore.RED}🛑 Uscita in corso...{Style.RESET_ALL}")
+        prewarm_task.cancel()
+        print(f"🔌 TTS: {tts.stats()} | cache {tts.cache.stats()}")
+        print(f"🔌 HTTP: {brain.http_stats()}")
+        print(f"🧰 Tool: {brain.tool_stats()}")
+        print(f"🧠 Memoria: {brain.memory_stats()}")
+        await tts.close()
+        player.close()
+        capture.close()
+        p.terminate()
+        print("✅ Bye.")
 
 if __name__ == "__main__":
+    if "--bench-asr" in sys.argv:
+        benchmark_asr(sys.argv[sys.argv.index("--bench-asr") + 1:]); sys.exit(0)
+    if "--bench-seg" in sys.argv:
+        benchmark_segmenter(); sys.exit(0)
+    if "--bench-mem" in sys.argv:
+        sizes = [int(n) for n in sys.argv[sys.argv.index("--bench-mem") + 1:]]
+        Memory.benchmark_delete(*([sizes] if sizes else [])); sys.exit(0)
+    if "--bench-http" in sys.argv:
+        benchmark_http(); sys.exit(0)
     try: asyncio.run(main_loop())
     except KeyboardInterrupt: pass
\ No newline at end of file
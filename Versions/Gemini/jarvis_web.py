@@ -0,0 +1,348 @@
+# Tool web del brain (ricerca Google entro un budget di latenza, meteo), cache dei loro risultati e loop asyncio di servizio.
+# Nessun modello né database caricato all'import: si usa (e si testa) senza Chroma o le API di Gemini.
+import aiohttp
+import asyncio
+import threading
+import json
+import html
+import random
+import re
+import unicodedata
+import os
+import time
+import atexit
+import statistics
+from collections import OrderedDict
+from colorama import Fore, Style
+from dotenv import load_dotenv
+
+load_dotenv()
+
+# CONFIGURAZIONE TOOL WEB
+HTTP_POOL_SIZE = 4 # Connessioni keep-alive per host: una per tool in parallelo (come TOOL_WORKERS del brain)
+HTTP_CONNECT_TIMEOUT = 3.05 # Secondi per aprire la connessione del meteo
+WEATHER_READ_TIMEOUT = 3 # Attesa massima tra due letture dalle API Open-Meteo
+TOOL_CACHE_TTLS = {"geocode": None, "weather": 600, "search": 3600} # Secondi di validità per tool (None = per sempre)
+TOOL_CACHE_MAX_ENTRIES = 500 # Oltre si scartano le voci usate meno di recente
+TOOL_CACHE_PATH = os.path.join(os.getcwd(), "tool_cache.json") # None = solo in memoria
+TOOL_CACHE_SAVE_DELAY_S = 5 # Le voci nuove si scrivono su disco insieme, al più una volta ogni N secondi (e all'uscita)
+SEARCH_URL = "https://www.googleapis.com/customsearch/v1"
+SEARCH_BUDGET_S = 4.0 # Tempo massimo di una ricerca web: alla scadenza si risponde con quel che c'è
+SEARCH_HEDGE_AFTER_S = 1.0 # Se Google tarda oltre, parte una seconda richiesta identica (vince la prima)
+SEARCH_MAX_ATTEMPTS = 3 # Tentativi se la ricerca torna vuota o fallisce (sempre entro il budget)
+SEARCH_BACKOFF_S = 0.4 # Base del backoff esponenziale con jitter tra un tentativo e l'altro
+SEARCH_FETCH_PAGES = 0 # Pagine dei primi risultati da scaricare per arricchire gli snippet (0 = disattivato)
+SEARCH_PAGE_MAX_BYTES = 64 * 1024 # Byte letti al massimo per pagina
+SEARCH_PAGE_TIMEOUT_S = 1.5 # Attesa massima per le pagine: una pagina lenta non consuma tutto il budget
+SEARCH_PAGE_CHARS = 400 # Testo tenuto per pagina
+SEARCH_RESULT_CHARS = 1500 + SEARCH_FETCH_PAGES * SEARCH_PAGE_CHARS
+
+# 🟢 DATI PER LA RICERCA WEB DI GOOGLE (con fallback per errore chiaro)
+GOOGLE_SEARCH_API_KEY = os.getenv("GOOGLE_SEARCH_API_KEY", "ERRORE_CHIAVE_MANCANTE") 
+GOOGLE_SEARCH_CX = os.getenv("GOOGLE_SEARCH_CX", "ERRORE_CX_MANCANTE") 
+
+# ==========================================
+# 🗃️ CACHE RISULTATI DEI TOOL (TTL per tool)
+# ==========================================
+
+class ToolCache:
+    """Cache dei risultati dei tool: TTL per tool (None = non scade), chiavi normalizzate, LRU e persistenza JSON opzionale."""
+    def __init__(self, ttls, max_entries=TOOL_CACHE_MAX_ENTRIES, path=TOOL_CACHE_PATH, save_delay=TOOL_CACHE_SAVE_DELAY_S):
+        self.ttls = ttls
+        self.max_entries = max_entries
+        self.path = os.path.abspath(path) if path else None  # Risolto subito: il salvataggio può arrivare all'uscita, da un'altra cartella
+        self.save_delay = save_delay
+        self.entries = OrderedDict()    # "tool|chiave" -> (scadenza epoch o None, valore)
+        self.lock = threading.Lock()    # I tool girano in parallelo sul pool
+        self.save_lock = threading.Lock()  # Un salvataggio alla volta (timer o uscita): il file temporaneo non si contende
+        self.dirty, self.timer = False, None  # Voci non ancora su disco / salvataggio in programma
+        self.hits = self.misses = 0
+        self._load()
+        if self.path: atexit.register(self.flush)
+
+    @staticmethod
+    def _key(tool, key):
+        # "Roma", " roma " e "ROMA" sono la stessa richiesta
+        return f"{tool}|{' '.join(unicodedata.normalize('NFKC', str(key)).casefold().split())}"
+
+    def get(self, tool, key):
+        k = self._key(tool, key)
+        with self.lock:
+            entry = self.entries.get(k)
+            if entry and (entry[0] is None or entry[0] > time.time()):
+                self.entries.move_to_end(k); self.hits += 1
+                return entry[1]
+            if entry: del self.entries[k]
+            self.misses += 1
+            return None
+
+    def put(self, tool, key, value):
+        """Memorizza solo risultati validi (gli errori non vanno in cache) e restituisce value."""
+        ttl = self.ttls.get(tool)
+        with self.lock:
+            k = self._key(tool, key)
+            self.entries[k] = (None if ttl is None else time.time() + ttl, value)
+            self.entries.move_to_end(k)
+            while len(self.entries) > self.max_entries: self.entries.popitem(last=False)
+            if self.path:
+                self.dirty = True
+                if self.timer is None:
+                    # Un burst di ricerche parallele diventa una sola riscrittura del file
+                    self.timer = threading.Timer(self.save_delay, self.flush)
+                    self.timer.daemon = True
+                    self.timer.start()
+        return value
+
+    def flush(self):
+        """Scrive su disco le voci nuove, se ce ne sono (dal timer e all'uscita)."""
+        with self.save_lock:
+            with self.lock:
+                self.timer = None
+                if not self.dirty: return
+                self.dirty = False
+                snapshot = list(self.entries.items())
+            self._save(snapshot)
+
+    def _load(self):
+        if not self.path or not os.path.exists(self.path): return
+        try:
+            with open(self.path, encoding="utf-8") as f:
+                now = time.time()
+                for k, expires, value in json.load(f):
+                    if expires is None or expires > now: self.entries[k] = (expires, value)
+        except Exception as e:
+            print(f"{Fore.YELLOW}⚠️ Cache tool illeggibile, si riparte vuoti: {e}{Style.RESET_ALL}")
+
+    def _save(self, snapshot):
+        # Scrittura atomica: un crash a metà non lascia un file troncato (e un altro processo Jarvis usa un altro temporaneo)
+        try:
+            tmp = f"{self.path}.{os.getpid()}.tmp"
+            with open(tmp, "w", encoding="utf-8") as f:
+                json.dump([[k, expires, value] for k, (expires, value) in snapshot], f, ensure_ascii=False)
+            os.replace(tmp, self.path)
+        except Exception as e:
+            print(f"{Fore.YELLOW}⚠️ Salvataggio cache tool fallito: {e}{Style.RESET_ALL}")
+
+    def stats(self):
+        total = self.hits + self.misses
+        rate = f"{self.hits / total:.0%}" if total else "n/d"
+        return f"hit {rate} ({self.hits}/{total}), {len(self.entries)} voci"
+
+tool_cache = ToolCache(TOOL_CACHE_TTLS)
+
+# ==========================================
+# 🔎 RICERCA WEB ASINCRONA (budget di latenza)
+# ==========================================
+
+class SearchConfigError(Exception):
+    """Errore di configurazione/quota restituito da Google: ritentare non serve."""
+
+_tool_session = None
+tool_conn_stats = {"new": 0, "reused": 0}  # Connessioni dei tool HTTP: aperte / riusate dal pool keep-alive
+
+def _count_tool_conn(kind):
+    async def on_event(session, ctx, params): tool_conn_stats[kind] += 1
+    return on_event
+
+def _tool_http():
+    """Sessione aiohttp dei tool (ricerca web e meteo), sul loop di servizio: le connessioni restano calde tra una chiamata e l'altra."""
+    global _tool_session
+    if _tool_session is None or _tool_session.closed:
+        trace = aiohttp.TraceConfig()
+        trace.on_connection_create_end.append(_count_tool_conn("new"))
+        trace.on_connection_reuseconn.append(_count_tool_conn("reused"))
+        _tool_session = aiohttp.ClientSession(connector=aiohttp.TCPConnector(limit_per_host=HTTP_POOL_SIZE), trace_configs=[trace],
+                                              headers={"User-Agent": "Mozilla/5.0 (Jarvis)"})
+    return _tool_session
+
+def http_pool_stats():
+    """Riuso delle connessioni keep-alive dei tool."""
+    if not any(tool_conn_stats.values()): return "nessuna richiesta"
+    return f"{tool_conn_stats['reused']} riusate/{tool_conn_stats['new']} nuove"
+
+def _abandon(tasks):
+    """Cancella i task non più utili senza lasciare eccezioni "never retrieved"."""
+    for t in tasks:
+        t.cancel()
+        t.add_done_callback(lambda t: t.cancelled() or t.exception())
+
+async def _google_once(session, params, timeout):
+    async with session.get(SEARCH_URL, params=params, timeout=aiohttp.ClientTimeout(total=timeout)) as r:
+        if r.status >= 500: r.raise_for_status()  # Errore transitorio del server: si ritenta
+        data = await r.json(content_type=None)
+        if data.get("error"):
+            raise SearchConfigError(data["error"].get("message", r.status))
+        r.raise_for_status()
+    return data.get("items", [])
+
+async def _google_hedged(session, params, deadline):
+    """Una richiesta, più una copia identica se la prima tarda oltre SEARCH_HEDGE_AFTER_S: vince la prima risposta valida."""
+    loop = asyncio.get_running_loop()
+    tasks = {asyncio.ensure_future(_google_once(session, params, deadline - loop.time()))}
+    hedged, error = False, None
+    try:
+        while tasks and loop.time() < deadline:
+            wait = deadline - loop.time() if hedged else min(SEARCH_HEDGE_AFTER_S, deadline - loop.time())
+            done, tasks = await asyncio.wait(tasks, timeout=wait, return_when=asyncio.FIRST_COMPLETED)
+            for t in done:
+                if isinstance(t.exception(), SearchConfigError): raise t.exception()
+                if t.exception() is None: return t.result()
+                error = t.exception()
+            if not done and not hedged and loop.time() < deadline:
+                hedged = True
+                tasks.add(asyncio.ensure_future(_google_once(session, params, deadline - loop.time())))
+        if error: raise error
+        return None  # Scadenza raggiunta senza risposta
+    finally:
+        _abandon(tasks)
+
+async def _fetch_page_text(session, url, timeout):
+    """Testo della pagina, letto al massimo per SEARCH_PAGE_MAX_BYTES."""
+    buf = bytearray()
+    async with session.get(url, timeout=aiohttp.ClientTimeout(total=timeout)) as r:
+        async for chunk in r.content.iter_chunked(8192):
+            buf += chunk
+            if len(buf) >= SEARCH_PAGE_MAX_BYTES: break
+    text = re.sub(r"(?is)<(script|style)\b.*?</\1>", " ", buf[:SEARCH_PAGE_MAX_BYTES].decode("utf-8", errors="ignore"))
+    text = html.unescape(re.sub(r"<[^>]+>", " ", text))
+    return " ".join(text.split())[:SEARCH_PAGE_CHARS]
+
+async def web_search_async(query, budget=SEARCH_BUDGET_S):
+    """Ricerca Google entro `budget` secondi: hedging, backoff con jitter e, alla scadenza, quel che c'è."""
+    cached = tool_cache.get("search", query)
+    if cached is not None: return cached
+    
+    loop = asyncio.get_running_loop()
+    deadline = loop.time() + budget
+    session = _tool_http()
+    params = {"key": GOOGLE_SEARCH_API_KEY, "cx": GOOGLE_SEARCH_CX, "q": query, "num": 3, "gl": "it", "lr": "lang_it"}
+    
+    items, error = [], None
+    for attempt in range(SEARCH_MAX_ATTEMPTS):
+        try:
+            items = await _google_hedged(session, params, deadline)
+        except SearchConfigError as e:
+            print(f"{Fore.RED}❌ ERRORE GOOGLE API (Configurazione/Rate-Limit): {e}{Style.RESET_ALL}")
+            return f"Errore di configurazione API: {e}"
+        except Exception as e:
+            error, items = e, []
+        if items is None or items: break  # Risultati, oppure budget esaurito in attesa di Google
+        # Backoff esponenziale con jitter, mai oltre la scadenza
+        delay = min(SEARCH_BACKOFF_S * 2 ** attempt * random.uniform(0.5, 1.5), deadline - loop.time())
+        if delay <= 0: break
+        await asyncio.sleep(delay)
+    
+    if not items:
+        if error:
+            print(f"{Fore.RED}❌ ERRORE GOOGLE API (Network): {error}{Style.RESET_ALL}")
+            return "In questo momento non riesco a cercare sul web. Riprova più tardi."
+        if items is None: return "La ricerca web non ha risposto in tempo. Riprova più tardi."
+        return "Nessun risultato trovato sul web."
+    
+    results = [f"- {item.get('title')}: {item.get('snippet')}" for item in items]
+    
+    # 🟢 Arricchimento opzionale: pagine dei primi risultati in parallelo; alla scadenza si tiene solo quel che è arrivato
+    links = [item.get("link") for item in items[:SEARCH_FETCH_PAGES] if item.get("link")]
+    if links and deadline - loop.time() > 0:
+        wait = min(SEARCH_PAGE_TIMEOUT_S, deadline - loop.time())
+        fetches = [asyncio.ensure_future(_fetch_page_text(session, link, wait)) for link in links]
+        await asyncio.wait(fetches, timeout=wait)
+        for i, f in enumerate(fetches):
+            if f.done() and f.exception() is None and f.result():
+                results[i] += f"\n  {f.result()}"
+        _abandon(fetches)
+    
+    return tool_cache.put("search", query, "\n".join(results)[:SEARCH_RESULT_CHARS])
+
+async def weather_async(city):
+    """Meteo attuale da Open-Meteo: coordinate in cache per sempre, meteo per qualche minuto."""
+    session = _tool_http()
+    timeout = aiohttp.ClientTimeout(total=None, sock_connect=HTTP_CONNECT_TIMEOUT, sock_read=WEATHER_READ_TIMEOUT)
+    # Le coordinate di una città non cambiano: geocoding in cache per sempre
+    coords = tool_cache.get("geocode", city)
+    if coords is None:
+        async with session.get("https://geocoding-api.open-meteo.com/v1/search", params={"name": city, "count": 1}, timeout=timeout) as r:
+            geo = await r.json(content_type=None)
+        if not geo.get("results"): return "Città non trovata."
+        coords = tool_cache.put("geocode", city, [geo["results"][0]["latitude"], geo["results"][0]["longitude"]])
+    lat, lon = coords
+    # Il meteo attuale si riusa per qualche minuto
+    cw = tool_cache.get("weather", f"{lat:.2f},{lon:.2f}")
+    if cw is None:
+        async with session.get("https://api.open-meteo.com/v1/forecast", params={"latitude": lat, "longitude": lon, "current_weather": "true"}, timeout=timeout) as r:
+            cw = (await r.json(content_type=None)).get("current_weather")
+        if not cw: return "Impossibile ottenere il meteo attuale."
+        tool_cache.put("weather", f"{lat:.2f},{lon:.2f}", cw)
+    return f"Meteo {city}: {cw['temperature']}°C, Vento {cw['windspeed']} km/h."
+
+# ==========================================
+# 🔁 PONTE SYNC -> ASYNC
+# ==========================================
+
+_sync_loop = None
+_sync_loop_lock = threading.Lock()
+
+def service_loop():
+    """Loop asyncio di servizio in background (creato al primo uso, anche da più thread di tool insieme)."""
+    global _sync_loop
+    with _sync_loop_lock:
+        if _sync_loop is None:
+            _sync_loop = asyncio.new_event_loop()
+            threading.Thread(target=_sync_loop.run_forever, daemon=True).start()
+            atexit.register(_close_service_loop)  # Registrato dopo writer e hot tier: all'uscita gira per primo
+    return _sync_loop
+
+def _close_service_loop():
+    """Uscita: chiude la sessione HTTP dei tool sul loop di servizio, ancora vivo (niente "Unclosed client session")."""
+    if _tool_session is None or _tool_session.closed: return
+    try: asyncio.run_coroutine_threadsafe(_tool_session.close(), _sync_loop).result(timeout=2)
+    except Exception: pass  # Loop bloccato o già fermo: le connessioni cadono comunque con il processo
+
+def run_async(coro):
+    """Esegue una coroutine sul loop di servizio e ne attende il risultato (da codice sincrono, es. i tool)."""
+    return asyncio.run_coroutine_threadsafe(coro, service_loop()).result()
+
+def iterate_async(agen):
+    """Consuma un generatore asincrono da codice sincrono, sul loop di servizio."""
+    loop = service_loop()
+    try:
+        while True:
+            try: yield asyncio.run_coroutine_threadsafe(agen.__anext__(), loop).result()
+            except StopAsyncIteration: return
+    finally:
+        asyncio.run_coroutine_threadsafe(agen.aclose(), loop).result()
+
+# ==========================================
+# 📊 BENCHMARK POOL HTTP DEI TOOL
+# ==========================================
+
+def benchmark_http(requests=50):
+    """GET verso un server locale: sessione (e connessione) nuova a ogni richiesta contro la sessione keep-alive dei tool."""
+    from aiohttp import web
+
+    async def ok(request): return web.Response(text="ok")
+
+    async def start():
+        app = web.Application(); app.router.add_get("/", ok)
+        runner = web.AppRunner(app); await runner.setup()
+        await web.TCPSite(runner, "127.0.0.1", 0).start()
+        return runner, runner.addresses[0][1]
+
+    async def fresh(url):
+        async with aiohttp.ClientSession() as session, session.get(url) as r: await r.read()
+
+    async def pooled(url):
+        async with _tool_http().get(url) as r: await r.read()
+
+    runner, port = run_async(start())
+    url, before = f"http://127.0.0.1:{port}/", dict(tool_conn_stats)
+    try:
+        print(f"{Fore.CYAN}📊 {requests} GET verso un server locale (mediana){Style.RESET_ALL}")
+        for name, fn in [("sessione nuova per richiesta", fresh), ("sessione dei tool (keep-alive)", pooled)]:
+            times = []
+            for _ in range(requests):
+                t0 = time.perf_counter(); run_async(fn(url)); times.append((time.perf_counter() - t0) * 1000)
+            print(f"  {name:30s}: {statistics.median(times):.2f} ms")
+        print(f"  connessioni della sessione dei tool: {tool_conn_stats['new'] - before['new']} nuove, {tool_conn_stats['reused'] - before['reused']} riusate")
+    finally:
+        run_async(runner.cleanup())
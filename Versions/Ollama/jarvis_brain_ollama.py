@@ -1,5 +1,9 @@
-import requests
+import aiohttp
+import asyncio
+import threading
 import json
+import hashlib
+import inspect
 import re
 import chromadb
 import uuid
@@ -8,7 +12,13 @@ from sentence_transformers import SentenceTransformer
 from colorama import Fore, Style
 import os
 import time
+import atexit
+import numpy as np
+import statistics
+from collections import deque, OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 from dotenv import load_dotenv
+from jarvis_web_ollama import SEARCH_BUDGET_S, WEB_SEARCH_ENABLED, tool_cache, web_search_async, http_pool_stats, run_async, iterate_async
 
 load_dotenv()
 
@@ -16,22 +26,360 @@ load_dotenv()
 SIMILARITY_THRESHOLD = 1.4
 DEDUPLICATION_THRESHOLD = 0.3
 OLLAMA_URL = "http://localhost:11434/api/chat"
+MAX_TOOL_ROUNDS = 3  # Giri tool -> risposta consentiti in un turno (evita loop infiniti)
+TOOL_WORKERS = 4     # Tool eseguiti in parallelo quando il modello ne chiede più di uno
+TOOL_TIMEOUT_S = 5   # Deadline di default di un tool: oltre, il turno prosegue con un errore
+TOOL_LATENCY_BUCKETS_MS = (10, 50, 100, 250, 500, 1000, 2500, 5000, float("inf"))  # Istogramma latenze per tool
+OLLAMA_KEEP_ALIVE = "30m"  # Il modello resta in memoria tra un turno e l'altro (niente ricaricamento)
+OLLAMA_POOL_SIZE = 2       # Connessioni keep-alive verso Ollama (una per lo stream, una di scorta)
+OLLAMA_IDLE_KEEPALIVE_S = 120  # Una connessione inattiva resta aperta fra un turno e l'altro
+OLLAMA_CONNECT_TIMEOUT = 5     # Secondi per aprire la connessione verso Ollama
+OLLAMA_READ_TIMEOUT = 30       # Attesa massima tra due righe dello stream (compreso il caricamento a freddo del modello)
 
-# --- CONFIGURAZIONE RICERCA WEB OPZIONALE ---
-GOOGLE_SEARCH_API_KEY = os.getenv("GOOGLE_SEARCH_API_KEY") 
-GOOGLE_SEARCH_CX = os.getenv("GOOGLE_SEARCH_CX") 
-WEB_SEARCH_ENABLED = bool(GOOGLE_SEARCH_API_KEY and GOOGLE_SEARCH_CX)
+# --- PROMPT (cache-friendly) ---
+# Il prefisso (system + storia) resta identico byte per byte tra i turni, così Ollama riusa la KV cache:
+# niente orario nel system prompt e storia append-only, compattata solo quando supera CONTEXT_TOKEN_BUDGET.
+SYSTEM_PROMPT = "Sei Jarvis, un assistente IA. Rispondi in italiano in modo conciso e utile."
+CONTEXT_TOKEN_BUDGET = 1500  # Token massimi di storia + riassunto (il contesto di default dei modelli piccoli è 2048)
+CONTEXT_TARGET_RATIO = 0.6   # Una compattazione scende fino a questa frazione del budget (un solo cambio di prefisso)
+SUMMARY_TOKEN_BUDGET = 300   # Il riassunto dei turni piegati scorre: le righe più vecchie escono
+EMBED_CACHE_SIZE = 1024      # Vettori tenuti in memoria (~1.5 KB l'uno per MiniLM)
+MEMORY_FLUSH_SIZE = 8         # Scritture in coda che fanno partire subito un batch su Chroma
+MEMORY_FLUSH_INTERVAL_S = 2.0 # Attesa massima di una scrittura in coda prima del batch
+MEMORY_CLOSE_TIMEOUT_S = 10   # Alla chiusura si aspetta al massimo tanto lo svuotamento della coda
+MEMORY_COLLECTION = "user_memories"
+MEMORY_DELETE_PAGE = 5000    # Id per giro nelle cancellazioni di massa (memoria costante anche con milioni di ricordi)
+HOT_INDEX_SIZE = 4096        # Ricordi nel hot tier in RAM (4096 x 384 float32 = 6 MB, top-k sotto il millisecondo)
+HOT_INDEX_ACCEPT = 0.8       # Se tutti i k risultati caldi sono più vicini di così, Chroma non si interroga
+HOT_INDEX_PATH = "./memoria_db/hot_index"  # .f32 (matrice mappata) + .json (id e testi, scritto alla chiusura)
+MEMORY_RETENTION_DAYS = {"ai": 30, "user": None}  # Giorni di vita dei turni per speaker (None = per sempre: far scadere i turni dell'utente è una scelta esplicita)
+MEMORY_DUP_SIMILARITY = 0.92 # Coseno oltre il quale due ricordi sono lo stesso (resta il più recente)
+MEMORY_COMPACT_BLOCK = 1024  # Ricordi per blocco nella compattazione (matrice di similarità 1024 x 1024)
+MEMORY_COMPACT_WINDOW = 8    # Blocchi precedenti con cui si confronta ogni blocco (RAM limitata, doppioni vicini nel tempo)
+MEMORY_COMPACT_DELAY_S = 120 # Primo giro di compattazione dopo l'avvio
+MEMORY_COMPACT_INTERVAL_S = 6 * 3600  # Giri successivi (0 = solo a mano)
+MEMORY_COMPACT_PROBES = 20   # Query campione per misurare la latenza prima e dopo
 
 # --- SETUP DATABASE CHROMA ---
 print(f"{Fore.CYAN}🧠 [Brain] Init Database...{Style.RESET_ALL}")
 try:
     embedder = SentenceTransformer('all-MiniLM-L6-v2')
     chroma_client = chromadb.PersistentClient(path="./memoria_db")
-    collection = chroma_client.get_or_create_collection(name="user_memories")
+    collection = chroma_client.get_or_create_collection(name=MEMORY_COLLECTION)
     print(f"{Fore.GREEN}✅ Database Caricato.{Style.RESET_ALL}")
 except Exception as e:
     print(f"{Fore.RED}❌ ERRORE DATABASE: {e}{Style.RESET_ALL}"); collection = None; embedder = None
 
+# --- CACHE EMBEDDING ---
+class EmbeddingCache:
+    """Embedding con LRU per hash del testo: ogni stringa si calcola una volta sola, i vettori vanno diretti a Chroma."""
+    def __init__(self, encode, max_entries=EMBED_CACHE_SIZE):
+        self.encode = encode            # lista di testi -> lista di vettori (un solo batch)
+        self.max_entries = max_entries
+        self.vectors = OrderedDict()    # sha1 del testo -> vettore (lista di float)
+        self.lock = threading.Lock()    # Tool, salvataggi e ricerche arrivano da thread diversi
+        self.hits = self.misses = 0
+
+    def embed(self, texts):
+        keys = [hashlib.sha1(t.encode("utf-8")).hexdigest() for t in texts]
+        with self.lock:
+            found = {k: self.vectors[k] for k in keys if k in self.vectors}
+            for k in found: self.vectors.move_to_end(k)
+        # I mancanti si calcolano insieme, fuori dal lock (il modello è la parte lenta)
+        todo = {k: t for k, t in zip(keys, texts) if k not in found}
+        if todo:
+            computed = [list(map(float, v)) for v in self.encode(list(todo.values()))]
+            found.update(zip(todo, computed))
+        with self.lock:
+            self.hits += len(texts) - len(todo); self.misses += len(todo)
+            for k in todo:
+                self.vectors[k] = found[k]
+            while len(self.vectors) > self.max_entries: self.vectors.popitem(last=False)
+        return [found[k] for k in keys]
+
+    def stats(self):
+        total = self.hits + self.misses
+        return f"embedding hit {self.hits / total:.0%} ({self.hits}/{total})" if total else "embedding: nessuno"
+
+embed_cache = EmbeddingCache(lambda texts: embedder.encode(texts))
+
+# --- SCRITTURE IN DIFFERITA (write-behind) ---
+class MemoryWriter:
+    """I salvataggi tornano subito: un thread li scrive su Chroma a blocchi (per dimensione, tempo o alla chiusura)."""
+    def __init__(self, write, flush_size=MEMORY_FLUSH_SIZE, flush_interval=MEMORY_FLUSH_INTERVAL_S):
+        self.write = write                  # lista di (testo, speaker) -> una scrittura batch
+        self.flush_size, self.flush_interval = flush_size, flush_interval
+        self.queue, self.inflight = [], []  # In coda / in scrittura: entrambi visibili a Memory.search
+        self.oldest = 0.0                   # Arrivo del primo elemento in coda (trigger a tempo)
+        self.flush_requested = self.closed = False
+        self.cond = threading.Condition()
+        self.batches = self.written = 0
+        self.thread = threading.Thread(target=self._run, daemon=True, name="jarvis-memory-writer")
+        self.thread.start()
+        atexit.register(self.close)         # Chiusura pulita: quel che è in coda arriva su disco
+
+    def submit(self, entries):
+        with self.cond:
+            if not self.queue: self.oldest = time.monotonic()
+            self.queue.extend(entries)
+            self.cond.notify_all()  # Il thread ricalcola la scadenza (o parte subito se la coda è piena)
+
+    def _due(self):
+        return self.closed or self.flush_requested or len(self.queue) >= self.flush_size or \
+            (self.queue and time.monotonic() - self.oldest >= self.flush_interval)
+
+    def _run(self):
+        while True:
+            with self.cond:
+                while not self._due():
+                    self.cond.wait(max(0.0, self.flush_interval - (time.monotonic() - self.oldest)) if self.queue else None)
+                if not self.queue:
+                    if self.closed: return
+                    self.flush_requested = False
+                    continue
+                batch, self.queue = self.queue, []
+                self.inflight = batch
+            try: self.write(batch)
+            except Exception as e: print(f"{Fore.RED}❌ Scrittura memoria fallita: {e}{Style.RESET_ALL}")
+            with self.cond:
+                self.inflight = []
+                self.batches += 1; self.written += len(batch)
+                self.cond.notify_all()
+
+    def pending(self):
+        """Testi inviati ma non ancora su Chroma (read-your-writes)."""
+        with self.cond: return self.inflight + self.queue
+
+    def flush(self, timeout=None):
+        """Attende che quanto inviato finora sia scritto."""
+        with self.cond:
+            self.flush_requested = True
+            self.cond.notify_all()
+            return self.cond.wait_for(lambda: not self.queue and not self.inflight, timeout)
+
+    def discard(self):
+        """Reset della memoria: la coda non va più scritta (una scrittura già in corso termina prima)."""
+        with self.cond:
+            self.queue.clear()
+            self.cond.wait_for(lambda: not self.inflight)
+
+    def close(self):
+        with self.cond:
+            if self.closed: return
+            self.closed = True
+            self.cond.notify_all()
+        self.thread.join(timeout=MEMORY_CLOSE_TIMEOUT_S)
+
+    def stats(self):
+        with self.cond:
+            return f"scritture {self.written} in {self.batches} batch, in coda {len(self.queue) + len(self.inflight)}"
+
+def _pending_hits(vector):
+    """Testi ancora in coda di scrittura con la stessa distanza di Chroma (L2 al quadrato) dal vettore della query."""
+    texts = [text for text, _ in memory_writer.pending()]
+    if not texts: return []
+    q = np.asarray(vector, dtype=np.float32)
+    return [(text, float(((np.asarray(v, dtype=np.float32) - q) ** 2).sum())) for text, v in zip(texts, embed_cache.embed(texts))]
+
+def _merge_hits(hits, limit):
+    """Chroma + coda, senza doppioni, in ordine di distanza."""
+    best = {}
+    for doc, dist in hits:
+        if doc not in best or dist < best[doc]: best[doc] = dist
+    return sorted(best.items(), key=lambda h: h[1])[:limit]
+
+# --- INDICE CALDO (hot tier davanti a Chroma) ---
+class HotIndex:
+    """Ricordi più recenti e più usati in una matrice float32 mappata su disco: top-k vettoriale, Chroma solo per il resto."""
+    def __init__(self, path, capacity=HOT_INDEX_SIZE, total=0):
+        self.path, self.capacity = path, capacity
+        self.lock = threading.Lock()        # Ricerche, writer e cancellazioni arrivano da thread diversi
+        self.hot = self.cold = 0
+        self.hot_ms, self.cold_ms = deque(maxlen=256), deque(maxlen=256)
+        self._empty()
+        self._load(total)
+        atexit.register(self.close)         # Registrato prima del writer: si chiude dopo l'ultimo batch
+
+    def _empty(self):
+        self.matrix = None                  # np.memmap (capacity x dim), creato al primo vettore
+        self.norms = np.full(self.capacity, np.inf, dtype=np.float32)  # inf = riga libera (mai nel top-k)
+        self.ids, self.docs = [None] * self.capacity, [None] * self.capacity
+        self.used = np.zeros(self.capacity, dtype=np.int64)  # Ultimo uso (salvataggio o risultato): il minimo esce
+        self.row_of, self.free = {}, list(range(self.capacity - 1, -1, -1))
+        self.tick, self.complete = 0, True  # complete: il caldo contiene tutta la collection (risposta esatta)
+
+    def _open(self, dim, mode):
+        os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+        self.matrix = np.memmap(self.path + ".f32", dtype=np.float32, mode=mode, shape=(self.capacity, dim))
+
+    def _load(self, total):
+        # Il sidecar esiste solo dopo una chiusura pulita: si consuma subito, così dopo un crash si riparte da vuoto
+        try:
+            with open(self.path + ".json", encoding="utf-8") as f: meta = json.load(f)
+            os.remove(self.path + ".json")
+            if meta["capacity"] != self.capacity: raise ValueError("HOT_INDEX_SIZE cambiato")  # Si riparte da vuoto, non completo
+            self._open(meta["dim"], "r+")
+            for row, (id_, doc, used) in enumerate(zip(meta["ids"], meta["docs"], meta["used"])):
+                if id_ is None: continue
+                self.ids[row], self.docs[row], self.used[row] = id_, doc, used
+                self.row_of[id_] = row
+                self.norms[row] = float(self.matrix[row] @ self.matrix[row])
+            self.free = [row for row in range(self.capacity - 1, -1, -1) if self.ids[row] is None]
+            self.tick, self.complete = meta["tick"], meta["complete"] and total == len(self.row_of)
+        except Exception:
+            self._empty()
+            self.complete = total == 0
+
+    def add(self, ids, docs, vectors):
+        """Salvataggi e risultati promossi da Chroma: entrano (o si rinfrescano) in testa."""
+        with self.lock:
+            for id_, doc, vector in zip(ids, docs, vectors):
+                v = np.asarray(vector, dtype=np.float32)
+                if self.matrix is None: self._open(len(v), "w+")
+                row = self.row_of.get(id_)
+                if row is None:
+                    if self.free: row = self.free.pop()
+                    else:  # Pieno: esce il ricordo usato meno di recente, che resta solo su Chroma
+                        row = int(np.argmin(self.used))
+                        del self.row_of[self.ids[row]]
+                        self.complete = False
+                    self.row_of[id_] = row
+                self.matrix[row] = v
+                self.norms[row] = float(v @ v)
+                self.ids[row], self.docs[row] = id_, doc
+                self.tick += 1; self.used[row] = self.tick
+
+    def remove(self, ids):
+        with self.lock:
+            for id_ in ids:
+                row = self.row_of.pop(id_, None)
+                if row is None: continue
+                self.norms[row] = np.inf
+                self.ids[row] = self.docs[row] = None
+                self.free.append(row)
+
+    def clear(self):
+        with self.lock:
+            matrix = self.matrix
+            self._empty()
+            self.matrix = matrix  # Il file resta: le righe libere hanno norma inf e non escono mai
+
+    def search(self, vector, limit):
+        """(risultati [(doc, distanza L2 al quadrato come Chroma)], esatto)."""
+        with self.lock:
+            k = min(limit, len(self.row_of))
+            if not k: return [], self.complete
+            q = np.asarray(vector, dtype=np.float32)
+            dists = self.norms - 2.0 * (self.matrix @ q) + float(q @ q)
+            rows = np.argpartition(dists, k - 1)[:k]
+            rows = rows[np.argsort(dists[rows])]
+            for row in rows:
+                self.tick += 1; self.used[row] = self.tick
+            return [(self.docs[row], max(0.0, float(dists[row]))) for row in rows], self.complete
+
+    def record(self, hot, ms):
+        with self.lock:
+            if hot: self.hot += 1; self.hot_ms.append(ms)
+            else: self.cold += 1; self.cold_ms.append(ms)
+
+    def close(self):
+        with self.lock:
+            if self.matrix is None: return
+            self.matrix.flush()
+            meta = {"capacity": self.capacity, "dim": self.matrix.shape[1], "tick": self.tick, "complete": self.complete,
+                    "ids": self.ids, "docs": self.docs, "used": self.used.tolist()}
+            with open(self.path + ".json", "w", encoding="utf-8") as f: json.dump(meta, f, ensure_ascii=False)
+
+    def stats(self):
+        with self.lock:
+            total = self.hot + self.cold
+            if not total: return f"hot tier {len(self.row_of)}/{self.capacity}, nessuna ricerca"
+            p50 = lambda xs: f"{np.median(xs):.2f} ms" if xs else "-"
+            return (f"hot tier {len(self.row_of)}/{self.capacity}, {self.hot / total:.0%} dal caldo (p50 {p50(self.hot_ms)})"
+                    f" / Chroma {self.cold} (p50 {p50(self.cold_ms)})")
+
+hot_index = HotIndex(HOT_INDEX_PATH, total=collection.count() if collection is not None else 0)
+
+# ==========================================
+# 🧰 REGISTRO TOOL (schema, dispatch, deadline, metriche)
+# ==========================================
+
+_JSON_TYPES = {str: "string", int: "integer", float: "number", bool: "boolean"}
+
+class _ToolSpec:
+    """Un tool registrato: funzione, parametri ricavati dalla firma, deadline e metriche."""
+    def __init__(self, name, fn, timeout_s):
+        self.name, self.fn, self.timeout_s = name, fn, timeout_s
+        params = inspect.signature(fn).parameters.values()
+        self.params = {p.name: _JSON_TYPES.get(p.annotation, "string") for p in params}
+        self.required = [p.name for p in params if p.default is p.empty]
+        self.description = inspect.getdoc(fn) or name
+        self.hist = [0] * len(TOOL_LATENCY_BUCKETS_MS)  # Istogramma delle latenze (ms)
+        self.calls = self.errors = self.timeouts = 0
+
+    def record(self, ms):
+        self.calls += 1
+        self.hist[next(i for i, bound in enumerate(TOOL_LATENCY_BUCKETS_MS) if ms <= bound)] += 1
+
+    def percentile(self, q):
+        """Limite superiore del bucket che contiene il quantile q."""
+        seen = 0
+        for bound, n in zip(TOOL_LATENCY_BUCKETS_MS, self.hist):
+            seen += n
+            if seen >= q * self.calls: return bound
+
+class ToolRegistry:
+    """Registro unico: lo schema per il modello nasce da firma e docstring dei metodi di Tools, il dispatch è un lookup."""
+    def __init__(self):
+        self.specs = {}
+
+    def tool(self, name, timeout_s=TOOL_TIMEOUT_S, enabled=True):
+        """Decoratore: registra la funzione col nome visto dal modello (va sotto @staticmethod)."""
+        def register(fn):
+            if enabled: self.specs[name] = _ToolSpec(name, fn, timeout_s)
+            return fn
+        return register
+
+    def schema(self):
+        """Schema JSON dei tool (formato Ollama / OpenAI)."""
+        return [{"type": "function", "function": {
+            "name": s.name, "description": s.description,
+            "parameters": {"type": "object", "properties": {p: {"type": t} for p, t in s.params.items()}, "required": s.required},
+        }} for s in self.specs.values()]
+
+    async def arun(self, name, args):
+        """Esegue il tool sul pool entro la sua deadline; errori e timeout tornano come testo per il modello."""
+        spec = self.specs.get(name)
+        if spec is None: return f"Errore: tool '{name}' sconosciuto."
+        kwargs = {k: v for k, v in (args or {}).items() if k in spec.params}  # Argomenti inventati dal modello: ignorati
+        missing = [p for p in spec.required if p not in kwargs]
+        if missing:
+            spec.errors += 1
+            return f"Errore: argomenti mancanti per {name}: {', '.join(missing)}."
+        
+        t0 = time.perf_counter()
+        try:
+            res = await asyncio.wait_for(asyncio.get_running_loop().run_in_executor(_tool_pool, lambda: spec.fn(**kwargs)), spec.timeout_s)
+            if isinstance(res, str) and res.startswith("Err"): spec.errors += 1  # I tool restituiscono gli errori come testo
+        except asyncio.TimeoutError:
+            # Il thread non si può interrompere, ma il turno prosegue senza aspettarlo
+            spec.timeouts += 1
+            res = f"Errore: il tool {name} non ha risposto entro {spec.timeout_s:g} secondi."
+        except Exception as e:
+            spec.errors += 1
+            res = f"Errore: {e}"
+        ms = (time.perf_counter() - t0) * 1000
+        spec.record(ms)
+        print(f"{Fore.BLACK}{Style.BRIGHT}⏱️ Tool {name}: {ms:.0f} ms{Style.RESET_ALL}")
+        return res
+
+    def stats(self):
+        used = [s for s in self.specs.values() if s.calls]
+        return ", ".join(f"{s.name} {s.calls}x p50≤{s.percentile(0.5):g} p95≤{s.percentile(0.95):g} ms err {s.errors} timeout {s.timeouts}" for s in used) or "nessuna chiamata"
+
+_tool_pool = ThreadPoolExecutor(max_workers=TOOL_WORKERS, thread_name_prefix="jarvis-tool")
+registry = ToolRegistry()
+
 # ==========================================
 # 🛠️ CLASSI E FUNZIONI TOOLS
 # ==========================================
@@ -40,113 +388,396 @@ class Memory:
     # ... (Il codice della classe Memory rimane invariato per brevità)
     @staticmethod
     def save(text, speaker="user"):
+        memory_writer.submit([(text, speaker)])
+
+    @staticmethod
+    def save_many(entries):
+        """Scrive più (testo, speaker) con un solo batch di embedding, una query di dedup e un solo add (thread di MemoryWriter)."""
         try:
-            res = collection.query(query_texts=[text], n_results=1, include=["distances"])
-            if res['documents'] and res['distances'][0][0] < DEDUPLICATION_THRESHOLD: return
-            collection.add(documents=[text], metadatas=[{"speaker": speaker, "timestamp": datetime.now().isoformat()}], ids=[str(uuid.uuid4())])
-            print(f"{Fore.BLACK}{Style.BRIGHT}   [💾 Saved]{Style.RESET_ALL}")
+            texts = [text for text, _ in entries]
+            vectors = embed_cache.embed(texts)
+            res = collection.query(query_embeddings=vectors, n_results=1, include=["distances"])
+            new = [i for i, dists in enumerate(res['distances']) if not (dists and dists[0] < DEDUPLICATION_THRESHOLD)]
+            if not new: return
+            now = datetime.now()
+            ids = [str(uuid.uuid4()) for _ in new]
+            collection.add(ids=ids, documents=[texts[i] for i in new], embeddings=[vectors[i] for i in new],
+                           metadatas=[{"speaker": entries[i][1], "timestamp": now.isoformat(), "ts": now.timestamp()} for i in new])
+            hot_index.add(ids, [texts[i] for i in new], [vectors[i] for i in new])
+            print(f"{Fore.BLACK}{Style.BRIGHT}   [💾 Saved {len(new)}]{Style.RESET_ALL}")
         except: pass
 
+    @staticmethod
+    def _stored_hits(vector, limit):
+        """Hot tier se basta (completo o k risultati tutti vicini), altrimenti Chroma: i risultati freddi salgono nel caldo."""
+        start = time.perf_counter()
+        hits, exact = hot_index.search(vector, limit)
+        if exact or (len(hits) == limit and hits[-1][1] < HOT_INDEX_ACCEPT):
+            hot_index.record(True, (time.perf_counter() - start) * 1000)
+            return hits
+        res = collection.query(query_embeddings=[vector], n_results=limit, include=["documents", "distances", "embeddings"])
+        hot_index.add(res['ids'][0], res['documents'][0], res['embeddings'][0])
+        hot_index.record(False, (time.perf_counter() - start) * 1000)
+        return list(zip(res['documents'][0], res['distances'][0]))
+
+    @staticmethod
+    def benchmark_delete(sizes=(1_000, 100_000, 1_000_000), dim=384):
+        """Tempi e picco di memoria Python di reset, forget_where e del vecchio get()+delete su store sintetici.
+        La metà più vecchia ha solo il "timestamp" ISO, come gli store nati prima di "ts": forget_where(until) paga il backfill.
+        Gira su una PersistentClient in una cartella temporanea, con la compattazione ferma; svuota il hot tier e la coda di scrittura."""
+        import tempfile, tracemalloc
+        global chroma_client, collection
+        saved, rng, lines = (chroma_client, collection), np.random.default_rng(0), []
+
+        def fill(n):
+            global collection, _ts_backfilled
+            try: chroma_client.delete_collection(MEMORY_COLLECTION)
+            except Exception: pass
+            collection = chroma_client.get_or_create_collection(name=MEMORY_COLLECTION)
+            now = time.time()
+            for start in range(0, n, MEMORY_DELETE_PAGE):
+                ids = range(start, min(start + MEMORY_DELETE_PAGE, n))
+                collection.add(ids=[f"bench-{i}" for i in ids], documents=[f"U: ricordo di prova numero {i}" for i in ids],
+                               embeddings=rng.standard_normal((len(ids), dim), dtype=np.float32),
+                               metadatas=[{"speaker": "ai" if i % 2 else "user", "timestamp": datetime.fromtimestamp(now - i).isoformat(),
+                                           **({} if i >= n // 2 else {"ts": now - i})} for i in ids])
+            _ts_backfilled = False
+            return now
+
+        def measure(fn):
+            tracemalloc.start()
+            start = time.perf_counter()
+            try: res = fn(); result = f"{time.perf_counter() - start:7.2f} s, picco {tracemalloc.get_traced_memory()[1] / 1e6:6.1f} MB ({res})"
+            except Exception as e: result = f"errore ({e})"
+            tracemalloc.stop()
+            return result
+
+        def legacy():
+            ids = collection.get()['ids']
+            if ids: collection.delete(ids=ids)
+            return f"{len(ids)} cancellati"
+
+        memory_compactor.stopped.set()  # Niente giri periodici: falserebbero i tempi, e in coda sul lock partirebbero all'uscita
+        try:
+            with memory_compactor.lock, tempfile.TemporaryDirectory(prefix="jarvis-bench-") as tmp:
+                chroma_client = chromadb.PersistentClient(path=tmp)
+                for n in sizes:
+                    t0 = time.perf_counter(); now = fill(n); fill_s = time.perf_counter() - t0
+                    lines.append(f"{n:>9} ricordi (inserimento {fill_s:.0f} s)")
+                    lines.append(f"  get()+delete       : {measure(legacy)}")
+                    if collection.count() != n: now = fill(n)  # Se il vecchio percorso fallisce lo store resta intatto
+                    lines.append(f"  forget_where(until): {measure(lambda: Memory.forget_where(until=now - n // 2 + 0.5))}")
+                    lines.append(f"  forget_where(ai)   : {measure(lambda: Memory.forget_where(speaker='ai'))}")
+                    fill(n); lines.append(f"  reset (drop+create): {measure(Memory.reset)}")
+                    print("\n".join(lines[-5:]))
+                chroma_client = None  # Rilascia i file prima della rimozione della cartella
+        finally:
+            chroma_client, collection = saved
+        return "\n".join(lines)
+
+    @staticmethod
+    def benchmark_search(queries, limit=3):
+        """Hot tier contro il solo Chroma: recall@k sui documenti e latenze p50."""
+        if collection is None or not queries: return "Niente da misurare."
+        tiered_ms, chroma_ms, found, expected = [], [], 0, 0
+        for vector in embed_cache.embed(queries):
+            start = time.perf_counter()
+            tiered = {doc for doc, _ in Memory._stored_hits(vector, limit)}
+            tiered_ms.append((time.perf_counter() - start) * 1000)
+            start = time.perf_counter()
+            truth = set(collection.query(query_embeddings=[vector], n_results=limit)['documents'][0])
+            chroma_ms.append((time.perf_counter() - start) * 1000)
+            found += len(truth & tiered); expected += len(truth)
+        return (f"recall@{limit} {found / max(expected, 1):.1%} | hot tier p50 {np.median(tiered_ms):.2f} ms"
+                f" | Chroma p50 {np.median(chroma_ms):.2f} ms ({len(queries)} query)")
+
     @staticmethod
     def search(query):
         try:
-            res = collection.query(query_texts=[query], n_results=3, include=["documents", "distances"])
-            return [doc for doc, dist in zip(res['documents'][0], res['distances'][0]) if dist < SIMILARITY_THRESHOLD]
+            vector = embed_cache.embed([query])[0]
+            hits = _merge_hits(Memory._stored_hits(vector, 3) + _pending_hits(vector), 3)
+            return [doc for doc, dist in hits if dist < SIMILARITY_THRESHOLD]
         except: return []
 
     @staticmethod
     def forget(query):
+        memory_writer.flush()  # Si può dimenticare anche ciò che era ancora in coda
         try:
-            res = collection.query(query_texts=[query], n_results=1)
+            res = collection.query(query_embeddings=embed_cache.embed([query]), n_results=1)
             if not res['ids'][0]: return "Nulla."
             collection.delete(ids=[res['ids'][0][0]])
+            hot_index.remove([res['ids'][0][0]])
             return "Cancellato."
         except: return "Errore."
 
+    @staticmethod
+    def _where(speaker=None, since=None, until=None):
+        """Filtro Chroma su speaker e su ts in [since, until) (datetime o epoch)."""
+        conds = [{"speaker": speaker}] if speaker else []
+        if since is not None: conds.append({"ts": {"$gte": since.timestamp() if isinstance(since, datetime) else since}})
+        if until is not None: conds.append({"ts": {"$lt": until.timestamp() if isinstance(until, datetime) else until}})
+        return None if not conds else conds[0] if len(conds) == 1 else {"$and": conds}
+
+    @staticmethod
+    def backfill_ts():
+        """Copia il vecchio "timestamp" ISO in "ts" numerico, a pagine di soli metadati: i filtri per data vedono solo ts."""
+        global _ts_backfilled
+        fixed, offset = 0, 0
+        while True:
+            res = collection.get(offset=offset, limit=MEMORY_DELETE_PAGE, include=["metadatas"])
+            if not res['ids']: break
+            offset += len(res['ids'])
+            legacy = [(id_, {**m, "ts": _entry_ts(m)}) for id_, m in zip(res['ids'], res['metadatas']) if m and m.get("ts") is None]
+            legacy = [(id_, m) for id_, m in legacy if not np.isnan(m["ts"])]  # Senza data leggibile resta fuori dai filtri per data
+            if legacy:
+                collection.update(ids=[id_ for id_, _ in legacy], metadatas=[m for _, m in legacy]); fixed += len(legacy)
+        _ts_backfilled = True
+        if fixed: print(f"{Fore.GREEN}🕰️ [DB] Data numerica aggiunta a {fixed} ricordi del vecchio formato.{Style.RESET_ALL}")
+        return fixed
+
+    @staticmethod
+    def forget_where(speaker=None, since=None, until=None):
+        """Dimentica in blocco per speaker e/o intervallo di tempo, a pagine di soli id."""
+        where = Memory._where(speaker, since, until)
+        if where is None: return Memory.reset()
+        memory_writer.flush()
+        deleted = 0
+        with memory_compactor.lock:  # Un giro a metà riscriverebbe i doppioni accorpati appena cancellati
+            try:
+                if (since is not None or until is not None) and not _ts_backfilled: Memory.backfill_ts()
+                while True:  # Ogni pagina cancellata esce dal filtro: si riparte sempre dall'inizio
+                    ids = collection.get(where=where, limit=MEMORY_DELETE_PAGE, include=[])['ids']
+                    if not ids: break
+                    collection.delete(ids=ids); hot_index.remove(ids); deleted += len(ids)
+                return f"Cancellati {deleted}."
+            except: return "Errore."
+
     @staticmethod
     def reset():
-        try:
-            ids = collection.get()['ids']
-            if ids: collection.delete(ids=ids)
-            return "Reset."
-        except: return "Errore."
+        """Drop e ricreazione della collection: costa uguale con mille o un milione di ricordi."""
+        global collection
+        memory_writer.discard()
+        with memory_compactor.lock:  # Un giro a metà scriverebbe sulla collection appena eliminata
+            try:
+                chroma_client.delete_collection(MEMORY_COLLECTION)
+                hot_index.clear()
+                collection = chroma_client.get_or_create_collection(name=MEMORY_COLLECTION)
+                return "Reset."
+            except: return "Errore."
 
-def get_time(): 
-    """Restituisce la data e l'ora attuali."""
-    return datetime.now().strftime("%A %d %B %Y, ore %H:%M")
-
-def calculate(expression): 
-    """Esegue calcoli matematici."""
-    try:
-        # 🟢 FIX SICUREZZA: Rimuove l'uso di eval(), mantiene solo i numeri e operatori base
-        clean_expression = re.sub(r'[^0-9+\-*/(). ]', '', expression)
-        return str(eval(clean_expression))
-    except: 
-        return "Errore di calcolo."
-
-def search_mem(query): 
-    """Cerca informazioni personali nel database."""
-    r = Memory.search(query); return "\n".join(r) if r else "Nessuna informazione personale trovata."
-
-def web_search(query):
-    """Esegue una ricerca su Google via API e restituisce un riassunto."""
-    if not WEB_SEARCH_ENABLED: 
-        return "Errore: Google Search API non configurata (mancano chiavi nel .env)."
-
-    print(f"{Fore.CYAN}🌐 Google Search API: '{query}'...{Style.RESET_ALL}")
-    url = "https://www.googleapis.com/customsearch/v1"
-    params = {
-        "key": GOOGLE_SEARCH_API_KEY,
-        "cx": GOOGLE_SEARCH_CX,
-        "q": query,
-        "num": 3, 
-        "gl": "it", 
-        "lr": "lang_it" 
-    }
-    
-    try:
-        response = requests.get(url, params=params, timeout=5)
-        response.raise_for_status() 
-        data = response.json()
-        items = data.get("items", [])
-        
-        if items:
-            results = [f"- {item.get('title')}: {item.get('snippet')}" for item in items]
-            return "\n".join(results)[:1500]
-        return "Nessun risultato trovato sul web."
-    except Exception as e:
-        print(f"{Fore.RED}❌ ERRORE GOOGLE API: {e}{Style.RESET_ALL}")
-        return "Errore durante la ricerca web."
+memory_writer = MemoryWriter(Memory.save_many)
 
-# ==========================================
-# SCHEMA OLLAMA DINAMICO
-# ==========================================
+# --- COMPATTAZIONE IN BACKGROUND ---
+def _entry_ts(meta):
+    """Epoch del ricordo: "ts" numerico, o il vecchio "timestamp" ISO (nan se manca)."""
+    if meta and meta.get("ts") is not None: return float(meta["ts"])
+    try: return datetime.fromisoformat(meta["timestamp"]).timestamp()
+    except Exception: return float("nan")
+
+_ts_backfilled = False  # Ogni ricordo ha "ts" numerico (dopo Memory.backfill_ts o un giro di compattazione)
+
+class MemoryCompactor:
+    """Ripulisce user_memories in background: turni oltre la retention e quasi-doppioni (coseno a blocchi) accorpati nel più recente."""
+    def __init__(self, delay=MEMORY_COMPACT_DELAY_S, interval=MEMORY_COMPACT_INTERVAL_S, block=MEMORY_COMPACT_BLOCK, window=MEMORY_COMPACT_WINDOW):
+        self.delay, self.interval, self.block, self.window = delay, interval, block, window
+        self.lock = threading.RLock()       # Un giro alla volta; lo prendono anche reset e forget_where (rientrante: il benchmark li chiama tenendolo)
+        self.last = None                    # Resoconto dell'ultimo giro
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self._run, daemon=True, name="jarvis-memory-compactor")
+        if collection is not None and interval: self.thread.start()
+        atexit.register(self.stopped.set)
+
+    def _run(self):
+        wait = self.delay
+        while not self.stopped.wait(wait):
+            try: self.compact()
+            except Exception as e: print(f"{Fore.RED}❌ Compattazione memoria fallita: {e}{Style.RESET_ALL}")
+            wait = self.interval
+
+    def _blocks(self):
+        """Pagine di (ids, vettori normalizzati, ts, metadati, vivi) in ordine di inserimento: in RAM solo la finestra."""
+        offset = 0
+        while True:
+            res = collection.get(offset=offset, limit=self.block, include=["embeddings", "metadatas"])
+            if not res['ids']: return
+            vectors = np.asarray(res['embeddings'], dtype=np.float32)
+            vectors /= np.maximum(np.linalg.norm(vectors, axis=1, keepdims=True), 1e-12)
+            metas = [m or {} for m in res['metadatas']]
+            yield res['ids'], vectors, np.array([_entry_ts(m) for m in metas]), metas, np.ones(len(res['ids']), dtype=bool)
+            offset += len(res['ids'])
+
+    @staticmethod
+    def _query_p50(probes):
+        times = []
+        for vector in probes:
+            start = time.perf_counter()
+            collection.query(query_embeddings=[vector.tolist()], n_results=3)
+            times.append((time.perf_counter() - start) * 1000)
+        return float(np.median(times)) if times else 0.0
+
+    def compact(self):
+        """Un giro completo. Ritorna (e ricorda) il resoconto: dimensione e latenza delle query prima e dopo."""
+        global _ts_backfilled
+        if collection is None: return "Errore DB."
+        with self.lock:
+            memory_writer.flush()  # Anche quel che è in coda partecipa al giro
+            start, before = time.perf_counter(), collection.count()
+            cutoffs = {s: time.time() - days * 86400 for s, days in MEMORY_RETENTION_DAYS.items() if days is not None}
+            drop, merged, aged, probes = [], {}, 0, []  # merged: id sopravvissuto -> (metadati, doppioni assorbiti)
+            legacy = []  # (id, metadati) dei ricordi con il solo "timestamp" ISO: a fine giro ricevono "ts"
+            window = deque(maxlen=self.window)  # Blocchi precedenti: ogni ricordo si confronta con i ~window*block vicini nel tempo
+            for block in self._blocks():
+                ids, vectors, ts, metas, alive = block
+                if len(probes) < MEMORY_COMPACT_PROBES: probes.extend(vectors[:MEMORY_COMPACT_PROBES - len(probes)])
+                for i, meta in enumerate(metas):
+                    if meta.get("ts") is None and not np.isnan(ts[i]):
+                        meta["ts"] = float(ts[i]); legacy.append((ids[i], meta))
+                    cutoff = cutoffs.get(meta.get("speaker"))
+                    if cutoff is not None and ts[i] < cutoff:  # nan (data ignota) non scade mai
+                        alive[i] = False; drop.append(ids[i]); aged += 1
+                for other in (*window, block):
+                    sims = vectors @ other[1].T  # Coseno: i vettori sono normalizzati
+                    if other is block: sims = np.triu(sims, k=1)
+                    for i, j in np.argwhere(sims >= MEMORY_DUP_SIMILARITY):
+                        if not (alive[i] and other[4][j]): continue
+                        # Resta il più recente (testo più aggiornato), l'altro sparisce
+                        newer = np.nan_to_num(ts[i], nan=-np.inf) >= np.nan_to_num(other[2][j], nan=-np.inf)
+                        (w_blk, w), (l_blk, l) = ((block, i), (other, j)) if newer else ((other, j), (block, i))
+                        l_blk[4][l] = False; drop.append(l_blk[0][l])
+                        absorbed = merged.pop(l_blk[0][l], (None, 0))[1] + l_blk[3][l].get("dups", 0) + 1
+                        meta, count = merged.get(w_blk[0][w], (w_blk[3][w], 0))
+                        merged[w_blk[0][w]] = (meta, count + absorbed)
+                window.append(block)
+            latency_before = self._query_p50(probes)
+            for i in range(0, len(drop), MEMORY_DELETE_PAGE):
+                page = drop[i:i + MEMORY_DELETE_PAGE]
+                collection.delete(ids=page); hot_index.remove(page)
+            # I sopravvissuti fusi portano già "ts" nei metadati; gli altri del vecchio formato si aggiornano a parte
+            dropped = set(drop)
+            updates = [(id_, {**meta, "dups": meta.get("dups", 0) + count}) for id_, (meta, count) in merged.items()]
+            updates += [(id_, meta) for id_, meta in legacy if id_ not in dropped and id_ not in merged]
+            for i in range(0, len(updates), MEMORY_DELETE_PAGE):
+                page = updates[i:i + MEMORY_DELETE_PAGE]
+                collection.update(ids=[id_ for id_, _ in page], metadatas=[meta for _, meta in page])
+            _ts_backfilled = True
+            after = collection.count()
+            self.last = (f"{before} -> {after} ricordi ({aged} scaduti, {len(drop) - aged} doppioni in {len(merged)} ricordi, {len(legacy)} date convertite)"
+                         f", query p50 {latency_before:.1f} -> {self._query_p50(probes):.1f} ms, {time.perf_counter() - start:.1f} s")
+            print(f"{Fore.GREEN}🧹 [DB] Compattazione: {self.last}{Style.RESET_ALL}")
+            return self.last
 
-TOOL_MAP = {"get_time": get_time, "calculate": calculate, "search_memory": search_mem}
-TOOLS_SCHEMA = [
-    {"type": "function", "function": {"name": "get_time", "description": "Restituisce la data e l'ora attuali.", "parameters": {"type": "object", "properties": {}, "required": []}}},
-    {"type": "function", "function": {"name": "calculate", "description": "Esegue calcoli matematici complessi o semplici.", "parameters": {"type": "object", "properties": {"expression": {"type": "string"}}, "required": ["expression"]}}},
-    {"type": "function", "function": {"name": "search_memory", "description": "Cerca informazioni o ricordi personali dell'utente nel database.", "parameters": {"type": "object", "properties": {"query": {"type": "string"}}, "required": ["query"]}}}
-]
+    def stats(self):
+        return f"compattazione: {self.last or 'mai'}"
+
+memory_compactor = MemoryCompactor()
+
+class Tools:
+    # Nome, descrizione e parametri visti dal modello nascono da @registry.tool, firma e docstring
+    @staticmethod
+    @registry.tool("get_time", timeout_s=1)
+    def get_time():
+        """Restituisce la data e l'ora attuali."""
+        return datetime.now().strftime("%A %d %B %Y, ore %H:%M")
+
+    @staticmethod
+    @registry.tool("calculate", timeout_s=1)
+    def calculate(expression: str):
+        """Esegue calcoli matematici complessi o semplici."""
+        try:
+            # 🟢 FIX SICUREZZA: Rimuove l'uso di eval(), mantiene solo i numeri e operatori base
+            clean_expression = re.sub(r'[^0-9+\-*/(). ]', '', expression)
+            return str(eval(clean_expression))
+        except: 
+            return "Errore di calcolo."
+
+    @staticmethod
+    @registry.tool("search_memory")
+    def search_memory(query: str):
+        """Cerca informazioni o ricordi personali dell'utente nel database."""
+        r = Memory.search(query); return "\n".join(r) if r else "Nessuna informazione personale trovata."
+
+    # 🟢 La ricerca web è registrata solo se le chiavi sono presenti
+    @staticmethod
+    @registry.tool("web_search", timeout_s=SEARCH_BUDGET_S + 1, enabled=WEB_SEARCH_ENABLED)
+    def web_search(query: str):
+        """Cerca informazioni aggiornate o generiche su internet (es. notizie, fatti recenti, definizioni)."""
+        print(f"{Fore.CYAN}🌐 Google Search API: '{query}'...{Style.RESET_ALL}")
+        # 🟢 Ricerca asincrona sul loop di servizio: niente attese bloccanti, risposta entro SEARCH_BUDGET_S
+        try:
+            return run_async(web_search_async(query))
+        except Exception as e:
+            print(f"{Fore.RED}❌ ERRORE GOOGLE API: {e}{Style.RESET_ALL}")
+            return "Errore durante la ricerca web."
 
-# 🟢 Aggiunge la ricerca web solo se le chiavi sono presenti
 if WEB_SEARCH_ENABLED:
-    TOOL_MAP["web_search"] = web_search
-    TOOLS_SCHEMA.append(
-        {"type": "function", "function": {"name": "web_search", "description": "Cerca informazioni aggiornate o generiche su internet (es. notizie, fatti recenti, definizioni).", "parameters": {"type": "object", "properties": {"query": {"type": "string"}}, "required": ["query"]}}}
-    )
     print(f"{Fore.YELLOW}🌐 Ricerca Web Caricata: Attiva!{Style.RESET_ALL}")
 else:
     print(f"{Fore.YELLOW}🌐 Ricerca Web: Disattivata (mancano chiavi nel .env).{Style.RESET_ALL}")
 
+TOOLS_SCHEMA = registry.schema()  # Generato una volta: identico a ogni richiesta (prefisso stabile per la cache)
+
+# ==========================================
+# 🧾 CONTESTO A BUDGET DI TOKEN
+# ==========================================
+
+def estimate_tokens(text):
+    """Stima veloce senza tokenizer: ~4 caratteri per token."""
+    return len(text) // 4 + 1
+
+def _gist(text, words):
+    """Prima frase del testo, tagliata a `words` parole (riassunto estrattivo)."""
+    first = re.split(r"(?<=[.!?])\s", text.strip(), maxsplit=1)[0].split()
+    return " ".join(first[:words]) + ("…" if len(first) > words else "")
+
+class ContextManager:
+    """Storia della conversazione entro un budget di token: i turni più vecchi confluiscono in un riassunto a scorrimento."""
+    def __init__(self, count, budget=CONTEXT_TOKEN_BUDGET, summary_budget=SUMMARY_TOKEN_BUDGET):
+        self.count = count              # Token di un messaggio (il formato dipende dal backend)
+        self.budget, self.summary_budget = budget, summary_budget
+        self.turns = deque()            # (messaggi, token, riga di riassunto)
+        self.summary = deque()          # (riga, token)
+        self.tokens = self.summary_tokens = self.folded = 0
+
+    def add_turn(self, messages, user_text, answer):
+        tokens = sum(self.count(m) for m in messages)
+        self.turns.append((list(messages), tokens, f"- U: {_gist(user_text, 20)} → AI: {_gist(answer, 30)}"))
+        self.tokens += tokens
+
+    def compact(self):
+        """Oltre il budget piega i turni vecchi fino a CONTEXT_TARGET_RATIO. True se la storia è cambiata."""
+        if self.tokens + self.summary_tokens <= self.budget: return False
+        while len(self.turns) > 1 and self.tokens + self.summary_tokens > self.budget * CONTEXT_TARGET_RATIO:
+            _, tokens, line = self.turns.popleft()
+            self.tokens -= tokens; self.folded += 1
+            self.summary.append((line, estimate_tokens(line))); self.summary_tokens += self.summary[-1][1]
+            while self.summary_tokens > self.summary_budget:
+                self.summary_tokens -= self.summary.popleft()[1]
+        return True
+
+    def messages(self):
+        return [m for msgs, _, _ in self.turns for m in msgs]
+
+    def summary_text(self):
+        return "\n".join(line for line, _ in self.summary)
+
+    def stats(self):
+        return f"{len(self.turns)} turni, ~{self.tokens + self.summary_tokens} token, {self.folded} piegati nel riassunto"
+
 # ==========================================
 # 🤖 CLASSE JARVIS BRAIN
 # ==========================================
 
+class OllamaError(Exception):
+    """Errore restituito da Ollama: status HTTP diverso da 200 o campo "error" nello stream."""
+
 class JarvisBrain:
     def __init__(self, model="llama3.2:1b"):
         self.model = model
-        self.history = []
+        self.context = ContextManager(count=lambda m: estimate_tokens(json.dumps(m, ensure_ascii=False)))
+        self._session, self._session_loop = None, None
+        self.conn_stats = {"new": 0, "reused": 0}  # Connessioni verso Ollama: aperte / riusate dal pool
+        self.turn_ms = deque(maxlen=100)  # Latenza degli ultimi turni LLM (richiesta -> fine stream)
+        self.use_tools = True  # Diventa False se il modello rifiuta i tool (400 "does not support tools")
 
     def _sanitize(self, args):
         # Ollama può a volte incapsulare gli argomenti in modo strano
@@ -154,71 +785,205 @@ class JarvisBrain:
         if len(args) == 1 and isinstance(list(args.values())[0], dict): return list(args.values())[0]
         return args
 
+    def _http(self):
+        """Sessione aiohttp legata al loop corrente (ricreata se il loop cambia)."""
+        loop = asyncio.get_running_loop()
+        if self._session is None or self._session.closed or self._session_loop is not loop:
+            self._close_session()
+            trace = aiohttp.TraceConfig()
+            trace.on_connection_create_end.append(self._count_conn("new"))
+            trace.on_connection_reuseconn.append(self._count_conn("reused"))
+            connector = aiohttp.TCPConnector(limit_per_host=OLLAMA_POOL_SIZE, keepalive_timeout=OLLAMA_IDLE_KEEPALIVE_S)
+            self._session, self._session_loop = aiohttp.ClientSession(connector=connector, trace_configs=[trace]), loop
+        return self._session
+
+    def _close_session(self):
+        """Chiude la sessione precedente sul suo loop (una sessione aiohttp non si usa da un altro loop)."""
+        session, loop = self._session, self._session_loop
+        if session is None or session.closed or loop.is_closed(): return
+        if loop.is_running(): asyncio.run_coroutine_threadsafe(session.close(), loop)
+        else:
+            try: loop.run_until_complete(session.close())
+            except RuntimeError: pass  # Questo thread ha già un loop attivo: le connessioni cadranno col loop vecchio
+
+    async def _post(self, messages):
+        """Apre lo stream della chat e controlla lo status; un modello senza tool si riprova subito senza."""
+        while True:
+            body = {"model": self.model, "messages": messages, "stream": True, "options": {"temperature": 0.7}, "keep_alive": OLLAMA_KEEP_ALIVE}
+            if self.use_tools: body["tools"] = TOOLS_SCHEMA
+            r = await self._http().post(OLLAMA_URL, json=body,
+                # Limite sulla singola lettura, non sulla risposta intera: le risposte lunghe non si troncano
+                timeout=aiohttp.ClientTimeout(total=None, sock_connect=OLLAMA_CONNECT_TIMEOUT, sock_read=OLLAMA_READ_TIMEOUT))
+            if r.status == 200: return r
+            try: error = (await r.json(content_type=None)).get("error") or r.reason
+            except Exception: error = r.reason
+            finally: r.release()
+            if self.use_tools and "does not support tools" in str(error):
+                print(f"{Fore.YELLOW}⚠️ {self.model} non supporta i tool: si prosegue senza.{Style.RESET_ALL}")
+                self.use_tools = False
+                continue
+            raise OllamaError(f"{r.status} {error}")
+
+    def _count_conn(self, kind):
+        async def on_event(session, ctx, params): self.conn_stats[kind] += 1
+        return on_event
+
+    def tool_stats(self):
+        return registry.stats()
+
+    def memory_stats(self):
+        return f"{embed_cache.stats()} | {memory_writer.stats()} | {hot_index.stats()} | {memory_compactor.stats()}"
+
+    def http_stats(self):
+        return f"Ollama {self.conn_stats['reused']} riusate/{self.conn_stats['new']} nuove | tool: {http_pool_stats()} | cache tool {tool_cache.stats()}"
+
     def think(self, user_text):
+        """Versione sincrona (compatibilità): stessa logica di athink."""
+        yield from iterate_async(self.athink(user_text))
+
+    async def athink(self, user_text):
+        t_turn = time.perf_counter()
         
-        # 1. PREPARAZIONE MESSAGGI
-        sys_msg = f"Sei Jarvis, un assistente IA. La data e l'ora attuali sono: {datetime.now().strftime('%d/%m/%Y %H:%M')}. Rispondi in italiano in modo conciso e utile."
-        messages = [{"role": "system", "content": sys_msg}]
-        messages.extend(self.history[-6:])
-        messages.append({"role": "user", "content": user_text})
-
-        # 2. CHIAMATA TOOL (Se la storia contiene messaggi, usa la chiamata tool per coerenza)
-        if len(self.history) > 0 or any(t in user_text.lower() for t in ["ora", "calcola", "ricordi", "cerca", "sai di me", "web"]):
-            
-            print(f"{Fore.MAGENTA}🧠 [Brain] Analisi Tool/History...{Style.RESET_ALL}")
-            
-            try:
-                # Prima chiamata per decidere se usare un tool
-                resp = requests.post(OLLAMA_URL, 
-                    json={"model": self.model, "messages": messages, "stream": False, "tools": TOOLS_SCHEMA, "options": {"temperature": 0.1}}, timeout=8).json()
-                
-                ai_msg = resp.get("message", {})
-                tool_calls = ai_msg.get("tool_calls", [])
-                
-                if tool_calls:
-                    messages.append(ai_msg)
-                    for tc in tool_calls:
-                        fname = tc["function"]["name"]
-                        fargs = self._sanitize(tc["function"]["arguments"])
-                        print(f"{Fore.YELLOW}🛠️ {fname}{fargs}{Style.RESET_ALL}")
-                        
-                        if fname in TOOL_MAP:
-                            try:
-                                res = TOOL_MAP[fname](**fargs)
-                            except TypeError:
-                                res = TOOL_MAP[fname]() # Chiamata senza argomenti se fallisce
-                            except Exception as e: 
-                                res = f"Errore esecuzione tool: {e}"
-                                
-                            messages.append({"role": "tool", "content": str(res)})
-                            
-            except Exception as e: 
-                print(f"{Fore.RED}❌ Errore Tool Call: {e}{Style.RESET_ALL}")
-
-        # 3. GENERAZIONE FINALE (STREAMING VELOCE)
-        full_resp = ""
+        # 1. PREPARAZIONE MESSAGGI: parte stabile (system + storia) prima, dati volatili (ora) solo in coda
+        if self.context.compact():
+            print(f"{Fore.BLACK}{Style.BRIGHT}   [🗜️ Contesto compattato: {self.context.stats()}]{Style.RESET_ALL}")
+        user_msg = {"role": "user", "content": f"[{datetime.now().strftime('%d/%m/%Y %H:%M')}] {user_text}"}
+        messages = [{"role": "system", "content": SYSTEM_PROMPT}]
+        if self.context.summary:
+            messages.append({"role": "system", "content": f"Riassunto della conversazione precedente:\n{self.context.summary_text()}"})
+        messages.extend(self.context.messages())
+        turn_start = len(messages)
+        messages.append(user_msg)
+        prompt_tokens, prompt_ms = 0, 0.0
+
+        # 2. UNICA CHIAMATA IN STREAMING CON TOOLS: il testo va subito al TTS, le tool_calls arrivano nello stesso stream
+        full_resp, round_text, done = "", "", False
         try:
-            # Seconda (o prima) chiamata per la risposta finale, sempre in streaming
-            r = requests.post(OLLAMA_URL, 
-                json={"model": self.model, "messages": messages, "stream": True, "options": {"temperature": 0.7}}, stream=True, timeout=30)
-            
-            for line in r.iter_lines():
-                if line:
+            for round_no in range(MAX_TOOL_ROUNDS + 1):
+                round_text, tool_calls, done = "", [], False
+                async with await self._post(messages) as r:
                     try:
-                        chunk = json.loads(line).get("message", {}).get("content", "").replace("<think>", "").replace("</think>", "")
-                        if chunk:
-                            full_resp += chunk
-                            yield chunk
-                    except json.JSONDecodeError:
-                        continue 
-        except requests.exceptions.Timeout:
+                        async for line in r.content:
+                            if line.strip():
+                                try:
+                                    data = json.loads(line)
+                                    if data.get("error"): raise OllamaError(data["error"])  # Errore a stream già aperto
+                                    msg = data.get("message", {})
+                                    tool_calls.extend(msg.get("tool_calls") or [])
+                                    chunk = msg.get("content", "").replace("<think>", "").replace("</think>", "")
+                                    if chunk:
+                                        round_text += chunk
+                                        yield chunk
+                                    if data.get("done"):
+                                        done = True
+                                        # Statistiche Ollama: con la cache contano solo i token non riusati
+                                        prompt_tokens += data.get("prompt_eval_count", 0)
+                                        prompt_ms += data.get("prompt_eval_duration", 0) / 1e6
+                                except json.JSONDecodeError:
+                                    continue 
+                    except (asyncio.CancelledError, GeneratorExit):
+                        # 🟢 BARGE-IN: chiude la connessione, così Ollama smette subito di decodificare token
+                        r.close()
+                        print(f"{Fore.BLACK}{Style.BRIGHT}   [✂️ Generazione interrotta dopo {len(full_resp + round_text)} caratteri]{Style.RESET_ALL}")
+                        raise
+                
+                full_resp += round_text
+                if not tool_calls or round_no == MAX_TOOL_ROUNDS: break
+                
+                # 3. TOOL RICHIESTI: si eseguono e si continua la stessa risposta con i risultati
+                messages.append({"role": "assistant", "content": round_text, "tool_calls": tool_calls})
+                calls = [(tc["function"]["name"], self._sanitize(tc["function"]["arguments"])) for tc in tool_calls]
+                for fname, fargs in calls: print(f"{Fore.YELLOW}🛠️ {fname}{fargs}{Style.RESET_ALL}")
+                # Dispatch dal registro: parallelo sul pool, ognuno entro la propria deadline
+                results = await asyncio.gather(*[registry.arun(fname, fargs) for fname, fargs in calls])
+                messages.extend({"role": "tool", "content": str(res)} for res in results)
+        except asyncio.TimeoutError:
             yield "Il modello Ollama ha impiegato troppo tempo per rispondere (Timeout)."
+        except OllamaError as e:
+            print(f"{Fore.RED}❌ Errore Ollama: {e}{Style.RESET_ALL}")
+            yield "Il modello Ollama ha restituito un errore. Controlla il terminale."
         except Exception as e: 
             print(f"{Fore.RED}❌ Errore Streaming: {e}{Style.RESET_ALL}")
 
-        # 4. SALVATAGGIO STORIA E MEMORIA
-        if full_resp:
-            self.history.append({"role": "user", "content": user_text})
-            self.history.append({"role": "assistant", "content": full_resp})
-            Memory.save(f"U: {user_text}", "user")
-            Memory.save(f"AI: {full_resp}", "ai")
\ No newline at end of file
+        self.turn_ms.append((time.perf_counter() - t_turn) * 1000)
+        print(f"{Fore.BLACK}{Style.BRIGHT}⏱️ Turno LLM: {self.turn_ms[-1]:.0f} ms (mediana {statistics.median(self.turn_ms):.0f} ms su {len(self.turn_ms)}) | prompt eval: {prompt_tokens} token in {prompt_ms:.0f} ms{Style.RESET_ALL}")
+
+        # 4. SALVATAGGIO STORIA E MEMORIA (solo risposte complete: una risposta troncata non è un ricordo)
+        if done and full_resp:
+            # Il turno (tool compresi) si salva così come è stato inviato: il prossimo prompt ne ripete il prefisso esatto
+            self.context.add_turn(messages[turn_start:] + [{"role": "assistant", "content": round_text}], user_text, full_resp)
+            memory_writer.submit([(f"U: {user_text}", "user"), (f"AI: {full_resp}", "ai")])
+
+    @staticmethod
+    def benchmark_turns(turns=7, long_turns=500, eval_ms=300, token_ms=10, tokens=20, kb_ms=2.0):
+        """Turni veri di athink contro un /api/chat finto sul loop di servizio: misura il percorso client senza modello né GPU.
+        Prima eval_ms fissi di valutazione del prompt per richiesta e `tokens` parole ogni token_ms: primo testo e totale di
+        risposte semplici e con un tool (get_time), richieste per turno e riuso delle connessioni verso "Ollama".
+        Poi una sessione di long_turns turni con valutazione proporzionale alla richiesta (kb_ms per KB): la latenza deve
+        assestarsi con la compattazione del contesto. I turni del benchmark non finiscono nella memoria a lungo termine."""
+        import contextlib, io, types, tracemalloc
+        from aiohttp import web
+        global OLLAMA_URL, memory_writer
+        state = {"eval_ms": eval_ms, "kb_ms": 0.0, "requests": 0}
+
+        async def chat(request):
+            body = await request.read()
+            state["requests"] += 1
+            last = json.loads(body)["messages"][-1]
+            await asyncio.sleep((state["eval_ms"] + state["kb_ms"] * len(body) / 1024) / 1000)
+            resp = web.StreamResponse(); await resp.prepare(request)
+            async def send(data): await resp.write(json.dumps(data).encode() + b"\n")
+            if last["role"] == "user" and "ore sono" in last["content"]:
+                await send({"message": {"role": "assistant", "content": "", "tool_calls": [{"function": {"name": "get_time", "arguments": {}}}]}, "done": False})
+            else:
+                for i in range(tokens):
+                    await send({"message": {"role": "assistant", "content": f"parola{i} "}, "done": False})
+                    await asyncio.sleep(token_ms / 1000)
+            await send({"done": True, "prompt_eval_count": len(body) // 4, "prompt_eval_duration": 0})
+            return resp
+
+        async def start():
+            app = web.Application(); app.router.add_post("/api/chat", chat)
+            runner = web.AppRunner(app); await runner.setup()
+            await web.TCPSite(runner, "127.0.0.1", 0).start()
+            return runner, runner.addresses[0][1]
+
+        async def turn(brain, text):
+            t0, first = time.perf_counter(), None
+            async for _ in brain.athink(text):
+                if first is None: first = (time.perf_counter() - t0) * 1000
+            return first, (time.perf_counter() - t0) * 1000
+
+        runner, port = run_async(start())
+        saved, lines = (OLLAMA_URL, memory_writer), []
+        OLLAMA_URL = f"http://127.0.0.1:{port}/api/chat"
+        memory_writer = types.SimpleNamespace(submit=lambda entries: None)
+        try:
+            brain = JarvisBrain()
+            lines.append(f"Ollama finto: {eval_ms} ms di valutazione per richiesta, {tokens} token ogni {token_ms} ms")
+            for name, text in [("risposta semplice", "Raccontami qualcosa"), ("con tool", "Che ore sono adesso?")]:
+                before = state["requests"]
+                with contextlib.redirect_stdout(io.StringIO()):  # Niente riga di log per turno
+                    runs = [run_async(turn(brain, text)) for _ in range(turns)]
+                lines.append(f"  {name:17s}: primo testo {statistics.median(r[0] for r in runs):4.0f} ms, totale {statistics.median(r[1] for r in runs):4.0f} ms "
+                             f"(mediana su {turns}, {(state['requests'] - before) / turns:.0f} richieste/turno)")
+            lines.append(f"  connessioni: {brain.conn_stats['new']} nuove, {brain.conn_stats['reused']} riusate")
+            brain._close_session()
+
+            state.update(eval_ms=0, kb_ms=kb_ms)
+            brain, latency = JarvisBrain(), []
+            tracemalloc.start()
+            with contextlib.redirect_stdout(io.StringIO()):
+                for i in range(long_turns):
+                    latency.append(run_async(turn(brain, f"Domanda numero {i}: " + "parliamo ancora un po' " * 5))[1])
+            current, peak = tracemalloc.get_traced_memory(); tracemalloc.stop()
+            lines.append(f"Sessione di {long_turns} turni, valutazione {kb_ms} ms per KB di richiesta:")
+            for lo in sorted({0, 40, long_turns // 2 - 10, long_turns - 10}):
+                if 0 <= lo <= long_turns - 10: lines.append(f"  turni {lo + 1:>3}-{lo + 10:<3}: {statistics.mean(latency[lo:lo + 10]):4.0f} ms")
+            lines.append(f"  memoria Python a fine sessione {current / 1024:.0f} KiB (picco {peak / 1024:.0f} KiB), contesto {brain.context.stats()}")
+            brain._close_session()
+        finally:
+            OLLAMA_URL, memory_writer = saved
+            run_async(runner.cleanup())
+        print("\n".join(lines))
+        return "\n".join(lines)
@@ -0,0 +1,388 @@
+# Sintesi vocale (pool WebSocket verso VibeVoice + cache audio) e segmentazione del testo in frasi.
+# Nessun modello caricato all'import: si usa (e si testa) senza torch, Whisper o PyAudio.
+import asyncio
+import websockets
+import urllib.parse
+import os
+import time
+import re
+import json
+import hashlib
+import mmap
+import unicodedata
+from collections import deque, OrderedDict
+from colorama import Fore, Style
+
+# CONFIGURAZIONE TTS
+SERVER_URL = "ws://127.0.0.1:8000/stream"
+VOICE_NAME = "it-Spk1_man" 
+SAMPLE_RATE = 24000 
+TTS_PROTOCOL = "auto"       # "persistent": messaggi JSON su connessione calda | "query": una connessione per frase (demo VibeVoice) | "auto": prova e ripiega
+                            # ("auto" ripiega solo se una connessione nuova si chiude senza audio, mai per un audio lento)
+TTS_POOL_SIZE = 2           # Connessioni calde tenute aperte verso il server TTS
+TTS_CONNECT_TIMEOUT = 3
+SEG_FIRST_CLAUSE_WORDS = 14 # La prima frase parte comunque dopo N parole (anticipa il primo audio)
+SEG_MIN_CLAUSE_WORDS = 4    # ...oppure alla prima virgola dopo almeno N parole
+SEG_SKIP_MAX_CHARS = 120    # Un "<" o "{" non chiuso entro tanto (o prima di fine frase) non era un tag: il testo si parla
+PING_TIMEOUT = 10
+
+# CACHE TTS
+TTS_CACHE_DIR = "tts_cache"
+TTS_CACHE_MEM_MB = 32       # Livello in memoria (LRU)
+TTS_CACHE_DISK_MB = 256     # Livello su disco: oltre si eliminano le frasi usate meno di recente
+TTS_CACHE_MAX_CHARS = 160   # Le frasi più lunghe raramente si ripetono: non vengono salvate
+TTS_CACHE_CHUNK = 9600      # Byte per blocco in riproduzione dalla cache (200 ms)
+
+# ==========================================
+# 🗣️ CLIENT TTS (connessioni WebSocket calde)
+# ==========================================
+
+class TTSCache:
+    """Cache dell'audio TTS indirizzata per contenuto: LRU in memoria + PCM grezzo su disco (letto via mmap)."""
+    def __init__(self, directory=TTS_CACHE_DIR):
+        self.dir = directory
+        os.makedirs(self.dir, exist_ok=True)
+        self.mem = OrderedDict()   # chiave -> bytes PCM
+        self.mem_bytes = 0
+        self.disk = OrderedDict()  # chiave -> dimensione, dal meno al più recente
+        files = [f for f in os.listdir(self.dir) if f.endswith(".pcm")]
+        for f in sorted(files, key=lambda f: os.path.getmtime(os.path.join(self.dir, f))):
+            self.disk[f[:-4]] = os.path.getsize(os.path.join(self.dir, f))
+        self.disk_bytes = sum(self.disk.values())
+        self.hits_mem = self.hits_disk = self.misses = 0
+
+    @staticmethod
+    def key(text, voice=VOICE_NAME, rate=SAMPLE_RATE):
+        norm = " ".join(unicodedata.normalize("NFC", text).split()).casefold()
+        return hashlib.sha1(f"{norm}|{voice}|{rate}".encode("utf-8")).hexdigest()
+
+    def _path(self, key):
+        return os.path.join(self.dir, key + ".pcm")
+
+    def _remember(self, key, pcm):
+        if key in self.mem: self.mem_bytes -= len(self.mem.pop(key))
+        self.mem[key] = pcm; self.mem_bytes += len(pcm)
+        while self.mem_bytes > TTS_CACHE_MEM_MB * 1024 * 1024 and len(self.mem) > 1:
+            self.mem_bytes -= len(self.mem.popitem(last=False)[1])
+
+    def get(self, text):
+        """Restituisce un iteratore di blocchi PCM se la frase è in cache, altrimenti None."""
+        key = self.key(text)
+        if key in self.mem:
+            self.hits_mem += 1
+            self.mem.move_to_end(key)
+            pcm = self.mem[key]
+            return (pcm[i:i + TTS_CACHE_CHUNK] for i in range(0, len(pcm), TTS_CACHE_CHUNK))
+        if key in self.disk:
+            self.hits_disk += 1
+            self.disk.move_to_end(key)
+            try: os.utime(self._path(key))
+            except OSError: pass
+            return self._read_mmap(key)
+        self.misses += 1
+        return None
+
+    def _read_mmap(self, key):
+        with open(self._path(key), "rb") as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            size = len(mm)
+            for i in range(0, size, TTS_CACHE_CHUNK): yield mm[i:i + TTS_CACHE_CHUNK]
+            # Le frasi lette dal disco salgono nel livello in memoria
+            if size <= TTS_CACHE_MEM_MB * 1024 * 1024 // 8: self._remember(key, mm[:])
+
+    def put(self, text, pcm):
+        if not pcm or len(text) > TTS_CACHE_MAX_CHARS: return
+        key = self.key(text)
+        self._remember(key, pcm)
+        if key in self.disk: return
+        tmp = self._path(key) + ".tmp"
+        try:
+            with open(tmp, "wb") as f: f.write(pcm)
+            os.replace(tmp, self._path(key))
+        except OSError as e:
+            print(f"{Fore.YELLOW}⚠️ Cache TTS non scrivibile: {e}{Style.RESET_ALL}"); return
+        self.disk[key] = len(pcm); self.disk_bytes += len(pcm)
+        while self.disk_bytes > TTS_CACHE_DISK_MB * 1024 * 1024 and len(self.disk) > 1:
+            old, size = self.disk.popitem(last=False)
+            self.disk_bytes -= size
+            try: os.remove(self._path(old))
+            except OSError: pass
+
+    def stats(self):
+        total = self.hits_mem + self.hits_disk + self.misses
+        rate = (self.hits_mem + self.hits_disk) / total * 100 if total else 0
+        return f"hit {rate:.0f}% (mem {self.hits_mem}, disco {self.hits_disk}, miss {self.misses}), {len(self.disk)} frasi / {self.disk_bytes / 1e6:.1f} MB su disco"
+
+class TTSProtocolError(Exception):
+    """Il server non parla il protocollo a messaggi su connessione persistente."""
+
+class TTSClient:
+    """Client VibeVoice con un piccolo pool di connessioni calde; ripiega sul protocollo a query-string se il server non lo supporta."""
+    def __init__(self, url=SERVER_URL, voice=VOICE_NAME, cache=None):
+        self.url, self.voice, self.cache = url, voice, cache
+        self.mode = TTS_PROTOCOL
+        self.idle = deque()                             # Connessioni calde libere
+        self.slots = asyncio.Semaphore(TTS_POOL_SIZE)   # Una per connessione in uso: restituirla o scartarla sveglia chi attende
+        self.open_conns = 0
+        self.handshakes = 0
+        self.requests = 0
+
+    async def _connect(self, url):
+        ws = await websockets.connect(url, ping_timeout=PING_TIMEOUT, open_timeout=TTS_CONNECT_TIMEOUT)
+        self.handshakes += 1
+        return ws
+
+    async def _acquire(self, fresh=False):
+        """Connessione per una frase: una calda libera o, con fresh (o nessuna calda), una nuova."""
+        await self.slots.acquire()
+        while self.idle:
+            ws = self.idle.popleft()
+            if ws.close_code is None and not fresh: return ws  # Ancora aperta
+            self.open_conns -= 1
+            # Con fresh le calde sono coetanee di una appena scaduta lato server: si chiudono anche loro
+            if ws.close_code is None: asyncio.ensure_future(ws.close())
+        # Nessuna calda libera: con lo slot preso le connessioni aperte restano entro TTS_POOL_SIZE
+        try: ws = await self._connect(self.url)
+        except BaseException: self.slots.release(); raise
+        self.open_conns += 1
+        return ws
+
+    def _release(self, ws):
+        """Frase completa: la connessione torna calda nel pool."""
+        self.idle.append(ws)
+        self.slots.release()
+
+    def _discard(self, ws):
+        """Connessione caduta o con audio residuo: si chiude e lo slot si libera (sveglia chi attende)."""
+        self.open_conns -= 1
+        self.slots.release()
+        asyncio.ensure_future(ws.close())
+
+    async def warm(self):
+        """Apre in anticipo una connessione, così la prima frase non paga l'handshake."""
+        if self.mode == "query": return
+        try: self._release(await self._acquire())
+        except Exception as e: print(f"{Fore.YELLOW}⚠️ TTS non raggiungibile in anticipo: {e}{Style.RESET_ALL}")
+
+    async def synthesize(self, text):
+        """Generatore asincrono dei byte PCM della frase: prima la cache, poi il server."""
+        self.requests += 1
+        cached = self.cache.get(text) if self.cache else None
+        if cached is not None:
+            for pcm in cached: yield pcm
+            return
+        chunks = []
+        async for pcm in self._synthesize_server(text):
+            chunks.append(pcm); yield pcm
+        # Si arriva qui solo se la frase è completa: un barge-in chiude il generatore prima e una
+        # connessione caduta prima dell'evento di fine solleva ConnectionError
+        if self.cache: self.cache.put(text, b"".join(chunks))
+
+    async def prewarm(self, phrases):
+        """Sintetizza in background le frasi note non ancora presenti nella cache."""
+        for phrase in phrases:
+            # Stessa segmentazione di speak_stream, così le chiavi coincidono con le frasi pronunciate
+            segmenter = SentenceSegmenter()
+            for text in segmenter.feed(phrase) + [segmenter.flush()]:
+                if not text or self.cache is None or self.cache.key(text) in self.cache.disk: continue
+                try:
+                    self.cache.put(text, b"".join([pcm async for pcm in self._synthesize_server(text)]))
+                except Exception as e:
+                    print(f"{Fore.YELLOW}⚠️ Pre-riscaldamento cache TTS interrotto: {e}{Style.RESET_ALL}"); return
+
+    async def _synthesize_server(self, text):
+        if self.mode != "query":
+            try:
+                async for pcm in self._synthesize_persistent(text): yield pcm
+                return
+            except TTSProtocolError:
+                print(f"{Fore.YELLOW}⚠️ Il server TTS non supporta connessioni persistenti: uso una connessione per frase.{Style.RESET_ALL}")
+                self.mode = "query"
+                await self.close()
+        async for pcm in self._synthesize_query(text): yield pcm
+
+    async def _synthesize_persistent(self, text, retry=True):
+        ws = await self._acquire(fresh=not retry)
+        done, got_audio = False, False
+        try:
+            try:
+                await ws.send(json.dumps({"text": text, "voice": self.voice}))
+            except websockets.ConnectionClosed:
+                # Connessione scaduta lato server: riconnessione trasparente
+                done = True; self._discard(ws)
+                if not retry: raise TTSProtocolError() if self.mode == "auto" else ConnectionError("Server TTS non raggiungibile.")
+                async for pcm in self._synthesize_persistent(text, retry=False): yield pcm
+                return
+            while True:
+                # Nessun timeout sul primo audio: GPU fredda o frase lunga non dicono nulla sul protocollo
+                try: msg = await ws.recv()
+                except websockets.ConnectionClosed:
+                    done = True; self._discard(ws)
+                    if not got_audio and retry:
+                        # Chiusa senza rispondere: di solito una calda scaduta lato server, si riprova su una nuova
+                        async for pcm in self._synthesize_persistent(text, retry=False): yield pcm
+                        return
+                    # Anche una connessione nuova si chiude senza audio: il server non parla il protocollo a messaggi
+                    if not got_audio and self.mode == "auto": raise TTSProtocolError()
+                    # Chiusa prima dell'evento di fine: la frase è troncata e non deve arrivare in cache
+                    raise ConnectionError("Frase TTS interrotta dal server.")
+                if isinstance(msg, bytes):
+                    got_audio = True
+                    yield msg
+                elif self._is_end(msg):
+                    done = True
+                    if self.mode == "auto": self.mode = "persistent"
+                    self._release(ws)
+                    return
+        finally:
+            # Frase interrotta a metà (barge-in): il resto dell'audio non deve finire nella prossima richiesta
+            if not done: self._discard(ws)
+
+    @staticmethod
+    def _is_end(msg):
+        try: return json.loads(msg).get("event") in ("end", "done")
+        except: return False
+
+    async def _synthesize_query(self, text):
+        url = f"{self.url}?{urllib.parse.urlencode({'text': text, 'voice': self.voice})}"
+        async with await self._connect(url) as ws:
+            async for msg in ws:
+                if isinstance(msg, bytes): yield msg
+
+    def stats(self):
+        return f"{self.requests} frasi, {self.handshakes} handshake ({self.mode})"
+
+    async def close(self):
+        while self.idle:
+            self.open_conns -= 1
+            await self.idle.popleft().close()
+
+async def text_chunks(*texts):
+    """Adatta un testo fisso all'interfaccia asincrona di speak_stream."""
+    for text in texts: yield text
+
+# ==========================================
+# ✂️ SEGMENTAZIONE INCREMENTALE (testo -> frasi per il TTS)
+# ==========================================
+
+ABBREVIATIONS = {"es", "ecc", "sig", "sigg", "dott", "prof", "ing", "avv", "arch", "geom", "rag",
+                 "egr", "gent", "pag", "pagg", "art", "cap", "cfr", "n", "nr", "num", "tel", "fig", "vol", "ca", "st", "dr", "mr", "ms"}
+SENTENCE_END = ".!?…"
+CLAUSE_END = ",;:"
+CLOSERS = "\"'»”’)]"
+
+class SentenceSegmenter:
+    """Segmentatore incrementale: esamina solo i caratteri nuovi di ogni chunk (O(chunk) per token)."""
+    def __init__(self, skip=""):
+        self.skip = dict(zip(skip[::2], skip[1::2]))  # Coppie di delimitatori da scartare, es. "{}" o "<>"
+        self.closing = None
+        self.skipped = []           # Caratteri dello span aperto (delimitatore incluso), restituiti se non si chiude
+        self.first = True           # Nessuna frase ancora emessa: si può anticipare la prima
+        self._reset()
+
+    def _reset(self):
+        self.out = []               # Caratteri della frase corrente
+        self.word_start = 0
+        self.words = 0
+        self.after_end = False      # Ultimo carattere utile = fine frase valida
+        self.after_clause = False
+
+    def _boundary(self):
+        text = "".join(self.out).strip()
+        if len(text) <= 5: return None   # Troppo corta ("Sì."): si unisce alla successiva
+        self._reset()
+        self.first = False
+        return text
+
+    def feed(self, chunk):
+        """Aggiunge un pezzo di testo e restituisce le frasi complete (eventualmente nessuna)."""
+        ready = []
+        for c in chunk:
+            if self.closing:
+                if c == self.closing:
+                    self.closing = None; self.skipped = []; continue
+                # "x < 5 allora ... . Poi": a fine frase, a capo o dopo SEG_SKIP_MAX_CHARS lo span non era un tag
+                if c == "\n" or len(self.skipped) >= SEG_SKIP_MAX_CHARS or (c.isspace() and self.skipped[-1] in SENTENCE_END):
+                    self._release(ready)
+                else:
+                    self.skipped.append(c); continue
+            elif c in self.skip:
+                self.closing = self.skip[c]; self.skipped = [c]; continue
+            self._put(c, ready)
+        return ready
+
+    def _release(self, ready):
+        """Lo span aperto torna testo normale (il delimitatore compreso)."""
+        skipped, self.closing, self.skipped = self.skipped, None, []
+        for c in skipped: self._put(c, ready)
+
+    def _put(self, c, ready):
+        if c.isspace():
+            if not self.out: return
+            if self.out[-1] != " ":
+                self.words += 1
+                sentence = None
+                if c == "\n" or self.after_end:
+                    sentence = self._boundary()
+                elif self.first and (self.words >= SEG_FIRST_CLAUSE_WORDS or (self.after_clause and self.words >= SEG_MIN_CLAUSE_WORDS)):
+                    # Prima frase lunga: si parte a una virgola (o dopo N parole) per anticipare il primo audio
+                    sentence = self._boundary()
+                if sentence:
+                    ready.append(sentence); return
+                self.out.append(" ")
+                self.word_start = len(self.out)
+            return
+
+        self.out.append(c)
+        if c in SENTENCE_END:
+            word = "".join(self.out[self.word_start:-1]).lower().strip(CLOSERS + "(").rstrip(SENTENCE_END)
+            # "es.", "Dott.", iniziali puntate e sigle non chiudono la frase ("3.5" non ha spazio dopo il punto)
+            self.after_end = not (c == "." and (word in ABBREVIATIONS or (len(word) == 1 and word.isalpha()) or "." in word))
+        elif c not in CLOSERS:
+            self.after_end = False
+        self.after_clause = c in CLAUSE_END
+
+    def flush(self):
+        """Fine dello stream: restituisce il testo rimasto (se c'è), compreso uno span mai chiuso."""
+        ready = []
+        if self.closing: self._release(ready)
+        text = " ".join(ready + ["".join(self.out).strip()]).strip()
+        self._reset()
+        return text
+
+def benchmark_segmenter(repeat=200):
+    """Confronta il vecchio segmentatore (concatenazione + re.sub) con quello incrementale su risposte lunghe."""
+    import random
+    text = ("Certo, ecco il riepilogo della giornata di oggi con tutti i dettagli che mi hai chiesto. Alle 14:30 hai la riunione "
+            "con il Dott. Rossi, es. per parlare del budget di 3.5 milioni e del margine del 12,5% previsto. Poi, verso sera, "
+            "la temperatura scenderà a 7.2 gradi! Ricordati di comprare pane, latte, uova ecc. prima di tornare a casa. "
+            "Vuoi che imposti un promemoria? ") * 6
+    rnd = random.Random(0)
+    tokens, i = [], 0
+    while i < len(text):
+        n = rnd.randint(1, 6); tokens.append(text[i:i + n]); i += n
+
+    def legacy(tokens):
+        out, sentence_buffer, first_at = [], "", None
+        for k, chunk in enumerate(tokens):
+            chunk = re.sub(r'\{.*?\}', '', chunk)
+            sentence_buffer += chunk
+            if any(sentence_buffer.strip().endswith(s) for s in [".", "!", "?", "\n"]) and len(sentence_buffer) > 5:
+                out.append(sentence_buffer.strip()); sentence_buffer = ""
+                if first_at is None: first_at = k
+        return out, first_at
+
+    def incremental(tokens):
+        seg, out, first_at = SentenceSegmenter(skip="{}"), [], None
+        for k, chunk in enumerate(tokens):
+            ready = seg.feed(chunk)
+            if ready and first_at is None: first_at = k
+            out.extend(ready)
+        return out + [seg.flush()], first_at
+
+    print(f"{Fore.CYAN}📊 Benchmark segmentatore ({len(tokens)} token, {len(text)} caratteri){Style.RESET_ALL}")
+    for name, fn in [("vecchio", legacy), ("incrementale", incremental)]:
+        t0 = time.perf_counter()
+        for _ in range(repeat): out, first_at = fn(tokens)
+        us = (time.perf_counter() - t0) / repeat / len(tokens) * 1e6
+        print(f"  {name:13s}: {us:.2f} µs/token | prima frase al token {first_at} | {len(out)} frasi")
+        print(f"    1ª: {out[0]!r}\n    2ª: {out[1]!r}")
@@ -16,6 +16,7 @@ google-genai
 python-dotenv
 chromadb
 requests
+aiohttp
 pyaudio
 SpeechRecognition
 faster-whisper
@@ -82,11 +83,13 @@ def select_and_copy_version():
         source_dir = os.path.join(VERSIONS_PATH, "Gemini")
         brain_source = "jarvis_brain.py"
         client_source = "jarvis_client.py"
+        module_sources = ["jarvis_tts.py", "jarvis_web.py"]
         mode = "GEMINI"
     elif version == '2':
         source_dir = os.path.join(VERSIONS_PATH, "Ollama")
         brain_source = "jarvis_brain_ollama.py"
         client_source = "jarvis_client_ollama.py"
+        module_sources = ["jarvis_tts_ollama.py", "jarvis_web_ollama.py"]
         mode = "OLLAMA"
     else:
         print(f"{Fore.RED}Selezione non valida. Annullamento setup.{Style.RESET_ALL}")
@@ -97,7 +100,7 @@ def select_and_copy_version():
     DEST_CLIENT = "jarvis_client.py"
 
     # Verifica che i file esistano nella cartella di origine
-    if not (os.path.exists(os.path.join(source_dir, brain_source)) and os.path.exists(os.path.join(source_dir, client_source))):
+    if not all(os.path.exists(os.path.join(source_dir, f)) for f in [brain_source, client_source] + module_sources):
         print(f"{Fore.RED}❌ ERRORE: Impossibile trovare i file in {source_dir}. Controlla la struttura delle cartelle 'Versions/...'!{Style.RESET_ALL}")
         sys.exit(1)
 
@@ -105,6 +108,8 @@ def select_and_copy_version():
     try:
         shutil.copy(os.path.join(source_dir, brain_source), DEST_BRAIN)
         shutil.copy(os.path.join(source_dir, client_source), DEST_CLIENT)
+        # Moduli importati da brain e client (TTS, tool web): si copiano con il loro nome
+        for module in module_sources: shutil.copy(os.path.join(source_dir, module), module)
         print(f"{Fore.GREEN}✅ Versione '{mode}' copiata e standardizzata come '{DEST_BRAIN}' e '{DEST_CLIENT}'.{Style.RESET_ALL}")
         return mode
     except Exception as e:
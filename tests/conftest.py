@@ -0,0 +1,37 @@
+import importlib
+import os
+import sys
+import tempfile
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+for version in ("Ollama", "Gemini"):
+    sys.path.insert(0, os.path.join(ROOT, "Versions", version))
+
+# Solo i moduli leggeri: client e brain completi caricano Silero, Whisper, PyAudio e Chroma all'import
+CLIENTS = ["jarvis_tts_ollama", "jarvis_tts"]
+BRAINS = ["jarvis_web_ollama", "jarvis_web"]
+
+
+def pytest_configure(config):
+    # La cache dei tool scrive tool_cache.json nella cartella corrente
+    os.chdir(tempfile.mkdtemp(prefix="jarvis-tests-"))
+
+
+def load(name):
+    """Importa un modulo Jarvis, saltando il test se mancano le dipendenze (websockets, aiohttp, ...)."""
+    try:
+        return importlib.import_module(name)
+    except (ImportError, SystemExit) as e:
+        pytest.skip(f"{name}: {e}")
+
+
+@pytest.fixture(params=CLIENTS)
+def client(request):
+    return load(request.param)
+
+
+@pytest.fixture(params=BRAINS)
+def brain(request):
+    return load(request.param)
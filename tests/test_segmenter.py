@@ -0,0 +1,34 @@
+def segment(client, text, skip="{}<>", step=3):
+    seg, out = client.SentenceSegmenter(skip=skip), []
+    for i in range(0, len(text), step):
+        out += seg.feed(text[i:i + step])
+    rest = seg.flush()
+    return out + ([rest] if rest else [])
+
+
+def test_sentences_and_abbreviations(client):
+    text = "Alle 14:30 hai la riunione con il Dott. Rossi. Poi la temperatura scenderà a 7.2 gradi! Ok?"
+    assert segment(client, text, skip="{}") == [
+        "Alle 14:30 hai la riunione con il Dott. Rossi.",
+        "Poi la temperatura scenderà a 7.2 gradi!",
+        "Ok?",
+    ]
+
+
+def test_tags_are_skipped(client):
+    text = 'Ciao <break time="0.5s"/> a tutti. Bene {"tool": "x"} fatto.'
+    assert segment(client, text) == ["Ciao a tutti.", "Bene fatto."]
+
+
+def test_unmatched_opener_is_spoken(client):
+    text = "Se x < 5 allora il risultato è corretto. Poi controlliamo il resto."
+    assert segment(client, text) == ["Se x < 5 allora il risultato è corretto.", "Poi controlliamo il resto."]
+
+
+def test_unclosed_span_at_end_of_stream(client):
+    assert segment(client, "Il valore è { aperto senza chiusura") == ["Il valore è { aperto senza chiusura"]
+
+
+def test_long_unclosed_span_is_released(client):
+    text = "Vale " + "<" + "parola " * 30 + "fine"
+    assert " ".join(segment(client, text)) == text
@@ -0,0 +1,155 @@
+import asyncio
+import json
+import os
+import urllib.parse
+
+import pytest
+
+websockets = pytest.importorskip("websockets")
+
+PCM = b"\x01\x00" * 480
+
+
+class StandInServer:
+    """Server TTS locale al posto di VibeVoice: per ogni messaggio JSON due blocchi PCM e l'evento di fine.
+    Il testo "TRONCA" riceve un solo blocco e poi la connessione si chiude.
+    query_only: come la demo VibeVoice, audio solo per ?text= e chiusura senza risposta ai messaggi JSON.
+    drop_first: la prima connessione si chiude al primo messaggio senza rispondere (calda scaduta lato server)."""
+    def __init__(self, delay=0.0, query_only=False, drop_first=False):
+        self.delay, self.query_only, self.drop_first = delay, query_only, drop_first
+        self.connections = 0
+
+    async def handler(self, ws, *_):
+        self.connections += 1
+        path = ws.request.path if hasattr(ws, "request") else ws.path
+        text = urllib.parse.parse_qs(urllib.parse.urlparse(path).query).get("text")
+        if self.query_only and text:
+            await asyncio.sleep(self.delay)
+            await ws.send(PCM); await ws.send(PCM)
+            return
+        async for msg in ws:
+            if self.query_only or (self.drop_first and self.connections == 1):
+                await ws.close(); return
+            text = json.loads(msg)["text"]
+            await ws.send(PCM)
+            await asyncio.sleep(self.delay)
+            if text == "TRONCA":
+                await ws.close(); return
+            await ws.send(PCM)
+            await ws.send(json.dumps({"event": "end"}))
+
+    async def __aenter__(self):
+        self.server = await websockets.serve(self.handler, "127.0.0.1", 0)
+        self.url = f"ws://127.0.0.1:{self.server.sockets[0].getsockname()[1]}/stream"
+        return self
+
+    async def __aexit__(self, *exc):
+        self.server.close()
+        await self.server.wait_closed()
+
+
+def make_client(client, url, tmp_path):
+    tts = client.TTSClient(url=url, cache=client.TTSCache(directory=os.fspath(tmp_path / "tts_cache")))
+    tts.mode = "persistent"
+    return tts
+
+
+def make_auto_client(client, url, tmp_path):
+    tts = make_client(client, url, tmp_path)
+    tts.mode = "auto"
+    return tts
+
+
+async def collect(tts, text):
+    return b"".join([pcm async for pcm in tts.synthesize(text)])
+
+
+def test_complete_sentence_is_cached(client, tmp_path):
+    async def run():
+        async with StandInServer() as server:
+            tts = make_client(client, server.url, tmp_path)
+            assert await collect(tts, "Frase completa.") == PCM * 2
+            assert tts.cache.get("Frase completa.") is not None
+            await tts.close()
+    asyncio.run(run())
+
+
+def test_truncated_sentence_is_not_cached(client, tmp_path):
+    async def run():
+        async with StandInServer() as server:
+            tts = make_client(client, server.url, tmp_path)
+            with pytest.raises(ConnectionError):
+                await collect(tts, "TRONCA")
+            assert tts.cache.get("TRONCA") is None
+            assert tts.open_conns == 0
+            await tts.close()
+    asyncio.run(run())
+
+
+def test_warm_connection_is_reused(client, tmp_path):
+    async def run():
+        async with StandInServer() as server:
+            tts = make_client(client, server.url, tmp_path)
+            await tts.warm()
+            for i in range(3):
+                assert await collect(tts, f"Frase numero {i}.") == PCM * 2
+            assert (server.connections, tts.handshakes) == (1, 1)
+            await tts.close()
+    asyncio.run(run())
+
+
+def test_concurrent_syntheses_stay_within_pool(client, tmp_path):
+    async def run():
+        async with StandInServer(delay=0.05) as server:
+            tts = make_client(client, server.url, tmp_path)
+            texts = [f"Frase in parallelo {i}." for i in range(client.TTS_POOL_SIZE + 2)]
+            results = await asyncio.wait_for(asyncio.gather(*[collect(tts, t) for t in texts]), 5)
+            assert results == [PCM * 2] * len(texts)
+            assert server.connections <= client.TTS_POOL_SIZE
+            await tts.close()
+    asyncio.run(run())
+
+
+def test_waiter_wakes_when_connections_drop(client, tmp_path):
+    # Tutte le connessioni del pool cadono mentre un'altra frase attende uno slot: non deve restare appesa
+    async def run():
+        async with StandInServer(delay=0.05) as server:
+            tts = make_client(client, server.url, tmp_path)
+            dropped = [collect(tts, "TRONCA") for _ in range(client.TTS_POOL_SIZE)]
+            results = await asyncio.wait_for(asyncio.gather(*dropped, collect(tts, "Frase in attesa."), return_exceptions=True), 5)
+            assert all(isinstance(r, ConnectionError) for r in results[:-1])
+            assert results[-1] == PCM * 2
+            await tts.close()
+    asyncio.run(run())
+
+
+def test_auto_keeps_persistent_when_first_audio_is_slow(client, tmp_path):
+    # GPU fredda: il primo audio tarda ma la connessione resta aperta, il protocollo non cambia
+    async def run():
+        async with StandInServer(delay=0.5) as server:
+            tts = make_auto_client(client, server.url, tmp_path)
+            assert await asyncio.wait_for(collect(tts, "Prima frase lenta."), 5) == PCM * 2
+            assert tts.mode == "persistent"
+            await tts.close()
+    asyncio.run(run())
+
+
+def test_auto_retries_a_stale_warm_connection(client, tmp_path):
+    async def run():
+        async with StandInServer(drop_first=True) as server:
+            tts = make_auto_client(client, server.url, tmp_path)
+            await tts.warm()
+            assert await asyncio.wait_for(collect(tts, "Dopo una pausa lunga."), 5) == PCM * 2
+            assert tts.mode == "persistent" and server.connections == 2
+            await tts.close()
+    asyncio.run(run())
+
+
+def test_auto_falls_back_when_server_closes_without_audio(client, tmp_path):
+    async def run():
+        async with StandInServer(query_only=True) as server:
+            tts = make_auto_client(client, server.url, tmp_path)
+            assert await asyncio.wait_for(collect(tts, "Server della demo."), 5) == PCM * 2
+            assert tts.mode == "query"
+            await tts.close()
+    asyncio.run(run())
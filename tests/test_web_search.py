@@ -0,0 +1,67 @@
+import asyncio
+import time
+
+import pytest
+
+
+@pytest.fixture
+def search_server(brain, monkeypatch):
+    """Server locale al posto di Google Custom Search, sul loop di servizio del brain."""
+    web = pytest.importorskip("aiohttp.web")
+    state = {"requests": 0, "delay": 0.0, "fail": 0}
+
+    async def handler(request):
+        state["requests"] += 1
+        if state["fail"]:
+            state["fail"] -= 1
+            return web.json_response({}, status=500)
+        await asyncio.sleep(state["delay"])
+        q = request.query["q"]
+        return web.json_response({"items": [{"title": f"Titolo {q}", "snippet": "Snippet di prova", "link": "http://127.0.0.1:9/"}]})
+
+    async def start():
+        app = web.Application()
+        app.router.add_get("/customsearch/v1", handler)
+        runner = web.AppRunner(app)
+        await runner.setup()
+        site = web.TCPSite(runner, "127.0.0.1", 0)
+        await site.start()
+        return runner, runner.addresses[0][1]
+
+    runner, port = brain.run_async(start())
+    monkeypatch.setattr(brain, "SEARCH_URL", f"http://127.0.0.1:{port}/customsearch/v1")
+    monkeypatch.setattr(brain, "GOOGLE_SEARCH_API_KEY", "test-key")
+    monkeypatch.setattr(brain, "GOOGLE_SEARCH_CX", "test-cx")
+    yield state
+    brain.run_async(runner.cleanup())
+
+
+def search(brain, query, **kwargs):
+    return brain.run_async(brain.web_search_async(query, **kwargs))
+
+
+def test_results_are_formatted(brain, search_server):
+    assert search(brain, "formato risultati") == "- Titolo formato risultati: Snippet di prova"
+
+
+def test_connections_are_reused(brain, search_server):
+    before = dict(brain.tool_conn_stats)
+    for i in range(3):
+        search(brain, f"riuso connessione {i}")
+    assert brain.tool_conn_stats["new"] - before["new"] == 1
+    assert brain.tool_conn_stats["reused"] - before["reused"] == 2
+    assert "riusate" in brain.http_pool_stats()
+
+
+def test_server_error_is_retried(brain, search_server):
+    search_server["fail"] = 1
+    assert search(brain, "errore transitorio").startswith("- Titolo errore transitorio")
+    assert search_server["requests"] == 2
+
+
+def test_answers_within_budget(brain, search_server):
+    search_server["delay"] = 1.5
+    start = time.monotonic()
+    result = search(brain, "server lento", budget=0.5)
+    assert time.monotonic() - start < 1.0
+    assert "in tempo" in result